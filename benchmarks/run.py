@@ -0,0 +1,188 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+from mcpi_ru.connection import Connection
+from mcpi_ru.emulator import EmulatorServer, World
+from mcpi_ru.minecraft import Minecraft
+from mcpi_ru.vec3 import Vec3, Vec3Array
+
+""" Throughput and latency benchmarks of mcpi_ru against the server emulator.
+
+    python -m benchmarks.run [--latency 0.001] [--scale 1] [--output results.json]
+                             [--compare baseline.json] [--only get_block,vec3]
+
+    Prints a table and, with --output, writes the results as JSON. With
+    --compare, every benchmark is also reported as a ratio to the ops/sec
+    of the same benchmark in an earlier result file."""
+
+
+class Call:
+    """Times `ops` operations. Each sample is one call of call(mc, i), which
+    performs `per_sample` operations. prepare(mc, i), if given, runs before
+    each sample and is not timed. sync=True waits at the end until the server
+    has processed everything (part of the timing)"""
+
+    def __init__(self, name, ops, call, per_sample=1, sync=False, prepare=None):
+        self.name = name
+        self.ops = ops
+        self.call = call
+        self.per_sample = per_sample
+        self.sync = sync
+        self.prepare = prepare
+
+    def run(self, mc):
+        samples = []
+        clock = time.perf_counter
+        untimed = 0.0
+        start = clock()
+        for i in range(max(1, self.ops // self.per_sample)):
+            if self.prepare is not None:
+                t = clock()
+                self.prepare(mc, i)
+                untimed += clock() - t
+            t = clock()
+            self.call(mc, i)
+            samples.append(clock() - t)
+        if self.sync:
+            mc.flush()
+            mc.get_height(0, 0)
+        total = clock() - start - untimed
+        samples.sort()
+        ops = len(samples) * self.per_sample
+        return {
+            "name": self.name,
+            "ops": ops,
+            "seconds": total,
+            "ops_per_sec": ops / total if total else float("inf"),
+            "p50_us": samples[len(samples) // 2] / self.per_sample * 1e6,
+            "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))] / self.per_sample * 1e6,
+        }
+
+
+def pipelined_get_block(batch):
+    def call(mc, i):
+        with mc.pipeline() as p:
+            for j in range(batch):
+                p.get_block(j, 0, i)
+    return call
+
+
+def get_blocks_cube(size):
+    def call(mc, i):
+        mc.get_blocks(0, 0, 0, size - 1, size - 1, size - 1)
+    return call
+
+
+def post_events(world, count):
+    def prepare(mc, i):
+        for j in range(count):
+            world.hit_block(j, 64, -j)
+            world.post_chat(1, "message %d" % j)
+            world.hit_projectile(j, 64, -j, "shooter", "victim")
+    return prepare
+
+
+def poll_all(mc, i):
+    mc.events.poll_block_hits()
+    mc.events.poll_chat_posts()
+    mc.events.poll_projectile_hits()
+
+
+def vec3_arithmetic(mc, i):
+    a = Vec3(i, 2, 3)
+    b = Vec3(0.5, -1, 2)
+    for _ in range(1000):
+        a = (a + b) * 0.5 - b
+
+
+def vec3_array_arithmetic(points):
+    def call(mc, i):
+        ((points + Vec3(1, 2, 3)) * 0.5).floor().length()
+    return call
+
+
+def benchmarks(scale, world, events):
+    n = int(1000 * scale)
+    points = Vec3Array.from_points([(i, i * 0.5, -i) for i in range(10000)])
+    return [
+        Call("get_block", n, lambda mc, i: mc.get_block(i, 0, 0)),
+        Call("get_block_pipelined_x100", n, pipelined_get_block(100), per_sample=100),
+        Call("get_height", n, lambda mc, i: mc.get_height(i, 0)),
+        Call("player_get_pos", n, lambda mc, i: mc.player.get_pos()),
+        Call("set_block", 10 * n, lambda mc, i: mc.set_block(i, 0, 0, "stone"), sync=True),
+        Call("set_blocks_4x4x4", 10 * n, lambda mc, i: mc.set_blocks(0, 0, i, 3, 3, i + 3, "stone"), sync=True),
+        Call("get_blocks_4^3", n, get_blocks_cube(4)),
+        Call("get_blocks_16^3", max(1, n // 10), get_blocks_cube(16)),
+        Call("get_blocks_32^3", max(1, n // 100), get_blocks_cube(32)),
+        Call("read_volume_64^3", max(1, n // 1000), lambda mc, i: mc.read_volume((0, 0, 0), (63, 63, 63))),
+        Call("poll_events_x3", n, poll_all, per_sample=3, prepare=post_events(world, events)),
+        Call("vec3_arithmetic", 100 * n, vec3_arithmetic, per_sample=1000),
+        Call("vec3_array_10k", 10 * n, vec3_array_arithmetic(points), per_sample=10000),
+    ]
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    for r in results:
+        old = baseline.get(r["name"])
+        if old and old["ops_per_sec"]:
+            r["vs_baseline"] = r["ops_per_sec"] / old["ops_per_sec"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mcpi_ru benchmarks against the server emulator")
+    parser.add_argument("--latency", type=float, default=0.0, help="artificial round-trip latency, seconds")
+    parser.add_argument("--events", type=int, default=5, help="events returned per event poll")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the number of operations")
+    parser.add_argument("--buffer-size", type=int, default=0, help="Connection write buffer (0 = off)")
+    parser.add_argument("--only", default="", help="comma-separated benchmark names")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args(argv)
+
+    world = World(ground=0)
+    server = EmulatorServer(world=world, latency=args.latency).start()
+    mc = Minecraft(Connection(*server.address, buffer_size=args.buffer_size))
+    only = set(filter(None, args.only.split(",")))
+
+    results = []
+    for benchmark in benchmarks(args.scale, world, args.events):
+        if only and benchmark.name not in only:
+            continue
+        results.append(benchmark.run(mc))
+        r = results[-1]
+        sys.stderr.write("%-28s %10.0f ops/s   p50 %9.1f us   p99 %9.1f us\n"
+                         % (r["name"], r["ops_per_sec"], r["p50_us"], r["p99_us"]))
+    mc.conn.close()
+    server.close()
+
+    if args.compare:
+        compare(results, args.compare)
+        for r in results:
+            if "vs_baseline" in r:
+                sys.stderr.write("%-28s %6.2fx\n" % (r["name"], r["vs_baseline"]))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "latency": args.latency,
+            "events_per_poll": args.events,
+            "scale": args.scale,
+            "buffer_size": args.buffer_size,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
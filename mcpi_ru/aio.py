@@ -0,0 +1,396 @@
+import asyncio
+import collections
+import os
+import sys
+import time
+
+from .connection import Connection, RequestError
+from .vec3 import Vec3
+from .event import parse_block_hits, parse_chat_posts, parse_projectile_hits
+from .minecraft import int_floor, parse_str, parse_list, parse_player_ids, parse_vec3, parse_tile_vec3, parse_entities
+
+""" asyncio client with the same surface as minecraft.py.
+
+    Every method is a coroutine. Requests are written as soon as the
+    coroutine starts and responses are matched to waiting requests in FIFO
+    order by one reader task, so concurrent awaits are pipelined:
+
+    mc = await AsyncMinecraft.create()
+    heights = await asyncio.gather(*[mc.get_height(x, 0) for x in range(64)])"""
+
+
+class AsyncConnection:
+    """Connection to a Minecraft Pi game over asyncio streams"""
+    RequestFailed = Connection.RequestFailed
+    RequestFailedBytes = Connection.RequestFailedBytes
+    StreamLimit = 2 ** 24  # getBlocks responses can be far longer than a 64 KiB line
+
+    def __init__(self, reader, writer, debug=False, metrics=None):
+        self.reader = reader
+        self.writer = writer
+        self.debug = debug
+        self.metrics = metrics
+        self.lastSent = ""
+        self._pending = collections.deque()
+        self._error = None  # why the reader task stopped
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @staticmethod
+    async def open(address, port, debug=False, metrics=None):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(address, port, limit=AsyncConnection.StreamLimit), 10)
+        return AsyncConnection(reader, writer, debug, metrics)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                s = await self.reader.readline()
+                if not s:
+                    break
+                s = s.rstrip(b"\n")
+                if not self._pending:
+                    if self.metrics is not None:
+                        self.metrics.discarded(s + b"\n")
+                    if self.debug:
+                        sys.stderr.write("Drained Data: <%s>\nLast Message: <%s>\n" % (s, self.lastSent.strip()))
+                    continue
+                line, future, start = self._pending.popleft()
+                if self.metrics is not None:
+                    self.metrics.request(line[:line.find(b"(")], time.perf_counter() - start, len(line), len(s) + 1,
+                                         s == self.RequestFailedBytes)
+                if future.done():
+                    continue
+                if s == self.RequestFailedBytes:
+                    future.set_exception(RequestError("%s failed" % line.strip()))
+                else:
+                    future.set_result(s)
+            error = RequestError("Connection closed")
+        except Exception as e:
+            error = e
+        self._error = error
+        while self._pending:
+            _, future, _ = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def send(self, f, *data):
+        """Sends data. Note that a trailing newline '\n' is added here"""
+        s = Connection.command(f, *data)
+        self.lastSent = s
+        self.writer.write(s)
+        if self.metrics is not None:
+            self.metrics.sent(f, len(s))
+        await self.writer.drain()
+
+    async def send_receive_bytes(self, f, *data):
+        """Sends data and waits for the matching response as raw bytes"""
+        if self._reader_task.done():
+            # Nobody would ever answer the request
+            raise self._error or RequestError("Connection closed")
+        s = Connection.command(f, *data)
+        future = asyncio.get_running_loop().create_future()
+        # Queue and write without awaiting in between, so that the order of
+        # the queue is always the order of the requests on the wire.
+        self._pending.append((s, future, time.perf_counter() if self.metrics is not None else 0.0))
+        self.lastSent = s
+        self.writer.write(s)
+        await self.writer.drain()
+        return await future
+
+    async def send_receive(self, f, *data):
+        """Sends and receive data"""
+        return (await self.send_receive_bytes(f, *data)).decode("UTF-8")
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        finally:
+            await self._reader_task
+
+
+class AsyncCmdPositioner:
+    """Методы для получения и изменения позиции"""
+
+    def __init__(self, connection, package_prefix):
+        self.conn = connection
+        self.pkg = package_prefix
+
+    async def get_pos(self, entity_id) -> Vec3:
+        """Получить позицию сущности (entityId:int) => Vec3"""
+        return parse_vec3(await self.conn.send_receive_bytes(self.pkg + b".getPos", entity_id))
+
+    async def set_pos(self, entity_id, *args):
+        """Изменить позицию сущности (entityId:int, x,y,z)"""
+        await self.conn.send(self.pkg + b".setPos", entity_id, args)
+
+    async def get_tile_pos(self, entity_id) -> Vec3:
+        """Получить положение блока, на котором стоит сущность (entityId:int) => Vec3"""
+        return parse_tile_vec3(await self.conn.send_receive_bytes(self.pkg + b".getTile", entity_id))
+
+    async def set_tile_pos(self, entity_id, *args):
+        """Изменить положение блока, на котором стоит сущность (entityId:int) => Vec3"""
+        await self.conn.send(self.pkg + b".setTile", entity_id, int_floor(*args))
+
+    async def set_direction(self, entity_id, *args):
+        """Изменить направление сущности (entityId:int, x,y,z)"""
+        await self.conn.send(self.pkg + b".setDirection", entity_id, args)
+
+    async def get_direction(self, entity_id) -> Vec3:
+        """Получить направление сущности (entityId:int) => Vec3"""
+        return parse_vec3(await self.conn.send_receive_bytes(self.pkg + b".getDirection", entity_id))
+
+    async def set_rotation(self, entity_id, yaw):
+        """Изменить угол поворота сущности (entityId:int, yaw)"""
+        await self.conn.send(self.pkg + b".setRotation", entity_id, yaw)
+
+    async def get_rotation(self, entity_id) -> float:
+        """Получить угол поворота сущности (entityId:int) => float"""
+        return float(await self.conn.send_receive_bytes(self.pkg + b".getRotation", entity_id))
+
+    async def set_pitch(self, entity_id, pitch: int):
+        """Изменить угол наклона сущности (entityId:int, pitch)"""
+        await self.conn.send(self.pkg + b".setPitch", entity_id, pitch)
+
+    async def get_pitch(self, entity_id) -> float:
+        """Получить угол наклона сущности (entityId:int) => float"""
+        return float(await self.conn.send_receive_bytes(self.pkg + b".getPitch", entity_id))
+
+    async def setting(self, setting: str, status: bool):
+        """Изменить настройки игрока (setting, status). keys: autojump"""
+        await self.conn.send(self.pkg + b".setting", setting, 1 if bool(status) else 0)
+
+
+class AsyncCmdEntity(AsyncCmdPositioner):
+    """Методы для сущностей"""
+
+    def __init__(self, connection):
+        AsyncCmdPositioner.__init__(self, connection, b"entity")
+
+    async def get_name(self, player_id: int) -> str:
+        """Получить имя игрока или сущности, используя ID => name:str"""
+        return await self.conn.send_receive(b"entity.getName", player_id)
+
+    async def remove(self, player_id: int):
+        await self.conn.send(b"entity.remove", player_id)
+
+
+class AsyncEntity:
+    def __init__(self, conn, entity_uuid, type_name):
+        self.p = AsyncCmdPositioner(conn, b"entity")
+        self.id = entity_uuid
+        self.type = type_name
+
+    async def get_pos(self) -> Vec3:
+        return await self.p.get_pos(self.id)
+
+    async def set_pos(self, *args):
+        return await self.p.set_pos(self.id, args)
+
+    async def get_tile_pos(self) -> Vec3:
+        return await self.p.get_tile_pos(self.id)
+
+    async def set_tile_pos(self, *args):
+        return await self.p.set_tile_pos(self.id, args)
+
+    async def set_direction(self, *args):
+        return await self.p.set_direction(self.id, args)
+
+    async def get_direction(self) -> Vec3:
+        return await self.p.get_direction(self.id)
+
+    async def set_rotation(self, yaw):
+        return await self.p.set_rotation(self.id, yaw)
+
+    async def get_rotation(self) -> float:
+        return await self.p.get_rotation(self.id)
+
+    async def set_pitch(self, pitch):
+        return await self.p.set_pitch(self.id, pitch)
+
+    async def get_pitch(self) -> float:
+        return await self.p.get_pitch(self.id)
+
+    async def remove(self):
+        await self.p.conn.send(b"entity.remove", self.id)
+
+
+class AsyncCmdPlayer(AsyncCmdPositioner):
+    """Methods for the host (Raspberry Pi) player"""
+
+    def __init__(self, connection):
+        AsyncCmdPositioner.__init__(self, connection, b"player")
+
+    async def get_pos(self) -> Vec3:
+        return await AsyncCmdPositioner.get_pos(self, [])
+
+    async def set_pos(self, *args):
+        return await AsyncCmdPositioner.set_pos(self, [], args)
+
+    async def get_tile_pos(self) -> Vec3:
+        return await AsyncCmdPositioner.get_tile_pos(self, [])
+
+    async def set_tile_pos(self, *args):
+        return await AsyncCmdPositioner.set_tile_pos(self, [], args)
+
+    async def set_direction(self, *args):
+        return await AsyncCmdPositioner.set_direction(self, [], args)
+
+    async def get_direction(self) -> Vec3:
+        return await AsyncCmdPositioner.get_direction(self, [])
+
+    async def set_rotation(self, yaw):
+        return await AsyncCmdPositioner.set_rotation(self, [], yaw)
+
+    async def get_rotation(self) -> float:
+        return await AsyncCmdPositioner.get_rotation(self, [])
+
+    async def set_pitch(self, pitch):
+        return await AsyncCmdPositioner.set_pitch(self, [], pitch)
+
+    async def get_pitch(self) -> float:
+        return await AsyncCmdPositioner.get_pitch(self, [])
+
+
+class AsyncCmdCamera:
+    def __init__(self, connection):
+        self.conn = connection
+
+    async def set_normal(self, *args):
+        """Set camera mode to normal Minecraft view ([entityId])"""
+        await self.conn.send(b"camera.mode.setNormal", args)
+
+    async def set_fixed(self):
+        """Set camera mode to fixed view"""
+        await self.conn.send(b"camera.mode.setFixed")
+
+    async def set_follow(self, *args):
+        """Set camera mode to follow an entity ([entityId])"""
+        await self.conn.send(b"camera.mode.setFollow", args)
+
+    async def set_pos(self, *args):
+        """Set camera entity position (x,y,z)"""
+        await self.conn.send(b"camera.setPos", args)
+
+
+class AsyncCmdEvents:
+    """События"""
+
+    def __init__(self, connection):
+        self.conn = connection
+
+    async def clear_all(self):
+        """Очистить список старых событий"""
+        await self.conn.send(b"events.clear")
+
+    async def poll_block_hits(self) -> list:
+        """При ударе мечом => [BlockEvent]"""
+        return parse_block_hits(await self.conn.send_receive_bytes(b"events.block.hits"))
+
+    async def poll_chat_posts(self) -> list:
+        """При использовании чата => [ChatEvent]"""
+        return parse_chat_posts(await self.conn.send_receive_bytes(b"events.chat.posts"))
+
+    async def poll_projectile_hits(self) -> list:
+        """При использовании снарядов => [ProjectileEvent]"""
+        return parse_projectile_hits(await self.conn.send_receive_bytes(b"events.projectile.hits"))
+
+
+class AsyncMinecraft:
+    """asyncio version of Minecraft: the same methods, awaitable."""
+
+    def __init__(self, connection):
+        self.conn = connection
+
+        self.camera = AsyncCmdCamera(connection)
+        self.entity = AsyncCmdEntity(connection)
+        self.player = AsyncCmdPlayer(connection)
+        self.events = AsyncCmdEvents(connection)
+
+    async def get_block(self, *args):
+        """Получить блок (x,y,z) => id"""
+        return await self.conn.send_receive(b"world.getBlock", int_floor(args))
+
+    async def get_block_with_data(self, *args):
+        """Получить блок с параметрами (x,y,z) => Block"""
+        return parse_list(await self.conn.send_receive_bytes(b"world.getBlockWithData", int_floor(args)))
+
+    async def get_blocks(self, *args):
+        """Получить блоки в координатах (x0,y0,z0,x1,y1,z1) => [id]"""
+        return parse_list(await self.conn.send_receive_bytes(b"world.getBlocks", int_floor(args)))
+
+    async def set_block(self, *args):
+        """Изменить блок (x,y,z,nameOfBlock,[data])"""
+        await self.conn.send(b"world.setBlock", *args)
+
+    async def set_blocks(self, *args):
+        """Изменить блоки в координатах (x0,y0,z0,x1,y1,z1,nameOfBlock,[data])"""
+        await self.conn.send(b"world.setBlocks", *args)
+
+    async def set_sign(self, *args):
+        """Установить табличку (x, y, z, sign_type, направление, линия1, линия2, линия3, линия4)"""
+        await self.conn.send(b"world.setSign", *args)
+
+    async def spawn_entity(self, *args):
+        """Создать сущность (x,y,z,id,[data])"""
+        return AsyncEntity(self.conn, await self.conn.send_receive(b"world.spawnEntity", *args), args[3])
+
+    async def spawn_particle(self, *args):
+        """Сущность частицу (x,y,z,id,[data])"""
+        await self.conn.send(b"world.spawnParticle", *args)
+
+    async def get_nearby_entities(self, *args) -> list:
+        """Получить сущности поблизости (x,y,z) => [AsyncEntity]"""
+        s = await self.conn.send_receive_bytes(b"world.getNearbyEntities", *args)
+        return parse_entities(self.conn, s, AsyncEntity)
+
+    async def remove_entity(self, *args):
+        """Удалить сущность (x,y,z,id,[data])"""
+        return await self.conn.send_receive(b"world.removeEntity", *args)
+
+    async def get_height(self, *args) -> int:
+        """Получить самый высокостоящий блок (x,z) => int"""
+        return int(await self.conn.send_receive_bytes(b"world.getHeight", int_floor(args)))
+
+    async def get_player_entity_ids(self):
+        """Получить ID игроков, находящихся в игре => [id]"""
+        return parse_player_ids(await self.conn.send_receive_bytes(b"world.getPlayerIds"))
+
+    async def get_player_entity_id(self, name: str):
+        """Получить ID игрока, используя его ник => id"""
+        return parse_str(await self.conn.send_receive_bytes(b"world.getPlayerId", name))
+
+    async def save_checkpoint(self):
+        """Сохранить мир, чтобы затем его восстановить"""
+        await self.conn.send(b"world.checkpoint.save")
+
+    async def restore_checkpoint(self):
+        """Восстановить мир до точки восстановления"""
+        await self.conn.send(b"world.checkpoint.restore")
+
+    async def post_to_chat(self, msg):
+        """Написать сообщение в чате"""
+        await self.conn.send(b"chat.post", msg)
+
+    async def setting(self, setting, status):
+        """Изменить настройки мира (setting, status). keys: world_immutable, nametags_visible"""
+        await self.conn.send(b"world.setting", setting, 1 if bool(status) else 0)
+
+    async def set_player(self, name):
+        """Указать игрока, с которым будет происходить работа"""
+        return await self.conn.send_receive(b"setPlayer", name)
+
+    async def close(self):
+        await self.conn.close()
+
+    @staticmethod
+    async def create(address="localhost", port=4711, debug=False, metrics=None):
+        """Создать подключение к серверу. metrics: metrics.Metrics для учета запросов"""
+        if "JRP_API_HOST" in os.environ:
+            address = os.environ["JRP_API_HOST"]
+        if "JRP_API_PORT" in os.environ:
+            try:
+                port = int(os.environ["JRP_API_PORT"])
+            except ValueError:
+                pass
+        return AsyncMinecraft(await AsyncConnection.open(address, port, debug, metrics))
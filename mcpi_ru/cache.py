@@ -0,0 +1,211 @@
+import threading
+from collections import OrderedDict
+
+""" Client-side cache of block reads, keyed by 16x16 chunk columns.
+
+    Holds the answers of world.getBlock, world.getBlockWithData and
+    world.getHeight, and whole 16x16 tiles of heights read by
+    Minecraft.get_heightmap. Writes made through the same Minecraft
+    object drop the cached entries they cover (the next read asks the
+    server, so values are always spelled the way the server answers),
+    block hit events drop the blocks that were hit, and restoring a
+    checkpoint clears everything. Changes made by other clients or by
+    players are not seen until the entry is evicted or invalidated."""
+
+CHUNK_SHIFT = 4
+TILE_SIZE = 1 << CHUNK_SHIFT
+TILE_ENTRIES = TILE_SIZE * TILE_SIZE
+
+
+class _Chunk:
+    __slots__ = ("blocks", "data", "heights", "tile")
+
+    def __init__(self):
+        self.blocks = {}   # (x, y, z) -> getBlock answer
+        self.data = {}     # (x, y, z) -> getBlockWithData answer
+        self.heights = {}  # (x, z) -> getHeight answer
+        self.tile = None   # heights of the whole chunk column, array('i') in x, z order
+
+    def __len__(self):
+        return len(self.blocks) + len(self.data) + len(self.heights) + (TILE_ENTRIES if self.tile is not None else 0)
+
+
+class BlockCache:
+    """Кэш блоков с вытеснением давно не использованных чанков (LRU).
+
+    max_entries: сколько значений (блоков и высот) хранится одновременно."""
+
+    def __init__(self, max_entries=1 << 20):
+        self.max_entries = max_entries
+        self._chunks = OrderedDict()
+        self._entries = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _chunk(self, x, z, create=False):
+        key = (x >> CHUNK_SHIFT, z >> CHUNK_SHIFT)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+        elif create:
+            chunk = self._chunks[key] = _Chunk()
+        return chunk
+
+    def _lookup(self, table, x, z, key):
+        with self._lock:
+            chunk = self._chunk(x, z)
+            value = None if chunk is None else getattr(chunk, table).get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def _store(self, table, x, z, key, value):
+        with self._lock:
+            entries = getattr(self._chunk(x, z, True), table)
+            if key not in entries:
+                self._entries += 1
+            entries[key] = value
+            self._evict()
+
+    def _evict(self):
+        while self._entries > self.max_entries and self._chunks:
+            _, chunk = self._chunks.popitem(last=False)
+            self._entries -= len(chunk)
+            self.evictions += 1
+
+    def get_block(self, x, y, z):
+        return self._lookup("blocks", x, z, (x, y, z))
+
+    def put_block(self, x, y, z, block):
+        self._store("blocks", x, z, (x, y, z), block)
+
+    def get_block_with_data(self, x, y, z):
+        value = self._lookup("data", x, z, (x, y, z))
+        return None if value is None else list(value)
+
+    def put_block_with_data(self, x, y, z, value):
+        self._store("data", x, z, (x, y, z), tuple(value))
+
+    def get_height(self, x, z):
+        with self._lock:
+            chunk = self._chunk(x, z)
+            if chunk is not None and chunk.tile is not None:
+                self.hits += 1
+                return chunk.tile[(x & (TILE_SIZE - 1)) * TILE_SIZE + (z & (TILE_SIZE - 1))]
+        return self._lookup("heights", x, z, (x, z))
+
+    def put_height(self, x, z, height):
+        self._store("heights", x, z, (x, z), height)
+
+    def get_height_tile(self, cx, cz):
+        """Высоты всех столбцов чанка (cx, cz): array('i') в порядке x, z, или None"""
+        with self._lock:
+            chunk = self._chunk(cx << CHUNK_SHIFT, cz << CHUNK_SHIFT)
+            tile = None if chunk is None else chunk.tile
+            if tile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return tile
+
+    def put_height_tile(self, cx, cz, tile):
+        with self._lock:
+            chunk = self._chunk(cx << CHUNK_SHIFT, cz << CHUNK_SHIFT, True)
+            if chunk.tile is None:
+                self._entries += TILE_ENTRIES
+            chunk.tile = tile
+            self._evict()
+
+    def write(self, x0, y0, z0, x1, y1, z1):
+        """Records a write over the cuboid: cached blocks, block data and
+        heights of the columns it covers are dropped. The new value is not
+        stored, the next read gets it from the server in its own spelling"""
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        z0, z1 = min(z0, z1), max(z0, z1)
+        with self._lock:
+            if x0 == x1 and y0 == y1 and z0 == z1:
+                chunk = self._chunks.get((x0 >> CHUNK_SHIFT, z0 >> CHUNK_SHIFT))
+                if chunk is not None:
+                    for table, key in ((chunk.blocks, (x0, y0, z0)), (chunk.data, (x0, y0, z0)),
+                                       (chunk.heights, (x0, z0))):
+                        if key in table:
+                            self._drop(table, (key,))
+                    if chunk.tile is not None:
+                        chunk.tile = None
+                        self._entries -= TILE_ENTRIES
+                        self.invalidations += 1
+                return
+            cxs = range(x0 >> CHUNK_SHIFT, (x1 >> CHUNK_SHIFT) + 1)
+            czs = range(z0 >> CHUNK_SHIFT, (z1 >> CHUNK_SHIFT) + 1)
+            if len(cxs) * len(czs) <= len(self._chunks):
+                chunks = [(key, self._chunks.get(key)) for key in ((cx, cz) for cx in cxs for cz in czs)]
+            else:
+                chunks = [(key, chunk) for key, chunk in self._chunks.items() if key[0] in cxs and key[1] in czs]
+            for (cx, cz), chunk in chunks:
+                if chunk is None:
+                    continue
+                # The part of the cuboid inside this chunk
+                ax, bx = max(x0, cx << CHUNK_SHIFT), min(x1, ((cx + 1) << CHUNK_SHIFT) - 1)
+                az, bz = max(z0, cz << CHUNK_SHIFT), min(z1, ((cz + 1) << CHUNK_SHIFT) - 1)
+                area = (bx - ax + 1) * (bz - az + 1)
+                for table in (chunk.blocks, chunk.data):
+                    if not table:
+                        continue
+                    if area * (y1 - y0 + 1) <= len(table):
+                        self._drop(table, [k for k in ((x, y, z) for x in range(ax, bx + 1)
+                                                       for y in range(y0, y1 + 1) for z in range(az, bz + 1))
+                                           if k in table])
+                    else:
+                        self._drop(table, [k for k in table
+                                           if ax <= k[0] <= bx and y0 <= k[1] <= y1 and az <= k[2] <= bz])
+                if chunk.heights:
+                    if area <= len(chunk.heights):
+                        self._drop(chunk.heights, [k for k in ((x, z) for x in range(ax, bx + 1)
+                                                               for z in range(az, bz + 1))
+                                                   if k in chunk.heights])
+                    else:
+                        self._drop(chunk.heights, [k for k in chunk.heights
+                                                   if ax <= k[0] <= bx and az <= k[1] <= bz])
+                if chunk.tile is not None:
+                    chunk.tile = None
+                    self._entries -= TILE_ENTRIES
+                    self.invalidations += 1
+
+    def _drop(self, table, keys):
+        for k in keys:
+            del table[k]
+        self._entries -= len(keys)
+        self.invalidations += len(keys)
+
+    def invalidate(self, x, y, z):
+        """Drops everything cached about the block (x, y, z)"""
+        self.write(x, y, z, x, y, z)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += self._entries
+            self._chunks.clear()
+            self._entries = 0
+
+    def __len__(self):
+        return self._entries
+
+    def stats(self) -> dict:
+        """Счетчики кэша: попадания, промахи, вытеснения, размер"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._entries,
+                "chunks": len(self._chunks),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
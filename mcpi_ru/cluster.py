@@ -0,0 +1,246 @@
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .connection import Connection
+from .minecraft import Minecraft
+
+""" Driving many servers at once.
+
+    MinecraftCluster connects to every server concurrently and fans calls
+    out to all of them. Every server has its own lane (a single worker
+    thread), so the commands sent to one server stay in order, all servers
+    work at the same time, and a slow or dead server only holds up its own
+    lane. Any Minecraft method can be called on the cluster; the call waits
+    for every server and returns their results. broadcast() only queues the
+    call on every lane and returns at once:
+
+    cluster = MinecraftCluster(["10.0.0.5", "10.0.0.6:4712"])
+    cluster.broadcast("post_to_chat", "Урок начался")
+    heights = cluster.get_height(0, 0)   # {server name: height}
+    print(heights.errors, cluster.health())"""
+
+DEFAULT_PORT = 4711
+
+
+def parse_address(address):
+    """"host", "host:port" или (host, port) => (host, port)"""
+    if isinstance(address, (tuple, list)):
+        return address[0], int(address[1])
+    host, sep, port = str(address).rpartition(":")
+    if not sep or not port.isdigit():
+        return str(address), DEFAULT_PORT
+    return host, int(port)
+
+
+class ClusterResult(dict):
+    """Результаты по серверам {имя: значение}; ошибки - в errors {имя: исключение}"""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.errors = {}
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def __repr__(self):
+        return "ClusterResult(%s, errors=%r)" % (dict.__repr__(self), self.errors)
+
+
+class ServerNode:
+    """Один сервер кластера: подключение, очередь команд и статистика"""
+
+    def __init__(self, address, name=None):
+        self.address = parse_address(address)
+        self.name = name or "%s:%d" % self.address
+        self.mc = None
+        self.lane = ThreadPoolExecutor(1, thread_name_prefix="cluster-%s" % self.name)
+        self.lock = threading.Lock()
+        self.backlog = 0
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.latency = None  # moving average, seconds
+        self.last_error = None
+        self.last_ok = None
+
+    @property
+    def up(self) -> bool:
+        return self.mc is not None
+
+    def connect(self, io_timeout, **kwargs):
+        host, port = self.address
+        try:
+            # Not Minecraft.create: JRP_API_HOST/JRP_API_PORT would send every node to the same server
+            mc = Minecraft(Connection(host, port, **kwargs))
+        except OSError as e:
+            self.last_error = e
+            self.mc = None
+            return False
+        mc.conn.socket.settimeout(io_timeout)
+        self.mc = mc
+        return True
+
+    def disconnect(self):
+        mc, self.mc = self.mc, None
+        if mc is not None:
+            try:
+                mc.conn.close()
+            except OSError:
+                pass
+
+    def _run(self, fn, args, kwargs):
+        with self.lock:
+            self.backlog -= 1
+        mc = self.mc
+        if mc is None:
+            raise ConnectionError("%s is down: %s" % (self.name, self.last_error))
+        start = time.perf_counter()
+        try:
+            result = fn(mc, *args, **kwargs)
+        except (OSError, socket.timeout) as e:
+            # The connection is no longer usable (or out of step); reconnect() brings it back
+            self.failures += 1
+            self.last_error = e
+            self.disconnect()
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = e
+            raise
+        elapsed = time.perf_counter() - start
+        self.requests += 1
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.last_ok = time.time()
+        return result
+
+    def submit(self, fn, args=(), kwargs=None):
+        with self.lock:
+            self.backlog += 1
+        return self.lane.submit(self._run, fn, args, kwargs or {})
+
+    def health(self) -> dict:
+        return {
+            "name": self.name,
+            "up": self.up,
+            "latency_ms": None if self.latency is None else self.latency * 1000.0,
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "backlog": self.backlog,
+            "last_ok": self.last_ok,
+            "last_error": None if self.last_error is None else repr(self.last_error),
+        }
+
+    def close(self):
+        self.lane.shutdown(wait=False)
+        self.disconnect()
+
+
+class MinecraftCluster:
+    """Подключение к нескольким серверам сразу.
+
+    addresses: адреса серверов ("host", "host:port" или (host, port)).
+    timeout: сколько секунд ждать ответы серверов в вызовах с результатом.
+    max_backlog: сервер, у которого в очереди больше команд, пропускается,
+    пока не разгрузится. Остальные аргументы (debug, buffer_size, metrics,
+    recorder) передаются Connection."""
+
+    def __init__(self, addresses, timeout=5.0, io_timeout=30.0, max_backlog=10000, **kwargs):
+        self.nodes = [ServerNode(a) for a in addresses]
+        self.timeout = timeout
+        self.io_timeout = io_timeout
+        self.max_backlog = max_backlog
+        self._kwargs = kwargs
+        self.reconnect()
+
+    def reconnect(self) -> int:
+        """Подключиться к серверам, которые недоступны => сколько серверов работает"""
+        down = [node for node in self.nodes if not node.up]
+        if down:
+            with ThreadPoolExecutor(len(down)) as pool:
+                list(pool.map(lambda node: node.connect(self.io_timeout, **self._kwargs), down))
+        return len([node for node in self.nodes if node.up])
+
+    def node(self, name) -> ServerNode:
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        raise KeyError(name)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def call(self, fn, *args, wait_results=True, timeout=None, **kwargs):
+        """Выполнить fn(mc, *args, **kwargs) на всех работающих серверах.
+
+        wait_results=False - не ждать (для команд без ответа): все записи
+        уходят параллельно. Иначе => ClusterResult; серверы, не ответившие
+        за timeout, попадают в errors с TimeoutError."""
+        futures = {}
+        result = ClusterResult()
+        for node in self.nodes:
+            if not node.up:
+                result.errors[node.name] = ConnectionError("%s is down: %s" % (node.name, node.last_error))
+            elif node.backlog > self.max_backlog:
+                result.errors[node.name] = TimeoutError("%s is behind by %d calls" % (node.name, node.backlog))
+            else:
+                futures[node.submit(fn, args, kwargs)] = node
+        if not wait_results:
+            return result
+        done, pending = wait(futures, self.timeout if timeout is None else timeout)
+        for future in pending:
+            node = futures[future]
+            node.timeouts += 1
+            result.errors[node.name] = TimeoutError("%s did not answer in time" % node.name)
+        for future in done:
+            node = futures[future]
+            try:
+                result[node.name] = future.result()
+            except Exception as e:
+                result.errors[node.name] = e
+        return result
+
+    def broadcast(self, method, *args, **kwargs):
+        """Вызвать метод Minecraft method(*args) на всех серверах, не дожидаясь результата"""
+        return self.call(lambda mc: getattr(mc, method)(*args, **kwargs), wait_results=False)
+
+    def gather(self, method, *args, timeout=None, **kwargs) -> ClusterResult:
+        """Вызвать метод Minecraft method(*args) на всех серверах => ClusterResult"""
+        return self.call(lambda mc: getattr(mc, method)(*args, **kwargs), timeout=timeout)
+
+    def __getattr__(self, name):
+        # Any Minecraft method, fanned out: cluster.get_height(0, 0) => ClusterResult
+        if name.startswith("_") or not callable(getattr(Minecraft, name, None)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.gather(name, *args, **kwargs)
+
+    def flush(self, timeout=None) -> ClusterResult:
+        """Отправить накопленные команды и дождаться, пока все серверы их выполнят"""
+        def sync(mc):
+            mc.flush()
+            mc.get_player_entity_ids()  # answered after everything sent before it
+        return self.call(sync, timeout=timeout)
+
+    def ping(self, timeout=None) -> ClusterResult:
+        """Задержка круга запрос-ответ каждого сервера, секунды"""
+        def measure(mc):
+            start = time.perf_counter()
+            mc.get_player_entity_ids()
+            return time.perf_counter() - start
+        return self.call(measure, timeout=timeout)
+
+    def health(self) -> list:
+        return [node.health() for node in self.nodes]
+
+    def close(self):
+        for node in self.nodes:
+            node.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
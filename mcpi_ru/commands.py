@@ -0,0 +1,430 @@
+import bisect
+import shlex
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import LATENCY_BUCKETS
+
+""" Chat commands.
+
+    CommandRouter matches chat posts against registered commands with a
+    prefix trie (the longest registered command that the message starts
+    with wins, so "team join" and "team" can both exist), converts the
+    arguments once and runs the handler on a bounded pool of worker
+    threads. Commands of one player run one after another in the order
+    they were posted; different players run in parallel. Every player has
+    a token bucket of commands, and posts over the limit or over the
+    pending limit are dropped instead of blocking the event loop:
+
+    router = CommandRouter(mc, prefix="!")
+
+    @router.command("tp", float, float, float)
+    def tp(ctx, x, y, z):
+        mc.entity.set_pos(ctx.player, x, y, z)
+
+    stream = EventStream(mc)
+    router.attach(stream)
+    stream.start()"""
+
+_END = ""  # trie key of the command that ends at a node
+
+
+class CommandError(Exception):
+    """Ошибка в аргументах команды; сообщение отправляется игроку в чат"""
+
+
+class CommandContext:
+    """Вызов команды: event (ChatEvent), player (id игрока), name, args
+    (аргументы после преобразования), text (строка аргументов)"""
+    __slots__ = ("router", "event", "player", "name", "args", "text", "posted")
+
+    def __init__(self, router, event, name, args, text, posted):
+        self.router = router
+        self.event = event
+        self.player = event.entityId
+        self.name = name
+        self.args = args
+        self.text = text
+        self.posted = posted
+
+    def reply(self, message):
+        """Ответить в чат"""
+        self.router.reply(self, message)
+
+    def __repr__(self):
+        return "CommandContext(%s, %r, %r)" % (self.player, self.name, self.args)
+
+
+class CommandStats:
+    """Счетчики одной команды; задержки - от сообщения в чате до конца обработчика"""
+    __slots__ = ("calls", "errors", "latency_sum", "wait_sum", "latency_max", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.wait_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, wait, latency, failed):
+        self.calls += 1
+        self.errors += failed
+        self.wait_sum += wait
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def quantile(self, q):
+        """Оценка квантиля задержки (верхняя граница корзины), секунды"""
+        if not self.calls:
+            return None
+        rank = q * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency_mean": self.latency_sum / self.calls if self.calls else None,
+            "latency_max": self.latency_max,
+            "latency_p50": self.quantile(0.5),
+            "latency_p99": self.quantile(0.99),
+            "wait_mean": self.wait_sum / self.calls if self.calls else None,
+        }
+
+
+class _Command:
+    __slots__ = ("name", "handler", "converters", "rest", "stats")
+
+    def __init__(self, name, handler, converters, rest):
+        self.name = name
+        self.handler = handler
+        self.converters = converters
+        self.rest = rest
+        self.stats = CommandStats()
+
+    def parse(self, text):
+        if self.rest:
+            return (text,) if text else ()
+        try:
+            words = shlex.split(text)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if len(words) < len(self.converters):
+            raise CommandError("%s: expected %d arguments, got %d" % (self.name, len(self.converters), len(words)))
+        args = []
+        for i, word in enumerate(words):
+            if i >= len(self.converters):
+                args.append(word)
+                continue
+            try:
+                args.append(self.converters[i](word))
+            except ValueError:
+                raise CommandError("%s: bad argument %r" % (self.name, word))
+        return tuple(args)
+
+
+class _Player:
+    """Pending commands and token bucket of one player"""
+    __slots__ = ("queue", "running", "tokens", "last")
+
+    def __init__(self, burst, now):
+        self.queue = deque()
+        self.running = False
+        self.tokens = float(burst)
+        self.last = now
+
+
+class CommandRouter:
+    """Разбор сообщений чата на команды и их выполнение в пуле потоков.
+
+    prefix: с чего начинается команда ("!" - "!tp 1 2 3"). workers: число
+    потоков обработчиков, max_pending: сколько команд может ждать
+    выполнения (лишние отбрасываются). rate, burst: команд в секунду на
+    игрока и запас на короткие всплески (rate=None - без ограничения).
+    errors_to_chat: отвечать игроку текстом CommandError."""
+
+    def __init__(self, mc=None, prefix="", workers=8, max_pending=1000, rate=5.0, burst=10,
+                 errors_to_chat=True):
+        self.mc = mc
+        self.prefix = prefix
+        self.max_pending = max_pending
+        self.rate = rate
+        self.burst = burst
+        self.errors_to_chat = errors_to_chat
+        self.commands = {}
+        self._trie = {}
+        self._players = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="CommandRouter")
+        self.received = 0
+        self.unmatched = 0
+        self.limited = 0
+        self.dropped = 0
+        self.bad_arguments = 0
+
+    # -- registration --
+
+    def add(self, name, handler, *converters, rest=False):
+        """Зарегистрировать команду name (может состоять из нескольких слов).
+
+        handler(ctx, *args); converters - функции преобразования аргументов
+        по порядку (int, float, ...), лишние аргументы передаются строками.
+        rest=True: весь текст после команды - один аргумент."""
+        name = " ".join(name.split())
+        if not name:
+            raise ValueError("A command needs a name")
+        command = _Command(name, handler, converters, rest)
+        node = self._trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[_END] = command
+        self.commands[name] = command
+        return handler
+
+    def command(self, name, *converters, rest=False):
+        """Декоратор: @router.command("give", str, int)"""
+        def register(handler):
+            return self.add(name, handler, *converters, rest=rest)
+        return register
+
+    def match(self, message):
+        """Найти команду в сообщении => (команда, строка аргументов) или None"""
+        prefix = self.prefix
+        if prefix:
+            if not message.startswith(prefix):
+                return None
+            message = message[len(prefix):]
+        message = message.strip()
+        node = self._trie
+        found = None
+        for i, char in enumerate(message):
+            if char.isspace():
+                # Words of a command are separated by one space in the trie
+                if message[i - 1].isspace():
+                    continue
+                char = " "
+                if _END in node:
+                    found = (node[_END], i)
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if _END in node:
+                found = (node[_END], len(message))
+        if found is None:
+            return None
+        command, end = found
+        return command, message[end:].strip()
+
+    # -- dispatch --
+
+    def attach(self, stream):
+        """Получать сообщения чата из EventStream"""
+        stream.on_chat_post(self.dispatch)
+        return self
+
+    def poll(self) -> int:
+        """Забрать сообщения чата с сервера и разобрать их => сколько команд принято"""
+        return len([e for e in self.mc.events.poll_chat_posts() if self.dispatch(e)])
+
+    def dispatch(self, event, posted=None) -> bool:
+        """Разобрать ChatEvent и поставить команду в очередь => False, если это не
+        команда или она отброшена. Сам обработчик не ждет."""
+        posted = time.perf_counter() if posted is None else posted
+        self.received += 1
+        found = self.match(event.message)
+        if found is None:
+            self.unmatched += 1
+            return False
+        command, text = found
+        try:
+            args = command.parse(text)
+        except CommandError as e:
+            self.bad_arguments += 1
+            self._error(event, e)
+            return False
+        ctx = CommandContext(self, event, command.name, args, text, posted)
+        with self._lock:
+            player = self._players.get(event.entityId)
+            if player is None:
+                player = self._players[event.entityId] = _Player(self.burst, posted)
+            if self.rate is not None:
+                # Events of a poll can arrive with times out of order
+                player.tokens = min(float(self.burst), player.tokens + max(posted - player.last, 0.0) * self.rate)
+                player.last = max(posted, player.last)
+                if player.tokens < 1.0:
+                    self.limited += 1
+                    return False
+                player.tokens -= 1.0
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            player.queue.append((command, ctx))
+            if player.running:
+                return True
+            player.running = True
+        self._pool.submit(self._drain, event.entityId, player)
+        return True
+
+    def _drain(self, player_id, player):
+        # Runs the commands of one player in order; other players use other workers
+        while True:
+            with self._lock:
+                if not player.queue:
+                    player.running = False
+                    if not self._pending:
+                        self._idle.notify_all()
+                    return
+                command, ctx = player.queue.popleft()
+            start = time.perf_counter()
+            failed = False
+            try:
+                command.handler(ctx, *ctx.args)
+            except CommandError as e:
+                failed = True
+                self._error(ctx.event, e)
+            except Exception:
+                failed = True
+                traceback.print_exc()
+            end = time.perf_counter()
+            with self._lock:
+                command.stats.add(start - ctx.posted, end - ctx.posted, failed)
+                self._pending -= 1
+
+    def _error(self, event, error):
+        if self.errors_to_chat and self.mc is not None:
+            try:
+                self.mc.post_to_chat(str(error))
+            except Exception:
+                traceback.print_exc()
+
+    def reply(self, ctx, message):
+        if self.mc is not None:
+            self.mc.post_to_chat(message)
+
+    def join(self, timeout=None) -> bool:
+        """Дождаться выполнения всех принятых команд"""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def close(self):
+        self.join()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "received": self.received,
+                "unmatched": self.unmatched,
+                "bad_arguments": self.bad_arguments,
+                "limited": self.limited,
+                "dropped": self.dropped,
+                "pending": self._pending,
+                "players": len(self._players),
+                "commands": {name: c.stats.as_dict() for name, c in self.commands.items()},
+            }
+
+
+def test_commands():
+    from .emulator import EmulatorServer, World
+    from .event import ChatEvent
+    from .stream import EventStream
+
+    world = World(ground=0, chat_history=100)
+    with EmulatorServer(world=world) as server:
+        mc = server.minecraft()
+        router = CommandRouter(mc, prefix="!", workers=4, rate=None)
+        log = []
+        lock = threading.Lock()
+
+        @router.command("tp", float, float, float)
+        def tp(ctx, x, y, z):
+            log.append(("tp", ctx.player, x, y, z))
+
+        router.add("team", lambda ctx, *args: log.append(("team", args)))
+        router.add("team join", lambda ctx, name: log.append(("join", name)), str)
+        router.add("say", lambda ctx, text="": ctx.reply("echo " + text), rest=True)
+
+        @router.command("seq", int)
+        def seq(ctx, n):
+            time.sleep(0.001)
+            with lock:
+                log.append(("seq", ctx.player, n))
+
+        @router.command("bad")
+        def bad(ctx):
+            raise CommandError("nope")
+
+        # Trie: the longest command on a word boundary wins
+        assert router.match("!team  join  red")[0].name == "team join"
+        assert router.match("!team joiner")[0].name == "team"
+        assert router.match("!team")[0].name == "team" and router.match("!team")[1] == ""
+        assert router.match("!teams") is None and router.match("tp 1 2 3") is None
+        assert router.match("!say  a 'b c'  ") == (router.commands["say"], "a 'b c'")
+
+        # shlex arguments and converters
+        assert router.commands["team join"].parse('"red team" extra') == ("red team", "extra")
+        for text in ("1 2", "a b c", "1 2 'c"):
+            try:
+                router.commands["tp"].parse(text)
+                assert False
+            except CommandError:
+                pass
+
+        for message in ["!tp 1 2 3", "!team join red", "!team x 'y z'", "!teams", "!tp a b c", "!say hi  there",
+                        "!bad", "hello"]:
+            router.dispatch(ChatEvent.post(7, message))
+        # Commands of one player run in order, players in parallel
+        for i in range(30):
+            for player in range(10):
+                router.dispatch(ChatEvent.post(100 + player, "!seq %d" % i))
+        assert router.join(10)
+        assert log[:3] == [("tp", 7, 1.0, 2.0, 3.0), ("join", "red"), ("team", ("x", "y z"))]
+        for player in range(10):
+            assert [n for _, p, n in [e for e in log if e[0] == "seq"] if p == 100 + player] == list(range(30))
+        stats = router.stats()
+        assert (stats["received"], stats["unmatched"], stats["bad_arguments"]) == (308, 2, 1)
+        assert stats["commands"]["seq"]["calls"] == 300 and stats["commands"]["bad"]["errors"] == 1
+        mc.get_player_entity_ids()  # answered after the replies are posted
+        assert "echo hi  there" in world.chat and "nope" in world.chat and "tp: bad argument 'a'" in world.chat
+
+        # Token bucket per player
+        limited = CommandRouter(mc, prefix="!", rate=2, burst=3)
+        limited.add("x", lambda ctx: None)
+        now = time.perf_counter()
+        assert [limited.dispatch(ChatEvent.post(1, "!x"), now) for _ in range(5)] == [True] * 3 + [False] * 2
+        assert limited.dispatch(ChatEvent.post(2, "!x"), now)
+        assert limited.dispatch(ChatEvent.post(1, "!x"), now + 0.5)
+        assert limited.stats()["limited"] == 2
+        limited.close()
+
+        # From an EventStream
+        world.post_chat(5, "!tp 5 6 7")
+        stream = EventStream(mc)
+        router.attach(stream)
+        stream.poll()
+        router.close()
+        assert log[-1] == ("tp", 5, 5.0, 6.0, 7.0)
+
+
+if __name__ == "__main__":
+    test_commands()
@@ -1,7 +1,10 @@
 import socket
 import select
 import sys
-from .util import flatten_parameters_to_bytestring
+import threading
+import time
+from contextlib import contextmanager
+from .util import command_to_bytestring, commands_to_bytestring
 
 """ @author: Aron Nieminen, Mojang AB"""
 
@@ -13,52 +16,370 @@ class RequestError(Exception):
 class Connection:
     """Connection to a Minecraft Pi game"""
     RequestFailed = "Fail"
+    RequestFailedBytes = b"Fail"
+    RecvSize = 65536
 
-    def __init__(self, address, port, debug=False):
+    def __init__(self, address, port, debug=False, buffer_size=0, flush_interval=0.05, metrics=None,
+                 recorder=None):
+        """buffer_size > 0 turns on write coalescing: fire-and-forget commands
+        are collected and written together once buffer_size bytes are pending,
+        flush_interval seconds after the first of them, on flush(), or ahead
+        of the next request that waits for a response.
+        metrics: a metrics.Metrics that counts the traffic of this connection.
+        recorder: a recorder.Recorder that logs everything sent and received"""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(10)
         self.socket.connect((address, port))
-        self.socket.settimeout(60)  # doc suggests None for makefile
+        self.socket.settimeout(60)
         self.lastSent = ""
         self.debug = debug
+        self.metrics = metrics
+        self.recorder = recorder
+        self._stream = recorder.register() if recorder is not None else 0
+        # Long-lived receive buffer: bytes read from the socket but not yet
+        # returned as a line, and the offset up to which it has been scanned
+        # for a newline already.
+        self._buffer = bytearray()
+        self._scanned = 0
+        # Held for a whole request/response exchange, so that threads sharing
+        # the connection don't interleave (or drain) each other's responses.
+        self.lock = threading.RLock()
+        # Write buffer of fire-and-forget commands, see buffer_size
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._wbuffer = bytearray()
+        self._flush_timer = None
+        if buffer_size:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @contextmanager
+    def connection(self):
+        """Holds the connection for a sequence of exchanges and yields it"""
+        with self.lock:
+            yield self
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.socket.close()
+            if self.recorder is not None:
+                self.recorder.flush()
 
     def drain(self):
-        """Drains the socket of incoming data"""
+        """Drains the socket (and the receive buffer) of incoming data"""
+        if self._buffer:
+            self._discard(bytes(self._buffer))
+            del self._buffer[:]
+            self._scanned = 0
         while True:
             readable, _, _ = select.select([self.socket], [], [], 0.0)
             if not readable:
                 break
-            data = self.socket.recv(1500)
-            if self.debug:
-                e = "Drained Data: <%s>\n" % data.strip()
-                e += "Last Message: <%s>\n" % self.lastSent.strip()
-                sys.stderr.write(e)
+            data = self.socket.recv(self.RecvSize)
+            if not data:
+                break
+            self._discard(data)
+
+    def _discard(self, data):
+        if self.metrics is not None:
+            self.metrics.discarded(data)
+        if self.recorder is not None:
+            self.recorder.drained(self._stream, data)
+        if self.debug:
+            e = "Drained Data: <%s>\n" % data.strip()
+            e += "Last Message: <%s>\n" % self.lastSent.strip()
+            sys.stderr.write(e)
 
     def send(self, f, *data):
         """
         Sends data. Note that a trailing newline '\n' is added here
         """
-        s = b"".join([f, b"(", flatten_parameters_to_bytestring(data), b")", b"\n"])
-        self._send(s)
+        s = Connection.command(f, *data)
+        with self.lock:
+            if self.buffer_size:
+                self._buffer_write(s)
+            else:
+                self._send(s)
+        if self.metrics is not None:
+            self.metrics.sent(f, len(s))
+
+    def send_many(self, commands):
+        """Sends fire-and-forget commands [(f, data)], serialized into one buffer"""
+        s = commands_to_bytestring(commands)
+        with self.lock:
+            if self.buffer_size:
+                self._buffer_write(s)
+            else:
+                self._send(s)
+        if self.metrics is not None:
+            self.metrics.sent_many(commands, len(s))
+
+    def _buffer_write(self, s):
+        wbuffer = self._wbuffer
+        if not wbuffer and self.flush_interval:
+            self._flush_timer = threading.Timer(self.flush_interval, self._timed_flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+        wbuffer += s
+        self.lastSent = s
+        if len(wbuffer) >= self.buffer_size:
+            self.flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except OSError as e:
+            if self.debug:
+                sys.stderr.write("Flush failed: <%s>\n" % e)
+
+    def flush(self):
+        """Writes out the buffered fire-and-forget commands"""
+        with self.lock:
+            if self._wbuffer:
+                self._send(b"")
+
+    @staticmethod
+    def command(f, *data):
+        """Serializes a command into one protocol line, including the trailing newline"""
+        return command_to_bytestring(f, data)
 
     def _send(self, s):
         """
         The actual socket interaction from self.send, extracted for easier mocking
         and testing
         """
-        self.drain()
-        self.lastSent = s
+        if s:
+            self.lastSent = s
+        if self._wbuffer:
+            # Commands buffered earlier go first, in the same write
+            s = bytes(self._wbuffer) + s
+            del self._wbuffer[:]
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
 
+        if self.recorder is not None:
+            self.recorder.sent(self._stream, s)
         self.socket.sendall(s)
 
+    def read_line(self):
+        """Reads one raw response line, without checking it for a failure.
+        The trailing newline '\n' is trimmed"""
+        buf = self._buffer
+        end = buf.find(b"\n", self._scanned)
+        while end < 0:
+            self._scanned = len(buf)
+            data = self.socket.recv(self.RecvSize)
+            if not data:
+                raise RequestError("Connection closed while waiting for a response to %s"
+                                   % self.lastSent.strip())
+            buf += data
+            end = buf.find(b"\n", self._scanned)
+        with memoryview(buf) as view:
+            s = view[:end].tobytes()
+        del buf[:end + 1]
+        self._scanned = 0
+        if self.recorder is not None:
+            self.recorder.received(self._stream, s)
+        return s
+
+    def receive_bytes(self):
+        """Receives one line as raw bytes. The trailing newline '\n' is trimmed"""
+        s = self.read_line()
+        if s == Connection.RequestFailedBytes:
+            raise RequestError("%s failed" % self.lastSent.strip())
+        return s
+
     def receive(self):
         """Receives data. Note that the trailing newline '\n' is trimmed"""
-        s = self.socket.makefile("r").readline().rstrip("\n")
-        if s == Connection.RequestFailed:
+        return self.receive_bytes().decode("UTF-8")
+
+    def send_receive_bytes(self, *data):
+        """Sends data and receives the response as raw bytes"""
+        s = Connection.command(*data)
+        if self.metrics is not None:
+            return self._timed_send_receive(data[0], s)
+        with self.lock:
+            self.drain()
+            self._send(s)
+            return self.receive_bytes()
+
+    def _timed_send_receive(self, f, s):
+        response = None
+        with self.lock:
+            self.drain()
+            start = time.perf_counter()
+            try:
+                self._send(s)
+                response = self.read_line()
+            finally:
+                latency = time.perf_counter() - start
+                failed = response is None or response == Connection.RequestFailedBytes
+                self.metrics.request(f, latency, len(s), 0 if response is None else len(response) + 1, failed)
+        if response == Connection.RequestFailedBytes:
             raise RequestError("%s failed" % self.lastSent.strip())
-        return s
+        return response
 
     def send_receive(self, *data):
         """Sends and receive data"""
-        self.send(*data)
-        return self.receive()
+        return self.send_receive_bytes(*data).decode("UTF-8")
+
+
+class ConnectionPool:
+    """Pool of connections to one Minecraft Pi game, shared between threads.
+
+    Has the same send/send_receive methods as Connection, so it can be passed
+    to Minecraft. Every call checks out a connection for the whole exchange;
+    a thread gets back the connection it used last whenever it is idle. Calls
+    made inside "with pool.connection():" all go through the same connection,
+    which keeps fire-and-forget commands ordered before the reads that follow
+    them."""
+
+    def __init__(self, address, port, size=4, debug=False, buffer_size=0, flush_interval=0.05, metrics=None,
+                 recorder=None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.address = address
+        self.port = port
+        self.size = size
+        self.debug = debug
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.recorder = recorder
+        self._idle = []
+        self._all = []
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._closed = False
+
+    def _acquire(self):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ConnectionPool is closed")
+            preferred = getattr(self._local, "last", None)
+            if preferred is not None and preferred in self._idle:
+                self._idle.remove(preferred)
+                conn = preferred
+            elif self._idle:
+                conn = self._idle.pop()
+            elif len(self._all) < self.size:
+                conn = None
+                self._all.append(None)  # reserve the slot while connecting
+            else:
+                self._waits += 1
+                start = time.perf_counter()
+                while not self._idle and len(self._all) >= self.size and not self._closed:
+                    self._cond.wait()
+                self._wait_time += time.perf_counter() - start
+                if self._closed:
+                    raise RuntimeError("ConnectionPool is closed")
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    conn = None
+                    self._all.append(None)
+            self._checkouts += 1
+        if conn is None:
+            try:
+                conn = Connection(self.address, self.port, self.debug, self.buffer_size, self.flush_interval,
+                                  self.metrics, self.recorder)
+            except BaseException:
+                with self._cond:
+                    self._all.remove(None)
+                    self._cond.notify()
+                raise
+            with self._cond:
+                closed = self._closed
+                if not closed:
+                    self._all[self._all.index(None)] = conn
+            if closed:
+                conn.close()
+                raise RuntimeError("ConnectionPool is closed")
+        self._local.last = conn
+        return conn
+
+    def _release(self, conn):
+        with self._cond:
+            if self._closed:
+                return  # checked out while the pool was closed; close() already closed it
+            if conn.socket.fileno() == -1:
+                # Closed while checked out (a broken exchange): free its slot
+                self._all.remove(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the calling thread and yields it.
+        Nested uses in the same thread yield the same connection"""
+        conn = getattr(self._local, "held", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.held = conn
+        try:
+            yield conn
+        finally:
+            self._local.held = None
+            self._release(conn)
+
+    def send(self, f, *data):
+        with self.connection() as conn:
+            conn.send(f, *data)
+
+    def send_many(self, commands):
+        with self.connection() as conn:
+            conn.send_many(commands)
+
+    def send_receive_bytes(self, *data):
+        with self.connection() as conn:
+            return conn.send_receive_bytes(*data)
+
+    def send_receive(self, *data):
+        with self.connection() as conn:
+            return conn.send_receive(*data)
+
+    def flush(self):
+        with self._cond:
+            conns = [c for c in self._all if c is not None]
+        for conn in conns:
+            conn.flush()
+
+    def stats(self) -> dict:
+        """Pool statistics: open/idle/in-use connections, checkouts, waits"""
+        with self._cond:
+            opened = len([c for c in self._all if c is not None])
+            return {
+                "size": self.size,
+                "open": opened,
+                "idle": len(self._idle),
+                "in_use": opened - len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time": self._wait_time,
+            }
+
+    def close(self):
+        """Closes all connections, including the ones in use; later checkouts raise"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            conns = [c for c in self._all if c is not None]
+            self._all = [c for c in self._all if c is None]
+            self._idle = []
+        error = None
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception as e:
+                # Close the others anyway, then report the first failure
+                error = error or e
+        if error is not None:
+            raise error
@@ -0,0 +1,791 @@
+import argparse
+import asyncio
+import math
+import socket
+import threading
+import time
+import weakref
+from array import array
+from collections import deque
+
+from .connection import Connection, ConnectionPool
+from .minecraft import Minecraft
+from .vec3 import Vec3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" In-process emulator of a RaspberryJuice / JuicyRaspberryPie server.
+
+    Implements the server side of every command sent by minecraft.py, so
+    scripts can be tested without a game:
+
+    server = EmulatorServer().start()
+    mc = server.minecraft()
+    mc.set_blocks(0, 0, 0, 9, 9, 9, "stone")
+
+    The world is stored in 16x16x16 chunks of uint16 palette indices (numpy
+    arrays, or array('H') without numpy) that are created on first write;
+    block data values live in uint8 chunks of their own, created on the
+    first non-zero data value.
+    Each client connection is a Session with its own event queues and
+    current player; all sessions share one World behind one lock. Serve it
+    with threads (EmulatorServer) or with asyncio (serve_async)."""
+
+CHUNK_SHIFT = 4
+CHUNK = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK - 1
+CHUNK_VOLUME = CHUNK * CHUNK * CHUNK
+
+AIR = b"air"
+NEARBY_DISTANCE = 10.0
+
+
+def _int(s):
+    try:
+        return int(s)
+    except ValueError:
+        return int(math.floor(float(s)))
+
+
+def _ranges(lo, hi):
+    """Splits lo..hi (inclusive) at chunk borders => [(chunk, start, stop)] (local, stop exclusive)"""
+    out = []
+    c = lo >> CHUNK_SHIFT
+    while lo <= hi:
+        stop = min(hi, (c << CHUNK_SHIFT) + CHUNK_MASK)
+        out.append((c, lo & CHUNK_MASK, (stop & CHUNK_MASK) + 1))
+        lo = stop + 1
+        c += 1
+    return out
+
+
+class _Entity:
+    __slots__ = ("id", "type", "name", "x", "y", "z", "yaw", "pitch")
+
+    def __init__(self, entity_id, type_name, x, y, z, name=None):
+        self.id = entity_id
+        self.type = type_name
+        self.name = name
+        self.x = x
+        self.y = y
+        self.z = z
+        self.yaw = 0.0
+        self.pitch = 0.0
+
+    def direction(self):
+        yaw, pitch = math.radians(self.yaw), math.radians(self.pitch)
+        return -math.sin(yaw) * math.cos(pitch), -math.sin(pitch), math.cos(yaw) * math.cos(pitch)
+
+    def set_direction(self, x, y, z):
+        horizontal = math.hypot(x, z)
+        if horizontal or y:
+            self.yaw = math.degrees(math.atan2(-x, z)) % 360.0
+            self.pitch = math.degrees(math.atan2(-y, horizontal))
+
+    def copy(self):
+        e = _Entity(self.id, self.type, self.x, self.y, self.z, self.name)
+        e.yaw, e.pitch = self.yaw, self.pitch
+        return e
+
+
+class World:
+    """Мир эмулятора.
+
+    ground: если указан, все блоки ниже y=ground состоят из ground_block
+    (плоский мир), иначе мир пуст (air). chat_history: сколько последних
+    сообщений chat.post хранится в chat."""
+
+    def __init__(self, ground=None, ground_block="stone", chat_history=1000):
+        self.lock = threading.RLock()
+        self.names = [AIR]
+        self.palette = {AIR: 0}
+        self.ground = ground
+        self.ground_index = self.index(ground_block.encode("UTF-8")) if ground is not None else 0
+        self.chunks = {}    # (cx, cy, cz) -> chunk
+        self.data = {}      # (cx, cy, cz) -> chunk of data values, only where one is not 0
+        self.columns = {}   # (cx, cz) -> {cy}
+        self.entities = {}  # id -> _Entity
+        self.players = {}   # name -> id
+        self.chat = deque(maxlen=chat_history)  # last messages posted with chat.post
+        self.sessions = weakref.WeakSet()
+        self._templates = {}
+        self._names_array = None
+        self._next_id = 1
+        self._checkpoint = None
+        self.add_player("Steve")
+
+    # -- blocks --
+
+    def index(self, name) -> int:
+        """Номер блока name (bytes) в палитре"""
+        i = self.palette.get(name)
+        if i is None:
+            if len(self.names) > 0xFFFF:
+                raise ValueError("More than 65536 different blocks")
+            i = self.palette[name] = len(self.names)
+            self.names.append(name)
+            self._names_array = None
+        return i
+
+    def _template(self, cy):
+        """Chunk that has never been written"""
+        template = self._templates.get(cy)
+        if template is None:
+            below = 0 if self.ground is None else min(max(self.ground - (cy << CHUNK_SHIFT), 0), CHUNK)
+            if numpy is not None:
+                template = numpy.zeros((CHUNK, CHUNK, CHUNK), dtype=numpy.uint16)
+                template[:below] = self.ground_index
+                template.flags.writeable = False
+            else:
+                n = below * CHUNK * CHUNK
+                template = array("H", [self.ground_index]) * n + array("H", [0]) * (CHUNK_VOLUME - n)
+            self._templates[cy] = template
+        return template
+
+    def _chunk(self, key, create=False):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            if not create:
+                return self._template(key[1])
+            chunk = self.chunks[key] = self._template(key[1])[:] if numpy is None else self._template(key[1]).copy()
+            self.columns.setdefault((key[0], key[2]), set()).add(key[1])
+        return chunk
+
+    def get_block(self, x, y, z) -> bytes:
+        chunk = self._chunk((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT, z >> CHUNK_SHIFT))
+        if numpy is not None:
+            return self.names[chunk[y & CHUNK_MASK, x & CHUNK_MASK, z & CHUNK_MASK]]
+        return self.names[chunk[((y & CHUNK_MASK) * CHUNK + (x & CHUNK_MASK)) * CHUNK + (z & CHUNK_MASK)]]
+
+    def _data_chunk(self, key, create):
+        chunk = self.data.get(key)
+        if chunk is None and create:
+            if numpy is not None:
+                chunk = numpy.zeros((CHUNK, CHUNK, CHUNK), dtype=numpy.uint8)
+            else:
+                chunk = array("B", bytes(CHUNK_VOLUME))
+            self.data[key] = chunk
+        return chunk
+
+    def get_data(self, x, y, z) -> int:
+        """Данные (data) блока"""
+        chunk = self.data.get((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT, z >> CHUNK_SHIFT))
+        if chunk is None:
+            return 0
+        if numpy is not None:
+            return int(chunk[y & CHUNK_MASK, x & CHUNK_MASK, z & CHUNK_MASK])
+        return chunk[((y & CHUNK_MASK) * CHUNK + (x & CHUNK_MASK)) * CHUNK + (z & CHUNK_MASK)]
+
+    def set_block(self, x, y, z, name, data=0):
+        self.set_blocks(x, y, z, x, y, z, name, data)
+
+    def set_blocks(self, x0, y0, z0, x1, y1, z1, name, data=0):
+        i = self.index(name)
+        data &= 0xFF
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        z0, z1 = min(z0, z1), max(z0, z1)
+        xs, zs = _ranges(x0, x1), _ranges(z0, z1)
+        for cy, ya, yb in _ranges(y0, y1):
+            for cx, xa, xb in xs:
+                for cz, za, zb in zs:
+                    key = (cx, cy, cz)
+                    chunk = self._chunk(key, True)
+                    # Data chunks only exist where some data value is not 0
+                    data_chunk = self._data_chunk(key, data != 0)
+                    if numpy is not None:
+                        chunk[ya:yb, xa:xb, za:zb] = i
+                        if data_chunk is not None:
+                            data_chunk[ya:yb, xa:xb, za:zb] = data
+                        continue
+                    run = array("H", [i]) * (zb - za)
+                    data_run = array("B", [data]) * (zb - za)
+                    for y in range(ya, yb):
+                        for x in range(xa, xb):
+                            start = (y * CHUNK + x) * CHUNK
+                            chunk[start + za:start + zb] = run
+                            if data_chunk is not None:
+                                data_chunk[start + za:start + zb] = data_run
+
+    def get_blocks(self, x0, y0, z0, x1, y1, z1) -> bytes:
+        """Блоки кубоида через запятую в порядке y, x, z (как world.getBlocks)"""
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        z0, z1 = min(z0, z1), max(z0, z1)
+        xs, zs = _ranges(x0, x1), _ranges(z0, z1)
+        if numpy is None:
+            names = self.names
+            out = []
+            for cy, ya, yb in _ranges(y0, y1):
+                for y in range(ya, yb):
+                    for cx, xa, xb in xs:
+                        for x in range(xa, xb):
+                            for cz, za, zb in zs:
+                                chunk = self._chunk((cx, cy, cz))
+                                start = (y * CHUNK + x) * CHUNK
+                                out.extend(names[i] for i in chunk[start + za:start + zb])
+            return b",".join(out)
+
+        out = numpy.empty((y1 - y0 + 1, x1 - x0 + 1, z1 - z0 + 1), dtype=numpy.uint16)
+        for cy, ya, yb in _ranges(y0, y1):
+            oy = (cy << CHUNK_SHIFT) + ya - y0
+            for cx, xa, xb in xs:
+                ox = (cx << CHUNK_SHIFT) + xa - x0
+                for cz, za, zb in zs:
+                    oz = (cz << CHUNK_SHIFT) + za - z0
+                    out[oy:oy + yb - ya, ox:ox + xb - xa, oz:oz + zb - za] = \
+                        self._chunk((cx, cy, cz))[ya:yb, xa:xb, za:zb]
+        if self._names_array is None:
+            self._names_array = numpy.array(self.names, dtype=object)
+        return b",".join(self._names_array[out.ravel()].tolist())
+
+    def get_height(self, x, z) -> int:
+        """Высота самого высокого блока, отличного от air"""
+        cx, cz, lx, lz = x >> CHUNK_SHIFT, z >> CHUNK_SHIFT, x & CHUNK_MASK, z & CHUNK_MASK
+        levels = set(self.columns.get((cx, cz), ()))
+        if self.ground is not None:
+            levels.add((self.ground - 1) >> CHUNK_SHIFT)
+        if not levels:
+            return 0
+        for cy in range(max(levels), min(levels) - 1, -1):
+            chunk = self._chunk((cx, cy, cz))
+            if numpy is not None:
+                filled = numpy.flatnonzero(chunk[:, lx, lz])
+                if len(filled):
+                    return (cy << CHUNK_SHIFT) + int(filled[-1])
+            else:
+                for y in range(CHUNK_MASK, -1, -1):
+                    if chunk[(y * CHUNK + lx) * CHUNK + lz]:
+                        return (cy << CHUNK_SHIFT) + y
+        return self.ground - 1 if self.ground is not None else 0
+
+    # -- entities --
+
+    def _new_id(self):
+        entity_id = self._next_id
+        self._next_id += 1
+        return entity_id
+
+    def add_player(self, name, x=0.5, y=None, z=0.5) -> int:
+        """Добавить игрока => id"""
+        with self.lock:
+            if y is None:
+                y = float(self.ground if self.ground is not None else 0)
+            entity_id = self._new_id()
+            self.entities[entity_id] = _Entity(entity_id, "player", x, y, z, name)
+            self.players[name] = entity_id
+            return entity_id
+
+    def spawn_entity(self, type_name, x, y, z) -> int:
+        with self.lock:
+            entity_id = self._new_id()
+            self.entities[entity_id] = _Entity(entity_id, type_name, x, y, z)
+            return entity_id
+
+    def remove_entity(self, entity_id) -> int:
+        with self.lock:
+            e = self.entities.get(entity_id)
+            if e is None or e.type == "player":
+                return 0
+            del self.entities[entity_id]
+            return 1
+
+    def nearby_entities(self, x, y, z, distance=NEARBY_DISTANCE):
+        d2 = distance * distance
+        return [e for e in self.entities.values()
+                if e.type != "player" and (e.x - x) ** 2 + (e.y - y) ** 2 + (e.z - z) ** 2 <= d2]
+
+    # -- events --
+
+    def hit_block(self, x, y, z, face=1, entity_id=1):
+        """Удар мечом по блоку: событие получат все подключенные клиенты"""
+        line = b"%d,%d,%d,%d,%d" % (x, y, z, face, entity_id)
+        for session in list(self.sessions):
+            session.block_hits.append(line)
+
+    def post_chat(self, entity_id, message):
+        """Сообщение игрока в чате: событие получат все подключенные клиенты"""
+        line = b"%d,%s" % (entity_id, message.encode("UTF-8"))
+        for session in list(self.sessions):
+            session.chat_posts.append(line)
+
+    def hit_projectile(self, x, y, z, shooter="Steve", victim="", face=1):
+        """Попадание снаряда: событие получат все подключенные клиенты"""
+        line = b"%d,%d,%d,%d,%s,%s" % (x, y, z, face, shooter.encode("UTF-8"), victim.encode("UTF-8"))
+        for session in list(self.sessions):
+            session.projectile_hits.append(line)
+
+    # -- checkpoints --
+
+    def save_checkpoint(self):
+        with self.lock:
+            self._checkpoint = ({key: chunk[:] if numpy is None else chunk.copy()
+                                 for key, chunk in self.chunks.items()},
+                                {key: chunk[:] if numpy is None else chunk.copy()
+                                 for key, chunk in self.data.items()},
+                                {key: set(levels) for key, levels in self.columns.items()},
+                                {key: e.copy() for key, e in self.entities.items()})
+
+    def restore_checkpoint(self):
+        with self.lock:
+            if self._checkpoint is None:
+                return
+            chunks, data, columns, entities = self._checkpoint
+            self.chunks = {key: chunk[:] if numpy is None else chunk.copy() for key, chunk in chunks.items()}
+            self.data = {key: chunk[:] if numpy is None else chunk.copy() for key, chunk in data.items()}
+            self.columns = {key: set(levels) for key, levels in columns.items()}
+            self.entities = {key: e.copy() for key, e in entities.items()}
+            self.players = {e.name: e.id for e in self.entities.values() if e.type == "player"}
+
+
+class Session:
+    """Состояние одного подключения: очереди событий и текущий игрок"""
+
+    def __init__(self, world):
+        self.world = world
+        self.block_hits = deque()
+        self.chat_posts = deque()
+        self.projectile_hits = deque()
+        self.player = world.players.get("Steve", 1)
+        self.commands = 0
+        self._handlers = {
+            b"world.getBlock": self.get_block,
+            b"world.getBlockWithData": self.get_block_with_data,
+            b"world.setBlock": self.set_block,
+            b"world.setBlocks": self.set_blocks,
+            b"world.getBlocks": self.get_blocks,
+            b"world.getHeight": self.get_height,
+            b"world.setSign": self.set_block,
+            b"world.spawnEntity": self.spawn_entity,
+            b"world.spawnParticle": self.ignore,
+            b"world.getNearbyEntities": self.get_nearby_entities,
+            b"world.removeEntity": self.remove_entity,
+            b"world.getPlayerIds": self.get_player_ids,
+            b"world.getPlayerId": self.get_player_id,
+            b"world.checkpoint.save": self.save_checkpoint,
+            b"world.checkpoint.restore": self.restore_checkpoint,
+            b"world.setting": self.ignore,
+            b"chat.post": self.post_to_chat,
+            b"events.clear": self.clear_events,
+            b"events.block.hits": self.poll_block_hits,
+            b"events.chat.posts": self.poll_chat_posts,
+            b"events.projectile.hits": self.poll_projectile_hits,
+            b"setPlayer": self.set_player,
+            b"entity.getName": self.get_name,
+            b"entity.remove": self.remove,
+            b"camera.mode.setNormal": self.ignore,
+            b"camera.mode.setFixed": self.ignore,
+            b"camera.mode.setFollow": self.ignore,
+            b"camera.setPos": self.ignore,
+        }
+        for name, handler in ((b".getPos", self.get_pos), (b".setPos", self.set_pos),
+                              (b".getTile", self.get_tile), (b".setTile", self.set_pos),
+                              (b".getDirection", self.get_direction), (b".setDirection", self.set_direction),
+                              (b".getRotation", self.get_rotation), (b".setRotation", self.set_rotation),
+                              (b".getPitch", self.get_pitch), (b".setPitch", self.set_pitch),
+                              (b".setting", self.ignore)):
+            self._handlers[b"entity" + name] = handler
+            self._handlers[b"player" + name] = self._as_player(handler)
+        world.sessions.add(self)
+
+    def _as_player(self, handler):
+        """player.* commands are entity.* commands without the id: the current player's is used"""
+        return lambda args: handler([self.player] + args)
+
+    def handle(self, data) -> bytes:
+        """Выполнить команды (полные строки data) => ответы, одной строкой байтов"""
+        out = []
+        handlers = self._handlers
+        world = self.world
+        with world.lock:
+            for line in data.split(b"\n"):
+                if not line:
+                    continue
+                self.commands += 1
+                start = line.find(b"(")
+                handler = handlers.get(line[:start]) if start > 0 else None
+                if handler is None:
+                    out.append(b"Fail")
+                    continue
+                args = line[start + 1:line.rfind(b")")]
+                try:
+                    response = handler(args.split(b",") if args else [])
+                except Exception:
+                    response = b"Fail"
+                if response is not None:
+                    out.append(response)
+        if not out:
+            return b""
+        out.append(b"")
+        return b"\n".join(out)
+
+    def close(self):
+        self.world.sessions.discard(self)
+
+    # -- world --
+
+    def ignore(self, args):
+        return None
+
+    def get_block(self, args):
+        return self.world.get_block(_int(args[0]), _int(args[1]), _int(args[2]))
+
+    def get_block_with_data(self, args):
+        x, y, z = _int(args[0]), _int(args[1]), _int(args[2])
+        return b"%s,%d" % (self.world.get_block(x, y, z), self.world.get_data(x, y, z))
+
+    def set_block(self, args):
+        data = _int(args[4]) if len(args) > 4 else 0
+        self.world.set_block(_int(args[0]), _int(args[1]), _int(args[2]), args[3], data)
+
+    def set_blocks(self, args):
+        data = _int(args[7]) if len(args) > 7 else 0
+        self.world.set_blocks(*map(_int, args[:6]), args[6], data)
+
+    def get_blocks(self, args):
+        return self.world.get_blocks(*map(_int, args[:6]))
+
+    def get_height(self, args):
+        return b"%d" % self.world.get_height(_int(args[0]), _int(args[1]))
+
+    def spawn_entity(self, args):
+        return b"%d" % self.world.spawn_entity(args[3].decode("UTF-8"), *map(float, args[:3]))
+
+    def get_nearby_entities(self, args):
+        x, y, z = map(float, args[:3])
+        distance = float(args[3]) if len(args) > 3 else NEARBY_DISTANCE
+        return b",".join(b"%s:%d" % (e.type.encode("UTF-8"), e.id)
+                         for e in self.world.nearby_entities(x, y, z, distance))
+
+    def remove_entity(self, args):
+        return b"%d" % self.world.remove_entity(_int(args[0]))
+
+    def get_player_ids(self, args):
+        return b"|".join(b"%d" % i for i in self.world.players.values())
+
+    def get_player_id(self, args):
+        entity_id = self.world.players.get(b",".join(args).decode("UTF-8"))
+        return b"Fail" if entity_id is None else b"%d" % entity_id
+
+    def save_checkpoint(self, args):
+        self.world.save_checkpoint()
+
+    def restore_checkpoint(self, args):
+        self.world.restore_checkpoint()
+
+    def post_to_chat(self, args):
+        self.world.chat.append(b",".join(args).decode("UTF-8"))
+
+    def set_player(self, args):
+        entity_id = self.world.players.get(b",".join(args).decode("UTF-8"))
+        if entity_id is None:
+            return b"False"
+        self.player = entity_id
+        return b"True"
+
+    # -- entities --
+
+    def _entity(self, args):
+        return self.world.entities[_int(args[0])]
+
+    def get_name(self, args):
+        e = self._entity(args)
+        return (e.name or e.type).encode("UTF-8")
+
+    def remove(self, args):
+        self.world.remove_entity(_int(args[0]))
+
+    def get_pos(self, args):
+        e = self._entity(args)
+        return b"%r,%r,%r" % (float(e.x), float(e.y), float(e.z))
+
+    def set_pos(self, args):
+        e = self._entity(args)
+        e.x, e.y, e.z = map(float, args[1:4])
+
+    def get_tile(self, args):
+        e = self._entity(args)
+        return b"%d,%d,%d" % (math.floor(e.x), math.floor(e.y), math.floor(e.z))
+
+    def get_direction(self, args):
+        return b"%r,%r,%r" % self._entity(args).direction()
+
+    def set_direction(self, args):
+        self._entity(args).set_direction(*map(float, args[1:4]))
+
+    def get_rotation(self, args):
+        return b"%r" % self._entity(args).yaw
+
+    def set_rotation(self, args):
+        self._entity(args).yaw = float(args[1])
+
+    def get_pitch(self, args):
+        return b"%r" % self._entity(args).pitch
+
+    def set_pitch(self, args):
+        self._entity(args).pitch = float(args[1])
+
+    # -- events --
+
+    def clear_events(self, args):
+        self.block_hits.clear()
+        self.chat_posts.clear()
+        self.projectile_hits.clear()
+
+    @staticmethod
+    def _drain(events):
+        out = []
+        while events:
+            out.append(events.popleft())
+        return b"|".join(out)
+
+    def poll_block_hits(self, args):
+        return self._drain(self.block_hits)
+
+    def poll_chat_posts(self, args):
+        return self._drain(self.chat_posts)
+
+    def poll_projectile_hits(self, args):
+        return self._drain(self.projectile_hits)
+
+
+def _split_lines(buf):
+    """=> (complete lines, rest)"""
+    end = buf.rfind(b"\n")
+    if end < 0:
+        return b"", buf
+    return buf[:end], buf[end + 1:]
+
+
+class _DelayedWriter:
+    """Sends every response `latency` seconds after its request arrived, like
+    a network round-trip: pipelined requests overlap their delays"""
+
+    def __init__(self, sock, latency):
+        self.sock = sock
+        self.latency = latency
+        self.pending = deque()  # (due, data), in order of arrival
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="EmulatorWriter", daemon=True)
+        self.thread.start()
+
+    def send(self, data):
+        with self.cond:
+            self.pending.append((time.perf_counter() + self.latency, data))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.pending and not self.closed:
+                        self.cond.wait()
+                    if not self.pending:
+                        return
+                    due, data = self.pending[0]
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        self.cond.wait(delay)
+                        continue
+                    self.pending.popleft()
+                self.sock.sendall(data)
+        except OSError:
+            pass
+
+
+class EmulatorServer:
+    """TCP-сервер эмулятора, по потоку на подключение.
+
+    port=0 выбирает свободный порт, адрес доступен в address. latency:
+    задержка каждого ответа в секундах (имитация сети)."""
+
+    RecvSize = 1 << 16
+
+    def __init__(self, host="127.0.0.1", port=0, world=None, latency=0.0):
+        self.world = world if world is not None else World()
+        self.latency = latency
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+        self.address = self.listener.getsockname()[:2]
+        self._clients = set()
+        self._closed = False
+
+    def start(self):
+        threading.Thread(target=self._accept, name="EmulatorServer", daemon=True).start()
+        return self
+
+    def minecraft(self, pool_size=None, **kwargs) -> Minecraft:
+        """Minecraft, подключенный к этому серверу (JRP_API_HOST и JRP_API_PORT
+        не учитываются). pool_size: ConnectionPool на pool_size соединений;
+        остальные аргументы передаются Connection"""
+        if pool_size:
+            return Minecraft(ConnectionPool(*self.address, pool_size, **kwargs))
+        return Minecraft(Connection(*self.address, **kwargs))
+
+    def close(self):
+        self._closed = True
+        self.listener.close()
+        for client in list(self._clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._clients.add(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        session = Session(self.world)
+        writer = _DelayedWriter(client, self.latency) if self.latency else None
+        rest = b""
+        try:
+            while True:
+                data = client.recv(self.RecvSize)
+                if not data:
+                    break
+                lines, rest = _split_lines(rest + data)
+                if lines:
+                    response = session.handle(lines)
+                    if not response:
+                        continue
+                    if writer is not None:
+                        writer.send(response)
+                    else:
+                        client.sendall(response)
+        except OSError:
+            pass
+        finally:
+            if writer is not None:
+                writer.close()
+            session.close()
+            self._clients.discard(client)
+            client.close()
+
+
+async def serve_async(host="127.0.0.1", port=0, world=None):
+    """Запустить эмулятор на asyncio => asyncio.Server (его атрибут world - мир)"""
+    world = world if world is not None else World()
+
+    async def serve(reader, writer):
+        session = Session(world)
+        rest = b""
+        try:
+            while True:
+                data = await reader.read(EmulatorServer.RecvSize)
+                if not data:
+                    break
+                lines, rest = _split_lines(rest + data)
+                if lines:
+                    response = session.handle(lines)
+                    if response:
+                        writer.write(response)
+                        await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            session.close()
+            writer.close()
+
+    server = await asyncio.start_server(serve, host, port)
+    server.world = world
+    return server
+
+
+def test_emulator():
+    world = World(ground=4, chat_history=3)
+    with EmulatorServer(world=world) as server:
+        mc = server.minecraft()
+
+        # Blocks and data values
+        assert mc.get_block(0, 3, 0) == "stone" and mc.get_block(0, 4, 0) == "air"
+        mc.set_block(1, 10, 1, "wool", 5)
+        assert mc.get_block(1, 10, 1) == "wool"
+        assert mc.get_block_with_data(1, 10, 1) == ["wool", "5"]
+        mc.set_block(1, 10, 1, "wool")
+        assert mc.get_block_with_data(1, 10, 1) == ["wool", "0"]
+        mc.set_blocks(-20, 5, -20, 20, 6, 20, "planks", 2)
+        assert mc.get_block_with_data(-17, 6, 19) == ["planks", "2"]
+        assert mc.get_blocks(0, 5, 0, 1, 5, 0) == ["planks", "planks"]
+        assert mc.get_block_with_data(30, 5, 30) == ["air", "0"]
+
+        # Heights
+        assert mc.get_height(100, 100) == 3
+        assert mc.get_height(0, 0) == 6
+        mc.set_block(0, 40, 0, "glass")
+        assert mc.get_height(0, 0) == 40
+
+        # Checkpoints
+        mc.save_checkpoint()
+        mc.set_block(0, 40, 0, "air", 0)
+        mc.set_block(2, 5, 2, "stone", 1)
+        mc.restore_checkpoint()
+        assert mc.get_block(0, 40, 0) == "glass" and mc.get_block_with_data(2, 5, 2) == ["planks", "2"]
+
+        # Entities
+        pig = mc.spawn_entity(1, 5, 1, "pig")
+        pig.set_pos(3, 7, 3)
+        assert pig.get_pos() == Vec3(3, 7, 3)
+        assert [e.id for e in mc.get_nearby_entities(3, 7, 3)] == [pig.id]
+        pig.remove()
+        assert mc.get_nearby_entities(3, 7, 3) == []
+
+        # Events
+        world.hit_block(1, 2, 3, 4, 1)
+        world.post_chat(1, "hi, all")
+        world.hit_projectile(4, 5, 6, "Steve", "Alex")
+        hits = mc.events.poll_block_hits()
+        assert [(e.x, e.y, e.z, e.face) for e in hits] == [(1, 2, 3, "4")]
+        assert [(e.entityId, e.message) for e in mc.events.poll_chat_posts()] == [(1, "hi, all")]
+        assert [e.victimName for e in mc.events.poll_projectile_hits()] == ["Alex"]
+        assert mc.events.poll_block_hits() == []
+
+        # Chat keeps the last chat_history messages
+        for i in range(5):
+            mc.post_to_chat("m%d" % i)
+        mc.get_player_entity_ids()
+        assert list(world.chat) == ["m2", "m3", "m4"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Minecraft Pi / RaspberryJuice server emulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4711)
+    parser.add_argument("--ground", type=int, default=None, help="fill everything below this y with stone")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every response, seconds")
+    args = parser.parse_args(argv)
+    server = EmulatorServer(args.host, args.port, World(args.ground), args.latency)
+    print("Listening on %s:%d" % server.address)
+    server.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,28 @@
+from array import array
+
 from .vec3 import Vec3
 
 
 class BlockEvent:
     """An Event related to blocks (e.g. placed, removed, hit)"""
     HIT = 0
+    __slots__ = ("type", "x", "y", "z", "face", "entityId", "_pos")
 
     def __init__(self, type_of_event, x, y, z, face, entity_id):
         self.type = type_of_event
-        self.pos = Vec3(int(x), int(y), int(z))
+        self.x = int(x)
+        self.y = int(y)
+        self.z = int(z)
         self.face = face
         self.entityId = entity_id
+        self._pos = None
+
+    @property
+    def pos(self):
+        """Vec3 of the block, created on first use"""
+        if self._pos is None:
+            self._pos = Vec3(self.x, self.y, self.z)
+        return self._pos
 
     def __repr__(self):
         s_type = {
@@ -17,7 +30,7 @@ class BlockEvent:
         }.get(self.type, "???")
 
         return "BlockEvent(%s, %d, %d, %d, %s, %s)" % (
-            s_type, self.pos.x, self.pos.y, self.pos.z, self.face, self.entityId)
+            s_type, self.x, self.y, self.z, self.face, self.entityId)
 
     @staticmethod
     def hit(x, y, z, face, entity_id):
@@ -27,6 +40,7 @@ class BlockEvent:
 class ChatEvent:
     """An Event related to chat (e.g. posts)"""
     POST = 0
+    __slots__ = ("type", "entityId", "message")
 
     def __init__(self, type_of_event, entity_id, message):
         self.type = type_of_event
@@ -49,13 +63,24 @@ class ChatEvent:
 class ProjectileEvent:
     """An Event related to projectiles (e.g. placed, removed, hit)"""
     HIT = 0
+    __slots__ = ("type", "x", "y", "z", "face", "shooterName", "victimName", "_pos")
 
     def __init__(self, type_of_event, x, y, z, face, shooter_name, victim_name):
         self.type = type_of_event
-        self.pos = Vec3(int(x), int(y), int(z))
+        self.x = int(x)
+        self.y = int(y)
+        self.z = int(z)
         self.face = face
         self.shooterName = shooter_name
         self.victimName = victim_name
+        self._pos = None
+
+    @property
+    def pos(self):
+        """Vec3 of the block that was hit, created on first use"""
+        if self._pos is None:
+            self._pos = Vec3(self.x, self.y, self.z)
+        return self._pos
 
     def __repr__(self):
         s_type = {
@@ -63,8 +88,144 @@ class ProjectileEvent:
         }.get(self.type, "???")
 
         return "ProjectileEvent(%s, %d, %d, %d, %s, %s)" % (
-            s_type, self.pos.x, self.pos.y, self.pos.z, self.shooterName, self.victimName)
+            s_type, self.x, self.y, self.z, self.shooterName, self.victimName)
 
     @staticmethod
     def hit(x, y, z, face, shooter_name, victim_name):
         return ProjectileEvent(BlockEvent.HIT, x, y, z, face, shooter_name, victim_name)
+
+
+""" Parsers of raw (bytes) event responses. Events are separated by '|' and
+    their fields by ','; events without free text are parsed with a single
+    split of the whole response."""
+
+
+def _records(s):
+    """Drops empty events (a trailing or doubled '|')"""
+    if b"||" in s:
+        s = b"|".join([e for e in s.split(b"|") if e])
+    return s.strip(b"|")
+
+
+def _fields(s, width):
+    s = _records(s)
+    if not s:
+        return []
+    fields = s.replace(b"|", b",").split(b",")
+    if len(fields) % width:
+        raise ValueError("Malformed event list: %r" % s)
+    it = iter(fields)
+    return zip(*[it] * width)
+
+
+def parse_block_hits(s) -> list:
+    """b"x,y,z,face,entityId|..." => [BlockEvent]"""
+    hit = BlockEvent.HIT
+    return [BlockEvent(hit, x, y, z, face.decode(), entity_id.decode())
+            for x, y, z, face, entity_id in _fields(s, 5)]
+
+
+def parse_chat_posts(s) -> list:
+    """b"entityId,message|..." => [ChatEvent]"""
+    post = ChatEvent.POST
+    events = []
+    for e in s.split(b"|"):
+        if e:
+            entity_id, message = e.split(b",", 1)
+            events.append(ChatEvent(post, int(entity_id), message.decode("UTF-8")))
+    return events
+
+
+def parse_projectile_hits(s) -> list:
+    """b"x,y,z,face,shooter,victim|..." => [ProjectileEvent]"""
+    hit = ProjectileEvent.HIT
+    return [ProjectileEvent(hit, x, y, z, face.decode(), shooter.decode("UTF-8"), victim.decode("UTF-8"))
+            for x, y, z, face, shooter, victim in _fields(s, 6)]
+
+
+class BlockHitColumns:
+    """Удары по блокам в виде столбцов: x, y, z, face - array('i'), entity - [str]"""
+    __slots__ = ("x", "y", "z", "face", "entity")
+
+    def __init__(self, x, y, z, face, entity):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.face = face
+        self.entity = entity
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return "BlockHitColumns(%d events)" % len(self)
+
+
+class ProjectileHitColumns:
+    """Попадания снарядов в виде столбцов: x, y, z, face - array('i'), shooter, victim - [str]"""
+    __slots__ = ("x", "y", "z", "face", "shooter", "victim")
+
+    def __init__(self, x, y, z, face, shooter, victim):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.face = face
+        self.shooter = shooter
+        self.victim = victim
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return "ProjectileHitColumns(%d events)" % len(self)
+
+
+def _columns(s, width):
+    s = _records(s)
+    if not s:
+        return [[] for _ in range(width)]
+    fields = s.replace(b"|", b",").split(b",")
+    if len(fields) % width:
+        raise ValueError("Malformed event list: %r" % s)
+    return [fields[i::width] for i in range(width)]
+
+
+def block_hit_columns(s) -> BlockHitColumns:
+    """b"x,y,z,face,entityId|..." => BlockHitColumns"""
+    x, y, z, face, entity = _columns(s, 5)
+    return BlockHitColumns(array("i", map(int, x)), array("i", map(int, y)), array("i", map(int, z)),
+                           array("i", map(int, face)), [e.decode() for e in entity])
+
+
+def projectile_hit_columns(s) -> ProjectileHitColumns:
+    """b"x,y,z,face,shooter,victim|..." => ProjectileHitColumns"""
+    x, y, z, face, shooter, victim = _columns(s, 6)
+    return ProjectileHitColumns(array("i", map(int, x)), array("i", map(int, y)), array("i", map(int, z)),
+                                array("i", map(int, face)), [e.decode("UTF-8") for e in shooter],
+                                [e.decode("UTF-8") for e in victim])
+
+
+def test_event():
+    hits = parse_block_hits(b"1,2,3,4,5|6,7,8,1,9")
+    assert [(e.x, e.y, e.z, e.face, e.entityId) for e in hits] == [(1, 2, 3, "4", "5"), (6, 7, 8, "1", "9")]
+    for s in (b"1,2,3,4,5|", b"|1,2,3,4,5", b"1,2,3,4,5||6,7,8,1,9", b"|"):
+        assert len(parse_block_hits(s)) == s.count(b",") // 4, s
+        assert len(block_hit_columns(s)) == s.count(b",") // 4, s
+    assert parse_block_hits(b"") == [] and len(block_hit_columns(b"")) == 0
+    try:
+        parse_block_hits(b"1,2,3,4")
+        assert False
+    except ValueError:
+        pass
+
+    shots = parse_projectile_hits(b"1,2,3,1,Steve,Alex||4,5,6,2,Steve,|")
+    assert [(e.shooterName, e.victimName) for e in shots] == [("Steve", "Alex"), ("Steve", "")]
+    columns = projectile_hit_columns(b"1,2,3,1,Steve,Alex||4,5,6,2,Steve,|")
+    assert list(columns.x) == [1, 4] and columns.victim == ["Alex", ""]
+
+    posts = parse_chat_posts(b"1,hi, there||2,|")
+    assert [(e.entityId, e.message) for e in posts] == [(1, "hi, there"), (2, "")]
+
+
+if __name__ == "__main__":
+    test_event()
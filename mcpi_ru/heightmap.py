@@ -0,0 +1,161 @@
+from array import array
+
+from .cache import CHUNK_SHIFT, TILE_SIZE
+from .minecraft import int_floor
+from .pipeline import Pipeline
+from .volume import read_volume
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Heights of a whole area.
+
+    Heights are read tile by tile (16x16 columns, the chunk columns of the
+    block cache) in one of two ways:
+      "height"  one pipelined world.getHeight per column
+      "blocks"  world.getBlocks of the columns between y_range and the
+                highest non-air block of each; columns whose top is not
+                inside y_range are asked with world.getHeight afterwards.
+                Far fewer commands when the terrain height is roughly
+                known, but blocks above ymax with air below them are not
+                seen
+    With the block cache enabled, tiles read with "height" are read whole
+    and kept (tiles from "blocks" are approximate and are not); writes
+    through the same Minecraft object drop the tiles they touch."""
+
+TILE_MASK = TILE_SIZE - 1
+
+
+class Heightmap:
+    """Высоты столбцов прямоугольника.
+
+    origin: (x0, z0), size: (nx, nz), data: высоты [x][z] - массив numpy
+    формы (nx, nz) или список строк array('i')."""
+
+    def __init__(self, origin, size, data):
+        self.origin = tuple(origin)
+        self.size = tuple(size)
+        self.data = data
+
+    def get(self, x, z) -> int:
+        """Высота столбца с мировыми координатами (x, z)"""
+        dx, dz = x - self.origin[0], z - self.origin[1]
+        if not (0 <= dx < self.size[0] and 0 <= dz < self.size[1]):
+            raise IndexError("(%s, %s) is outside of the heightmap" % (x, z))
+        return int(self.data[dx][dz])
+
+    def __repr__(self):
+        return "Heightmap(%s, %s)" % (self.origin, self.size)
+
+
+def _heights_from_blocks(conn, x0, z0, x1, z1, y_range):
+    """{(x, z): height} for columns whose top is inside y_range"""
+    y0, y1 = min(y_range), max(y_range)
+    volume = read_volume(conn, (x0, y0, z0), (x1, y1, z1))
+    nx, ny, nz = volume.size
+    air = volume.palette.index("air") if "air" in volume.palette else -1
+    heights = {}
+    if numpy is not None:
+        solid = volume.data != air
+        # Highest solid block of every column; -1 where there is none
+        top = ny - 1 - numpy.argmax(solid[::-1], axis=0)
+        top[~solid.any(axis=0)] = -1
+        for dx, dz in zip(*numpy.nonzero((top >= 0) & (top < ny - 1))):
+            heights[(x0 + int(dx), z0 + int(dz))] = y0 + int(top[dx, dz])
+        return heights
+    data = volume.data
+    for dx in range(nx):
+        for dz in range(nz):
+            for dy in range(ny - 1, -1, -1):
+                if data[(dy * nx + dx) * nz + dz] != air:
+                    if dy < ny - 1:
+                        heights[(x0 + dx, z0 + dz)] = y0 + dy
+                    break
+    return heights
+
+
+def _method(method, y_range):
+    if method == "auto":
+        method = "blocks" if y_range is not None else "height"
+    if method not in ("height", "blocks"):
+        raise ValueError("method must be 'auto', 'height' or 'blocks', not %r" % (method,))
+    if method == "blocks" and y_range is None:
+        raise ValueError("method 'blocks' needs y_range")
+    return method
+
+
+def _read_heights(conn, tiles, y_range, method, window):
+    """Heights of the columns of tiles [[(x, z)]] => {(x, z): height}"""
+    heights = {}
+    if method == "blocks":
+        # One box per tile, so cached tiles between missing ones are not read
+        for columns in tiles:
+            heights.update(_heights_from_blocks(conn, min(x for x, _ in columns), min(z for _, z in columns),
+                                                max(x for x, _ in columns), max(z for _, z in columns), y_range))
+    pipeline = Pipeline(conn, window)
+    pending = [(column, pipeline.query(int, b"world.getHeight", column))
+               for columns in tiles for column in columns if column not in heights]
+    pipeline.execute()
+    for column, result in pending:
+        heights[column] = result.result()
+    return heights
+
+
+def get_heightmap(mc, x0, z0, x1, z1, y_range=None, method="auto", window=1024) -> Heightmap:
+    """Высоты столбцов прямоугольника (x0, z0)-(x1, z1) => Heightmap
+
+    y_range: (ymin, ymax), в которых ожидается поверхность; с ним высоты
+    берутся из getBlocks (method="blocks"), без него - по getHeight."""
+    a, b = int_floor(x0, z0), int_floor(x1, z1)
+    x0, x1 = min(a[0], b[0]), max(a[0], b[0])
+    z0, z1 = min(a[1], b[1]), max(a[1], b[1])
+    nx, nz = x1 - x0 + 1, z1 - z0 + 1
+    method = _method(method, y_range)
+    cache = mc.cache
+
+    tiles = {}
+    missing = []
+    for cx in range(x0 >> CHUNK_SHIFT, (x1 >> CHUNK_SHIFT) + 1):
+        for cz in range(z0 >> CHUNK_SHIFT, (z1 >> CHUNK_SHIFT) + 1):
+            tile = cache.get_height_tile(cx, cz) if cache is not None else None
+            if tile is not None:
+                tiles[(cx, cz)] = tile
+            else:
+                missing.append((cx, cz))
+
+    heights = {}
+    if missing:
+        # Only exact heights (getHeight) are kept: "blocks" can miss blocks above ymax
+        keep = cache is not None and method == "height"
+        tile_columns = []
+        for cx, cz in missing:
+            bx, bz = cx << CHUNK_SHIFT, cz << CHUNK_SHIFT
+            if keep:
+                # Whole tiles, so that they can be cached
+                xs, zs = range(bx, bx + TILE_SIZE), range(bz, bz + TILE_SIZE)
+            else:
+                xs = range(max(x0, bx), min(x1, bx + TILE_MASK) + 1)
+                zs = range(max(z0, bz), min(z1, bz + TILE_MASK) + 1)
+            tile_columns.append([(x, z) for x in xs for z in zs])
+        heights = _read_heights(mc.conn, tile_columns, y_range, method, window)
+        if keep:
+            for cx, cz in missing:
+                bx, bz = cx << CHUNK_SHIFT, cz << CHUNK_SHIFT
+                tile = array("i", [heights[(bx + i, bz + k)] for i in range(TILE_SIZE) for k in range(TILE_SIZE)])
+                cache.put_height_tile(cx, cz, tile)
+                tiles[(cx, cz)] = tile
+
+    def height(x, z):
+        tile = tiles.get((x >> CHUNK_SHIFT, z >> CHUNK_SHIFT))
+        if tile is not None:
+            return tile[(x & TILE_MASK) * TILE_SIZE + (z & TILE_MASK)]
+        return heights[(x, z)]
+
+    rows = [array("i", [height(x, z) for z in range(z0, z1 + 1)]) for x in range(x0, x1 + 1)]
+    if numpy is not None:
+        data = numpy.array(rows, dtype=numpy.int32).reshape(nx, nz)
+    else:
+        data = rows
+    return Heightmap((x0, z0), (nx, nz), data)
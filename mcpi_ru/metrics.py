@@ -0,0 +1,279 @@
+import bisect
+import os
+import socket
+import sys
+import threading
+import time
+
+""" Traffic and latency metrics of connections.
+
+    A Metrics object is passed to Connection (or ConnectionPool,
+    AsyncConnection, Minecraft.create) as metrics=...; without it the
+    connection does no bookkeeping at all. It counts, per command name,
+    fire-and-forget sends, round-trips, failures and bytes in both
+    directions, keeps a histogram of round-trip latencies, and counts the
+    responses that were drained unread (a sign that client and server got
+    out of step).
+
+    Hooks are called after every command with a Sample; StatsdHook sends
+    them to a StatsD daemon, and Metrics.prometheus() renders the totals in
+    the Prometheus text format (write_prometheus() for a textfile
+    collector):
+
+    metrics = Metrics()
+    metrics.add_hook(StatsdHook())
+    mc = Minecraft.create(metrics=metrics)"""
+
+# Upper bounds of the latency histogram buckets, seconds; the last bucket is unbounded
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Sample:
+    """Один выполненный запрос. latency - None для команд без ответа;
+    count - сколько одинаковых команд без ответа отправлено пачкой"""
+    __slots__ = ("command", "latency", "bytes_out", "bytes_in", "failed", "count")
+
+    def __init__(self, command, latency, bytes_out, bytes_in, failed, count=1):
+        self.command = command
+        self.latency = latency
+        self.bytes_out = bytes_out
+        self.bytes_in = bytes_in
+        self.failed = failed
+        self.count = count
+
+    def __repr__(self):
+        return "Sample(%s, %s, %d, %d, %s, %d)" % (self.command, self.latency, self.bytes_out,
+                                                    self.bytes_in, self.failed, self.count)
+
+
+class CommandStats:
+    """Счетчики одной команды"""
+    __slots__ = ("sent", "requests", "failures", "bytes_out", "bytes_in", "latency_sum", "buckets")
+
+    def __init__(self):
+        self.sent = 0
+        self.requests = 0
+        self.failures = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def quantile(self, q):
+        """Оценка квантиля задержки (верхняя граница корзины), секунды"""
+        if not self.requests:
+            return None
+        rank = q * self.requests
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self) -> dict:
+        return {
+            "sent": self.sent,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "latency_sum": self.latency_sum,
+            "latency_mean": self.latency_sum / self.requests if self.requests else None,
+            "latency_p50": self.quantile(0.5),
+            "latency_p99": self.quantile(0.99),
+            "buckets": list(self.buckets),
+        }
+
+
+def _name(command):
+    return command.decode("UTF-8") if isinstance(command, bytes) else str(command)
+
+
+class Metrics:
+    """Метрики соединений. Один объект можно разделить между соединениями
+    (например, всеми соединениями ConnectionPool)"""
+
+    def __init__(self):
+        self.commands = {}  # command name (bytes) -> CommandStats
+        self.drained = 0
+        self.drained_bytes = 0
+        self.started = time.time()
+        self._hooks = []
+        self._lock = threading.Lock()
+        self.hook_errors = 0
+        self._broken_hooks = []  # hooks whose failure was already reported
+
+    def add_hook(self, hook):
+        """Вызывать hook(sample: Sample) после каждой команды"""
+        self._hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+        with self._lock:
+            if hook in self._broken_hooks:
+                self._broken_hooks.remove(hook)
+
+    def _stats(self, command):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        return stats
+
+    def sent(self, command, nbytes, count=1):
+        """Команда без ответа (count одинаковых команд, nbytes всего)"""
+        with self._lock:
+            stats = self._stats(command)
+            stats.sent += count
+            stats.bytes_out += nbytes
+        if self._hooks:
+            self._call_hooks(Sample(command, None, nbytes, 0, False, count))
+
+    def sent_many(self, commands, nbytes):
+        """Пачка команд без ответа [(f, data)], nbytes всего"""
+        counts = {}
+        for f, _ in commands:
+            counts[f] = counts.get(f, 0) + 1
+        total = len(commands) or 1
+        for f, count in counts.items():
+            self.sent(f, nbytes * count // total, count)
+
+    def request(self, command, latency, bytes_out, bytes_in, failed=False):
+        """Запрос с ответом: задержка latency секунд"""
+        with self._lock:
+            stats = self._stats(command)
+            stats.requests += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            stats.latency_sum += latency
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            if failed:
+                stats.failures += 1
+        if self._hooks:
+            self._call_hooks(Sample(command, latency, bytes_out, bytes_in, failed))
+
+    def discarded(self, data):
+        """Данные, прочитанные drain() без запроса (рассинхронизация)"""
+        with self._lock:
+            self.drained += max(1, data.count(b"\n"))
+            self.drained_bytes += len(data)
+
+    def _call_hooks(self, sample):
+        # Called from the connection's own finally: a broken hook must not hide its result or error
+        for hook in self._hooks:
+            try:
+                hook(sample)
+            except Exception as e:
+                with self._lock:
+                    self.hook_errors += 1
+                    first = hook not in self._broken_hooks
+                    if first:
+                        self._broken_hooks.append(hook)
+                if first:
+                    # Once per hook, not once per command
+                    sys.stderr.write("Metrics hook %r failed: %r\n" % (hook, e))
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.drained = 0
+            self.drained_bytes = 0
+            self.started = time.time()
+
+    def snapshot(self) -> dict:
+        """Все счетчики в виде словаря (имена команд - str)"""
+        with self._lock:
+            commands = {_name(f): stats.as_dict() for f, stats in self.commands.items()}
+            elapsed = time.time() - self.started
+        return {
+            "elapsed": elapsed,
+            "drained": self.drained,
+            "drained_bytes": self.drained_bytes,
+            "bytes_out": sum(c["bytes_out"] for c in commands.values()),
+            "bytes_in": sum(c["bytes_in"] for c in commands.values()),
+            "commands": commands,
+        }
+
+    def prometheus(self, prefix="mcpi") -> str:
+        """Метрики в текстовом формате Prometheus"""
+        with self._lock:
+            items = sorted((_name(f), stats) for f, stats in self.commands.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+                lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+            family("commands_sent_total", "counter", "Commands sent without waiting for a response")
+            for name, stats in items:
+                lines.append('%s_commands_sent_total{command="%s"} %d' % (prefix, name, stats.sent))
+            family("requests_total", "counter", "Commands that waited for a response")
+            for name, stats in items:
+                lines.append('%s_requests_total{command="%s"} %d' % (prefix, name, stats.requests))
+            family("request_failures_total", "counter", "Requests answered with Fail")
+            for name, stats in items:
+                lines.append('%s_request_failures_total{command="%s"} %d' % (prefix, name, stats.failures))
+            family("bytes_out_total", "counter", "Bytes written")
+            for name, stats in items:
+                lines.append('%s_bytes_out_total{command="%s"} %d' % (prefix, name, stats.bytes_out))
+            family("bytes_in_total", "counter", "Bytes read")
+            for name, stats in items:
+                lines.append('%s_bytes_in_total{command="%s"} %d' % (prefix, name, stats.bytes_in))
+            family("request_latency_seconds", "histogram", "Round-trip latency of requests")
+            for name, stats in items:
+                if not stats.requests:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append('%s_request_latency_seconds_bucket{command="%s",le="%r"} %d'
+                                 % (prefix, name, bound, cumulative))
+                lines.append('%s_request_latency_seconds_bucket{command="%s",le="+Inf"} %d'
+                             % (prefix, name, stats.requests))
+                lines.append('%s_request_latency_seconds_sum{command="%s"} %r' % (prefix, name, stats.latency_sum))
+                lines.append('%s_request_latency_seconds_count{command="%s"} %d' % (prefix, name, stats.requests))
+            family("drained_responses_total", "counter", "Responses drained unread (protocol desync)")
+            lines.append("%s_drained_responses_total %d" % (prefix, self.drained))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="mcpi"):
+        """Записать prometheus() в файл path атомарно (для textfile collector)"""
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp, path)
+
+
+class StatsdHook:
+    """Hook, отправляющий замеры демону StatsD по UDP (или в файловый объект stream)"""
+
+    def __init__(self, address=("127.0.0.1", 8125), prefix="mcpi", stream=None):
+        self.address = address
+        self.prefix = prefix
+        self.stream = stream
+        self.socket = None if stream is not None else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, sample):
+        name = "%s.%s" % (self.prefix, _name(sample.command))
+        lines = ["%s.bytes_out:%d|c" % (name, sample.bytes_out)]
+        if sample.latency is None:
+            lines.append("%s.sent:%d|c" % (name, sample.count))
+        else:
+            lines.append("%s.latency:%.3f|ms" % (name, sample.latency * 1000.0))
+            lines.append("%s.bytes_in:%d|c" % (name, sample.bytes_in))
+            if sample.failed:
+                lines.append("%s.failures:1|c" % name)
+        payload = "\n".join(lines)
+        if self.stream is not None:
+            self.stream.write(payload + "\n")
+            return
+        try:
+            self.socket.sendto(payload.encode("UTF-8"), self.address)
+        except OSError:
+            pass  # StatsD is best effort
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
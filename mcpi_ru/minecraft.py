@@ -1,9 +1,10 @@
 import os
 import math
 
-from .connection import Connection
-from .vec3 import Vec3
-from .event import BlockEvent, ChatEvent, ProjectileEvent
+from .connection import Connection, ConnectionPool
+from .vec3 import Vec3, Vec3Array
+from .event import (BlockEvent, ChatEvent, ProjectileEvent, parse_block_hits, parse_chat_posts,
+                    parse_projectile_hits, block_hit_columns, projectile_hit_columns)
 from .util import flatten
 
 """ Minecraft PI low level api v0.1_1
@@ -33,6 +34,40 @@ def int_floor(*args):
     return [int(math.floor(x)) for x in flatten(args)]
 
 
+""" Parsers of raw (bytes) server responses. Shared by the direct calls below
+    and by the deferred calls of a Pipeline."""
+
+
+def parse_str(s):
+    return s.decode("UTF-8")
+
+
+def parse_list(s, sep=","):
+    return s.decode("UTF-8").split(sep)
+
+
+def parse_player_ids(s):
+    return parse_list(s, "|")
+
+
+def parse_vec3(s):
+    return Vec3(*map(float, s.split(b",")))
+
+
+def parse_tile_vec3(s):
+    return Vec3(*map(int, s.split(b",")))
+
+
+def parse_entities(conn, s, entity_class=None):
+    entity_class = entity_class or Entity
+    entities = []
+    for i in s.decode("UTF-8").split(","):
+        if i:
+            name, eid = i.split(":")
+            entities.append(entity_class(conn, eid, name))
+    return entities
+
+
 class CmdPositioner:
     """Методы для получения и изменения позиции"""
 
@@ -42,30 +77,45 @@ class CmdPositioner:
 
     def get_pos(self, entity_id) -> Vec3:
         """Получить позицию сущности (entityId:int) => Vec3"""
-        s = self.conn.send_receive(self.pkg + b".getPos", entity_id)
-        return Vec3(*list(map(float, s.split(","))))
+        return parse_vec3(self.conn.send_receive_bytes(self.pkg + b".getPos", entity_id))
 
     def set_pos(self, entity_id, *args):
-        """Изменить позицию сущности (entityId:int, x,y,z)"""
+        """Изменить позицию сущности (entityId:int, x,y,z)
+
+        Для списка id и Vec3Array точек той же длины каждая сущность
+        переносится в свою точку (одной пачкой команд)."""
+        if args and isinstance(args[0], Vec3Array):
+            return self._send_points(b".setPos", entity_id, args[0].tolist())
         self.conn.send(self.pkg + b".setPos", entity_id, args)
 
+    def _send_points(self, command, entity_ids, points):
+        if len(entity_ids) != len(points):
+            raise ValueError("%d entities, but %d points" % (len(entity_ids), len(points)))
+        self.conn.send_many([(self.pkg + command, (entity_id, point)) for entity_id, point in zip(entity_ids, points)])
+
     def get_tile_pos(self, entity_id) -> Vec3:
         """Получить положение блока, на котором стоит сущность (entityId:int) => Vec3"""
-        s = self.conn.send_receive(self.pkg + b".getTile", entity_id)
-        return Vec3(*list(map(int, s.split(","))))
+        return parse_tile_vec3(self.conn.send_receive_bytes(self.pkg + b".getTile", entity_id))
 
     def set_tile_pos(self, entity_id, *args):
-        """Изменить положение блока, на котором стоит сущность (entityId:int) => Vec3"""
+        """Изменить положение блока, на котором стоит сущность (entityId:int) => Vec3
+
+        Принимает список id и Vec3Array, как set_pos."""
+        if args and isinstance(args[0], Vec3Array):
+            return self._send_points(b".setTile", entity_id, args[0].floor().tolist())
         self.conn.send(self.pkg + b".setTile", entity_id, int_floor(*args))
 
     def set_direction(self, entity_id, *args):
-        """Изменить направление сущности (entityId:int, x,y,z)"""
+        """Изменить направление сущности (entityId:int, x,y,z)
+
+        Принимает список id и Vec3Array, как set_pos."""
+        if args and isinstance(args[0], Vec3Array):
+            return self._send_points(b".setDirection", entity_id, args[0].tolist())
         self.conn.send(self.pkg + b".setDirection", entity_id, args)
 
     def get_direction(self, entity_id) -> Vec3:
         """Получить направление сущности (entityId:int) => Vec3"""
-        s = self.conn.send_receive(self.pkg + b".getDirection", entity_id)
-        return Vec3(*map(float, s.split(",")))
+        return parse_vec3(self.conn.send_receive_bytes(self.pkg + b".getDirection", entity_id))
 
     def set_rotation(self, entity_id, yaw):
         """Изменить угол поворота сущности (entityId:int, yaw)"""
@@ -73,7 +123,7 @@ class CmdPositioner:
 
     def get_rotation(self, entity_id) -> float:
         """Получить угол поворота сущности (entityId:int) => float"""
-        return float(self.conn.send_receive(self.pkg + b".getRotation", entity_id))
+        return float(self.conn.send_receive_bytes(self.pkg + b".getRotation", entity_id))
 
     def set_pitch(self, entity_id, pitch: int):
         """Изменить угол наклона сущности (entityId:int, pitch)"""
@@ -81,7 +131,7 @@ class CmdPositioner:
 
     def get_pitch(self, entity_id) -> float:
         """Получить угол наклона сущности (entityId:int) => float"""
-        return float(self.conn.send_receive(self.pkg + b".getPitch", entity_id))
+        return float(self.conn.send_receive_bytes(self.pkg + b".getPitch", entity_id))
 
     def setting(self, setting: str, status: bool):
         """Изменить настройки игрока (setting, status). keys: autojump"""
@@ -208,6 +258,7 @@ class CmdEvents:
 
     def __init__(self, connection):
         self.conn = connection
+        self.cache = None
 
     def clear_all(self):
         """Очистить список старых событий"""
@@ -215,21 +266,31 @@ class CmdEvents:
 
     def poll_block_hits(self) -> list:
         """При ударе мечом => [BlockEvent]"""
-        s = self.conn.send_receive(b"events.block.hits")
-        events = [e for e in s.split("|") if e]
-        return [BlockEvent.hit(*e.split(",")) for e in events]
+        events = parse_block_hits(self.conn.send_receive_bytes(b"events.block.hits"))
+        if self.cache is not None:
+            for e in events:
+                self.cache.invalidate(e.x, e.y, e.z)
+        return events
+
+    def poll_block_hit_columns(self):
+        """При ударе мечом => BlockHitColumns (столбцы x, y, z, face, entity)"""
+        columns = block_hit_columns(self.conn.send_receive_bytes(b"events.block.hits"))
+        if self.cache is not None:
+            for x, y, z in zip(columns.x, columns.y, columns.z):
+                self.cache.invalidate(x, y, z)
+        return columns
 
     def poll_chat_posts(self) -> list:
         """При использовании чата => [ChatEvent]"""
-        s = self.conn.send_receive(b"events.chat.posts")
-        events = [e for e in s.split("|") if e]
-        return [ChatEvent.post(int(e[:e.find(",")]), e[e.find(",") + 1:]) for e in events]
+        return parse_chat_posts(self.conn.send_receive_bytes(b"events.chat.posts"))
 
     def poll_projectile_hits(self) -> list:
         """При использовании снарядов => [BlockEvent]"""
-        s = self.conn.send_receive(b"events.projectile.hits")
-        events = [e for e in s.split("|") if e]
-        return [ProjectileEvent.hit(*e.split(",")) for e in events]
+        return parse_projectile_hits(self.conn.send_receive_bytes(b"events.projectile.hits"))
+
+    def poll_projectile_hit_columns(self):
+        """При использовании снарядов => ProjectileHitColumns (столбцы x, y, z, face, shooter, victim)"""
+        return projectile_hit_columns(self.conn.send_receive_bytes(b"events.projectile.hits"))
 
 
 class Minecraft:
@@ -237,33 +298,87 @@ class Minecraft:
 
     def __init__(self, connection):
         self.conn = connection
+        self.cache = None
 
         self.camera = CmdCamera(connection)
         self.entity = CmdEntity(connection)
         self.player = CmdPlayer(connection)
         self.events = CmdEvents(connection)
 
+    def enable_cache(self, max_entries=1 << 20):
+        """Включить кэш блоков и высот (см. BlockCache) => BlockCache
+
+        Повторные get_block, get_block_with_data и get_height для тех же
+        координат отвечаются без запроса к серверу."""
+        from .cache import BlockCache
+        self.cache = self.events.cache = BlockCache(max_entries)
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = self.events.cache = None
+
     def get_block(self, *args) -> int:
-        """Получить блок (x,y,z) => id:int"""
-        return self.conn.send_receive(b"world.getBlock", int_floor(args))
+        """Получить блок (x,y,z) => id:int
+
+        Для Vec3Array точек => [id] (запросы отправляются одним конвейером)"""
+        if args and isinstance(args[0], Vec3Array):
+            with self.pipeline() as p:
+                results = [p.get_block(pos) for pos in args[0].floor().tolist()]
+            return [r.result() for r in results]
+        pos = int_floor(args)
+        if self.cache is None:
+            return self.conn.send_receive(b"world.getBlock", pos)
+        block = self.cache.get_block(*pos)
+        if block is None:
+            block = self.conn.send_receive(b"world.getBlock", pos)
+            self.cache.put_block(*pos, block)
+        return block
 
     def get_block_with_data(self, *args):
         """Получить блок с параметрами (x,y,z) => Block"""
-        return self.conn.send_receive(b"world.getBlockWithData", int_floor(args)).split(",")
+        pos = int_floor(args)
+        if self.cache is None:
+            return parse_list(self.conn.send_receive_bytes(b"world.getBlockWithData", pos))
+        block = self.cache.get_block_with_data(*pos)
+        if block is None:
+            block = parse_list(self.conn.send_receive_bytes(b"world.getBlockWithData", pos))
+            self.cache.put_block_with_data(*pos, block)
+        return block
 
     def get_blocks(self, *args):
-        """Получить блоки в координатах (x0,y0,z0,x1,y1,z1) => [id:int]"""
-        # s = self.conn.sendReceive(b"world.getBlocks", intFloor(args))
-        s = self.conn.send_receive(b"world.getBlocks", *args)
-        return s.split(",")
+        """Получить блоки в координатах (x0,y0,z0,x1,y1,z1) => [id]
+
+        Для больших областей удобнее read_volume."""
+        return parse_list(self.conn.send_receive_bytes(b"world.getBlocks", int_floor(args)))
 
     def set_block(self, *args):
-        """Изменить блок (x,y,z,nameOfBlock,[data])"""
+        """Изменить блок (x,y,z,nameOfBlock,[data])
+
+        Вместо x,y,z можно передать Vec3Array: блок ставится во все точки."""
+        if args and isinstance(args[0], Vec3Array):
+            points = args[0].floor().tolist()
+            block = args[1:]
+            self.conn.send_many([(b"world.setBlock", (pos, block)) for pos in points])
+            if self.cache is not None:
+                for pos in points:
+                    self._cache_write((pos, block), 3)
+            return
         self.conn.send(b"world.setBlock", *args)
+        if self.cache is not None:
+            self._cache_write(args, 3)
 
     def set_blocks(self, *args):
         """Изменить блоки в координатах (x0,y0,z0,x1,y1,z1,nameOfBlock,[data])"""
         self.conn.send(b"world.setBlocks", *args)
+        if self.cache is not None:
+            self._cache_write(args, 6)
+
+    def _cache_write(self, args, n_coords):
+        flat = list(flatten(args))
+        coords = int_floor(flat[:n_coords])
+        if n_coords == 3:
+            coords += coords
+        self.cache.write(*coords)
 
     def set_sign(self, *args):
         """Установить табличку
@@ -272,6 +387,8 @@ class Minecraft:
         направление: 0-север, 1-восток, 2-юг 3-запад
         """
         self.conn.send(b"world.setSign", *args)
+        if self.cache is not None:
+            self.cache.invalidate(*int_floor(list(flatten(args))[:3]))
 
     def spawn_entity(self, *args):
         """Создать сущность (x,y,z,id,[data])"""
@@ -283,11 +400,22 @@ class Minecraft:
 
     def get_nearby_entities(self, *args) -> list:
         """Получить сущности поблизости (x,y,z)"""
-        entities = []
-        for i in self.conn.send_receive(b"world.getNearbyEntities", *args).split(","):
-            name, eid = i.split(":")
-            entities.append(Entity(self.conn, eid, name))
-        return entities
+        return parse_entities(self.conn, self.conn.send_receive_bytes(b"world.getNearbyEntities", *args))
+
+    def snapshot(self, entities, fields=("pos", "rotation", "pitch")):
+        """Состояние многих сущностей одним конвейером => snapshot.EntitySnapshot
+
+        fields: из "pos", "tile", "direction", "rotation", "pitch"."""
+        from .snapshot import snapshot
+        return snapshot(self.conn, entities, fields)
+
+    def entity_index(self, center, distance=None, cell=8.0, rate=10.0):
+        """Индекс сущностей вокруг center (точка или функция) => spatial.EntityIndex
+
+        Заполняется refresh() или в фоне после start(); nearest, within и
+        in_box отвечают без обращения к серверу."""
+        from .spatial import EntityIndex
+        return EntityIndex(self, center, distance, cell, rate)
 
     def remove_entity(self, *args):
         """Удалить сущность (x,y,z,id,[data])"""
@@ -295,12 +423,38 @@ class Minecraft:
 
     def get_height(self, *args) -> int:
         """Получить самый высокостоящий блок (x,z) => int"""
-        return int(self.conn.send_receive(b"world.getHeight", int_floor(args)))
+        pos = int_floor(args)
+        if self.cache is None:
+            return int(self.conn.send_receive_bytes(b"world.getHeight", pos))
+        height = self.cache.get_height(*pos)
+        if height is None:
+            height = int(self.conn.send_receive_bytes(b"world.getHeight", pos))
+            self.cache.put_height(*pos, height)
+        return height
+
+    def get_heightmap(self, x0, z0, x1, z1, y_range=None, method="auto"):
+        """Высоты всех столбцов прямоугольника (x0,z0)-(x1,z1) => heightmap.Heightmap
+
+        Запросы отправляются конвейером. y_range=(ymin, ymax): высоты
+        определяются по блокам (getBlocks), что намного быстрее, если
+        поверхность лежит в этих пределах. С включенным кэшем области
+        16x16 запоминаются до записи блоков в них."""
+        from .heightmap import get_heightmap
+        return get_heightmap(self, x0, z0, x1, z1, y_range, method)
+
+    def find_blocks(self, p0, p1, blocks, index=None, workers=None):
+        """Координаты блоков blocks (имя или список имен) в кубоиде p0..p1 => {имя: Vec3Array}
+
+        Область читается по чанкам параллельно, по всем соединениям
+        ConnectionPool (Minecraft.create(pool_size=...)). index:
+        search.BlockIndex - запоминает прочитанные чанки, повторные поиски
+        по ним не обращаются к серверу."""
+        from .search import find_blocks
+        return find_blocks(self, p0, p1, blocks, index, workers)
 
     def get_player_entity_ids(self):
         """Получить ID игроков, находящихся в игре => [id:int]"""
-        ids = self.conn.send_receive(b"world.getPlayerIds")
-        return ids.split("|")
+        return parse_player_ids(self.conn.send_receive_bytes(b"world.getPlayerIds"))
 
     def get_player_entity_id(self, name: str) -> int:
         """Получить ID игрока, используя его ник => [id:int]"""
@@ -313,6 +467,8 @@ class Minecraft:
     def restore_checkpoint(self):
         """Восстановить мир до точки восстановления"""
         self.conn.send(b"world.checkpoint.restore")
+        if self.cache is not None:
+            self.cache.clear()
 
     def post_to_chat(self, msg):
         """Написать сообщение в чате"""
@@ -328,9 +484,84 @@ class Minecraft:
         """
         return self.conn.send_receive(b"setPlayer", name)
 
+    def read_volume(self, p0, p1, chunk=None):
+        """Прочитать блоки кубоида (p0, p1) => Volume
+
+        Большие области читаются частями (chunk = (dx, dy, dz)) через конвейер."""
+        from .volume import read_volume
+        if chunk is None:
+            return read_volume(self.conn, p0, p1)
+        return read_volume(self.conn, p0, p1, chunk)
+
+    def write_volume(self, origin, voxels, diff=False) -> int:
+        """Записать блоки voxels, начиная с угла origin => число команд setBlocks
+
+        voxels: Volume, массив numpy формы (ny, nx, nz) или вложенные списки
+        [y][x][z] с именами блоков (None - не менять блок). Одинаковые соседние
+        блоки объединяются в кубоиды. diff=True сначала читает область и не
+        перезаписывает уже совпадающие блоки."""
+        from .volume import volume_values, merge_cuboids
+        ox, oy, oz = int_floor(origin)
+        size, values = volume_values(voxels)
+        if diff and all(size):
+            nx, ny, nz = size
+            current = self.read_volume((ox, oy, oz), (ox + nx - 1, oy + ny - 1, oz + nz - 1))
+            _, current_values = volume_values(current)
+            values = [None if v == c else v for v, c in zip(values, current_values)]
+        return self.set_cuboids(merge_cuboids(values, size), (ox, oy, oz))
+
+    def set_cuboids(self, cuboids, origin=(0, 0, 0)) -> int:
+        """Записать кубоиды [((x0,y0,z0), (x1,y1,z1), блок)] одной пачкой
+        команд setBlocks => число команд. Координаты - относительно origin"""
+        ox, oy, oz = int_floor(origin)
+        commands = [(b"world.setBlocks", ((ox + x0, oy + y0, oz + z0, ox + x1, oy + y1, oz + z1), block))
+                    for (x0, y0, z0), (x1, y1, z1), block in cuboids]
+        if commands:
+            self.conn.send_many(commands)
+        if self.cache is not None:
+            for _, args in commands:
+                self._cache_write(args, 6)
+        return len(commands)
+
+    def draw(self, shape, *block) -> int:
+        """Нарисовать фигуру из модуля shapes блоком (nameOfBlock,[data]) => число команд setBlocks"""
+        return self.set_cuboids([(a, b, block) for a, b in shape.cuboids()])
+
+    def export_region(self, p0, p1, path, compress=True) -> int:
+        """Сохранить блоки кубоида (p0, p1) в файл региона path => число блоков
+
+        Область читается и записывается по частям, память не растет с размером области."""
+        from .region import export_region
+        return export_region(self, p0, p1, path, compress)
+
+    def import_region(self, path, origin, skip=()) -> int:
+        """Загрузить файл региона path в мир с углом origin => число команд setBlocks
+
+        skip: имена блоков, которые не нужно записывать (например, ("air",))."""
+        from .region import import_region
+        return import_region(self, path, origin, skip)
+
+    def flush(self):
+        """Отправить накопленные команды (при buffer_size > 0)"""
+        self.conn.flush()
+
+    def pipeline(self, window=1024):
+        """Создать конвейер запросов: все запросы отправляются одним пакетом,
+        а ответы читаются подряд (см. Pipeline)"""
+        from .pipeline import Pipeline
+        return Pipeline(self.conn, window)
+
     @staticmethod
-    def create(address="localhost", port=4711, debug=False):
-        """Создать подключение к серверу."""
+    def create(address="localhost", port=4711, debug=False, pool_size=None, buffer_size=0, metrics=None,
+               recorder=None):
+        """Создать подключение к серверу.
+
+        pool_size: если указан, создается ConnectionPool на pool_size соединений,
+        и экземпляр Minecraft можно использовать из нескольких потоков.
+        buffer_size: если больше 0, команды без ответа (set_block, post_to_chat...)
+        накапливаются и отправляются пачками (см. Connection.flush).
+        metrics: metrics.Metrics, в котором учитываются команды, байты и задержки.
+        recorder: recorder.Recorder, в журнал которого пишется весь трафик."""
         if "JRP_API_HOST" in os.environ:
             address = os.environ["JRP_API_HOST"]
         if "JRP_API_PORT" in os.environ:
@@ -338,7 +569,10 @@ class Minecraft:
                 port = int(os.environ["JRP_API_PORT"])
             except ValueError:
                 pass
-        return Minecraft(Connection(address, port, debug))
+        if pool_size:
+            return Minecraft(ConnectionPool(address, port, pool_size, debug, buffer_size, metrics=metrics,
+                                            recorder=recorder))
+        return Minecraft(Connection(address, port, debug, buffer_size, metrics=metrics, recorder=recorder))
 
 
 def mcpy(func):
@@ -0,0 +1,280 @@
+import time
+
+from .connection import Connection, RequestError
+from .event import (parse_block_hits, parse_chat_posts, parse_projectile_hits, block_hit_columns,
+                    projectile_hit_columns)
+from .minecraft import int_floor, parse_str, parse_list, parse_player_ids, parse_vec3, parse_tile_vec3, parse_entities
+
+""" Pipelined requests: every query is queued as a PipelineResult, then all
+    of them are written with one sendall() and the responses are read back in
+    order. A loop over an area costs one round-trip instead of one per block.
+
+    with mc.pipeline() as p:
+        heights = [p.get_height(x, z) for x in range(64) for z in range(64)]
+    print(heights[0].result())"""
+
+
+class PipelineResult:
+    """Результат отложенного запроса. Доступен после выполнения конвейера"""
+    __slots__ = ("_value", "_error", "_done")
+
+    def __init__(self):
+        self._value = None
+        self._error = None
+        self._done = False
+
+    def done(self) -> bool:
+        return self._done
+
+    def exception(self):
+        return self._error
+
+    def result(self):
+        """Значение запроса того же типа, что вернул бы обычный метод"""
+        if not self._done:
+            raise RuntimeError("Pipeline has not been executed yet")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _set(self, value):
+        self._value = value
+        self._done = True
+
+    def _fail(self, error):
+        self._error = error
+        self._done = True
+
+    def __repr__(self):
+        if not self._done:
+            return "PipelineResult(<pending>)"
+        if self._error is not None:
+            return "PipelineResult(<error %r>)" % self._error
+        return "PipelineResult(%r)" % (self._value,)
+
+
+class PipelinePositioner:
+    """Отложенные запросы позиции сущности"""
+
+    def __init__(self, pipeline, package_prefix):
+        self.pipeline = pipeline
+        self.pkg = package_prefix
+
+    def get_pos(self, entity_id) -> PipelineResult:
+        return self.pipeline.query(parse_vec3, self.pkg + b".getPos", entity_id)
+
+    def get_tile_pos(self, entity_id) -> PipelineResult:
+        return self.pipeline.query(parse_tile_vec3, self.pkg + b".getTile", entity_id)
+
+    def get_direction(self, entity_id) -> PipelineResult:
+        return self.pipeline.query(parse_vec3, self.pkg + b".getDirection", entity_id)
+
+    def get_rotation(self, entity_id) -> PipelineResult:
+        return self.pipeline.query(float, self.pkg + b".getRotation", entity_id)
+
+    def get_pitch(self, entity_id) -> PipelineResult:
+        return self.pipeline.query(float, self.pkg + b".getPitch", entity_id)
+
+
+class PipelineEntity(PipelinePositioner):
+    def __init__(self, pipeline):
+        PipelinePositioner.__init__(self, pipeline, b"entity")
+
+    def get_name(self, player_id) -> PipelineResult:
+        return self.pipeline.query(parse_str, b"entity.getName", player_id)
+
+
+class PipelinePlayer(PipelinePositioner):
+    def __init__(self, pipeline):
+        PipelinePositioner.__init__(self, pipeline, b"player")
+
+    def get_pos(self) -> PipelineResult:
+        return PipelinePositioner.get_pos(self, [])
+
+    def get_tile_pos(self) -> PipelineResult:
+        return PipelinePositioner.get_tile_pos(self, [])
+
+    def get_direction(self) -> PipelineResult:
+        return PipelinePositioner.get_direction(self, [])
+
+    def get_rotation(self) -> PipelineResult:
+        return PipelinePositioner.get_rotation(self, [])
+
+    def get_pitch(self) -> PipelineResult:
+        return PipelinePositioner.get_pitch(self, [])
+
+
+class PipelineEvents:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def poll_block_hits(self) -> PipelineResult:
+        return self.pipeline.query(parse_block_hits, b"events.block.hits")
+
+    def poll_chat_posts(self) -> PipelineResult:
+        return self.pipeline.query(parse_chat_posts, b"events.chat.posts")
+
+    def poll_projectile_hits(self) -> PipelineResult:
+        return self.pipeline.query(parse_projectile_hits, b"events.projectile.hits")
+
+    def poll_block_hit_columns(self) -> PipelineResult:
+        return self.pipeline.query(block_hit_columns, b"events.block.hits")
+
+    def poll_projectile_hit_columns(self) -> PipelineResult:
+        return self.pipeline.query(projectile_hit_columns, b"events.projectile.hits")
+
+
+class Pipeline:
+    """Конвейер запросов к серверу.
+
+    Методы повторяют запросы Minecraft (world.*, entity.*, player.*, events.*),
+    но возвращают PipelineResult. Запросы отправляются в execute() (или при
+    выходе из блока with) пачками по window штук: одна запись в сокет на пачку,
+    затем ответы читаются по порядку."""
+
+    def __init__(self, connection, window=1024):
+        self.conn = connection
+        self.window = window
+        self._queue = []
+
+        self.entity = PipelineEntity(self)
+        self.player = PipelinePlayer(self)
+        self.events = PipelineEvents(self)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self._queue = []
+
+    def query(self, parser, f, *data) -> PipelineResult:
+        """Поставить в очередь запрос f(*data). Ответ сервера (bytes) будет
+        преобразован функцией parser"""
+        result = PipelineResult()
+        self._queue.append((Connection.command(f, *data), parser, result))
+        return result
+
+    def execute(self) -> list:
+        """Отправить все запросы и прочитать ответы => [PipelineResult]"""
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+        window = max(1, self.window)
+        try:
+            with self.conn.connection() as conn:
+                metrics = getattr(conn, "metrics", None)
+                conn.drain()
+                written = False
+                try:
+                    for start in range(0, len(queue), window):
+                        batch = queue[start:start + window]
+                        sent = time.perf_counter()
+                        written = True
+                        conn._send(b"".join([line for line, _, _ in batch]))
+                        for line, parser, result in batch:
+                            s = conn.read_line()
+                            if metrics is not None:
+                                # Latency of a pipelined request: from the write of its batch to its response
+                                metrics.request(line[:line.find(b"(")], time.perf_counter() - sent, len(line),
+                                                len(s) + 1, s == Connection.RequestFailedBytes)
+                            if s == Connection.RequestFailedBytes:
+                                result._fail(RequestError("%s failed" % line.strip()))
+                                continue
+                            try:
+                                result._set(parser(s))
+                            except Exception as e:
+                                result._fail(e)
+                except BaseException:
+                    if written:
+                        # Responses still on the way would be read as the answers
+                        # of later requests: the connection can't be used any more
+                        try:
+                            conn.close()
+                        except Exception:
+                            pass
+                    raise
+        except BaseException as e:
+            # I/O failed partway: the results that were not read get the real error
+            for _, _, result in queue:
+                if not result.done():
+                    result._fail(e)
+            raise
+        return [result for _, _, result in queue]
+
+    def get_block(self, *args) -> PipelineResult:
+        return self.query(parse_str, b"world.getBlock", int_floor(args))
+
+    def get_block_with_data(self, *args) -> PipelineResult:
+        return self.query(parse_list, b"world.getBlockWithData", int_floor(args))
+
+    def get_blocks(self, *args) -> PipelineResult:
+        return self.query(parse_list, b"world.getBlocks", int_floor(args))
+
+    def get_height(self, *args) -> PipelineResult:
+        return self.query(int, b"world.getHeight", int_floor(args))
+
+    def get_nearby_entities(self, *args) -> PipelineResult:
+        conn = self.conn
+        return self.query(lambda s: parse_entities(conn, s), b"world.getNearbyEntities", *args)
+
+    def get_player_entity_ids(self) -> PipelineResult:
+        return self.query(parse_player_ids, b"world.getPlayerIds")
+
+    def get_player_entity_id(self, name) -> PipelineResult:
+        return self.query(parse_str, b"world.getPlayerId", name)
+
+
+def test_pipeline():
+    from .emulator import EmulatorServer, World
+
+    class Interrupted(BaseException):
+        pass
+
+    def interrupt(s):
+        raise Interrupted()
+
+    with EmulatorServer(world=World(ground=4)) as server:
+        mc = server.minecraft()
+        conn = mc.conn
+
+        # A failing command and a parser error fail only their own results
+        with mc.pipeline() as p:
+            before = p.get_height(0, 0)
+            failed = p.get_player_entity_id("nobody")
+            bad = p.query(int, b"world.getBlock", 0, 0, 0)
+            after = p.get_block(0, 3, 0)
+        assert before.result() == 3 and after.result() == "stone"
+        assert isinstance(failed.exception(), RequestError) and isinstance(bad.exception(), ValueError)
+
+        # Windows: 10 queries in writes of 3, answers stay in order
+        writes = []
+        send = conn._send
+        conn._send = lambda data: (writes.append(data.count(b"\n")), send(data))
+        p = mc.pipeline(window=3)
+        heights = [p.get_height(x, 0) for x in range(10)]
+        assert len(p.execute()) == 10 and len(p) == 0
+        assert writes == [3, 3, 3, 1] and [h.result() for h in heights] == [3] * 10
+        del conn._send
+
+        # Interrupted after a write: the unread results fail, the connection is closed
+        p = mc.pipeline()
+        first = p.get_height(0, 0)
+        stopped = p.query(interrupt, b"world.getHeight", 1, 1)
+        rest = p.get_height(2, 2)
+        try:
+            p.execute()
+            assert False, "Interrupted expected"
+        except Interrupted:
+            pass
+        assert first.result() == 3 and isinstance(rest.exception(), Interrupted)
+        assert conn.socket.fileno() == -1
+
+
+if __name__ == "__main__":
+    test_pipeline()
@@ -0,0 +1,290 @@
+import argparse
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from .metrics import Metrics
+
+""" Recording and replay of protocol traffic.
+
+    A Recorder passed to a connection (recorder=...) appends everything the
+    connection writes and reads to a log file: the raw bytes of every write
+    (one record per sendall, so batches stay batches), every response line
+    and every chunk of drained data, each with a timestamp and the number of
+    the connection it belongs to. The file is append-only and can be
+    recorded into by several processes one after another.
+
+    replay() plays a log back against a server, every recorded connection on
+    its own socket, either at the recorded pacing or as fast as possible,
+    and reports the throughput and, per command, the latency from the write
+    of a request to its response (as metrics.Metrics counts it):
+
+    python -m mcpi_ru.recorder replay session.log --port 4711
+
+    Log layout: HEADER (MAGIC, number of connections registered so far),
+    then records of RECORD (kind, stream, time, length) followed by length
+    bytes of data."""
+
+MAGIC = b"MCPILOG\x01"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<BHdI")
+
+SENT = 0
+RECEIVED = 1
+DRAINED = 2
+
+
+class Recorder:
+    """Журнал трафика соединений (файл path, дописывается в конец)"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, "r+b")
+            # Connections of an earlier recording into the same file keep their numbers
+            header = self.file.read(HEADER.size)
+            if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+                self.file.close()
+                raise ValueError("%s is not a traffic log" % path)
+            self._streams = HEADER.unpack(header)[1]
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "w+b")
+            self._streams = 0
+            self.file.write(HEADER.pack(MAGIC, 0))
+        self._lock = threading.Lock()
+
+    def register(self) -> int:
+        """Номер для нового соединения"""
+        with self._lock:
+            self._streams += 1
+            end = self.file.tell()
+            self.file.seek(len(MAGIC))
+            self.file.write(HEADER.pack(MAGIC, self._streams)[len(MAGIC):])
+            self.file.seek(end)
+            return self._streams
+
+    def write(self, kind, stream, data):
+        header = RECORD.pack(kind, stream, time.time(), len(data))
+        with self._lock:
+            self.file.write(header)
+            self.file.write(data)
+
+    def sent(self, stream, data):
+        self.write(SENT, stream, data)
+
+    def received(self, stream, data):
+        self.write(RECEIVED, stream, data)
+
+    def drained(self, stream, data):
+        self.write(DRAINED, stream, data)
+
+    def flush(self):
+        with self._lock:
+            self.file.flush()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_log(path):
+    """Перебрать записи журнала: (kind, stream, time, data)"""
+    with open(path, "rb") as f:
+        if f.read(HEADER.size)[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a traffic log" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return  # a truncated last record is what a crash mid-write leaves behind
+            kind, stream, timestamp, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, stream, timestamp, data
+
+
+def load_streams(path) -> dict:
+    """stream -> {"writes": [(time, bytes)], "answers": [строк ответа на каждую
+    запись], "responses": число строк ответов}"""
+    streams = {}
+    for kind, stream, timestamp, data in read_log(path):
+        s = streams.get(stream)
+        if s is None:
+            s = streams[stream] = {"writes": [], "answers": [], "responses": 0}
+        if kind == SENT:
+            s["writes"].append((timestamp, data))
+            s["answers"].append(0)
+            continue
+        lines = 1 if kind == RECEIVED else data.count(b"\n")
+        s["responses"] += lines
+        if s["answers"]:
+            s["answers"][-1] += lines
+    return streams
+
+
+def log_info(path) -> dict:
+    """Сводка журнала: соединения, команды по именам, длительность"""
+    commands = {}
+    first = last = None
+    streams = set()
+    totals = {SENT: 0, RECEIVED: 0, DRAINED: 0}
+    for kind, stream, timestamp, data in read_log(path):
+        streams.add(stream)
+        first = timestamp if first is None else first
+        last = timestamp
+        totals[kind] += len(data)
+        if kind == SENT:
+            for line in data.splitlines():
+                name = line[:line.find(b"(")].decode("UTF-8", "replace")
+                commands[name] = commands.get(name, 0) + 1
+    return {
+        "streams": len(streams),
+        "seconds": (last - first) if first is not None else 0.0,
+        "commands": sum(commands.values()),
+        "by_command": commands,
+        "bytes_sent": totals[SENT],
+        "bytes_received": totals[RECEIVED],
+        "bytes_drained": totals[DRAINED],
+    }
+
+
+class _StreamReplay:
+    IdleTimeout = 5.0  # after the last write, how long to wait for a missing response
+
+    def __init__(self, address, port, writes, answers, responses, pace, metrics):
+        self.writes = writes
+        self.responses = responses
+        self.pace = pace
+        self.metrics = metrics
+        self.socket = socket.create_connection((address, port), 10)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(60)
+        self.received = 0
+        self.bytes_in = 0
+        self.error = None
+        # The recorded responses of a write answer its last lines (a request
+        # goes out after the commands buffered ahead of it)
+        self._requests = collections.deque()  # (command, write, bytes out)
+        self._sent_at = [None] * len(writes)
+        for i, ((_, data), n) in enumerate(zip(writes, answers)):
+            lines = data.splitlines(True)
+            if n:
+                requests = lines[-n:] if n <= len(lines) else lines + lines[-1:] * (n - len(lines))
+                self._requests.extend((_command(line), i, len(line)) for line in requests)
+
+    def run(self, start, t0):
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+        try:
+            for i, (timestamp, data) in enumerate(self.writes):
+                if self.pace:
+                    delay = start + (timestamp - t0) / self.pace - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._sent_at[i] = time.perf_counter()
+                self.socket.sendall(data)
+        except OSError as e:
+            self.error = e
+        self.socket.settimeout(self.IdleTimeout)
+        reader.join()
+        self.socket.close()
+
+    def _read(self):
+        buffer = b""
+        try:
+            while self.received < self.responses:
+                data = self.socket.recv(1 << 16)
+                if not data:
+                    break
+                now = time.perf_counter()
+                self.bytes_in += len(data)
+                *lines, buffer = (buffer + data).split(b"\n")
+                self.received += len(lines)
+                for line in lines:
+                    if not self._requests:
+                        continue
+                    command, i, bytes_out = self._requests.popleft()
+                    self.metrics.request(command, now - self._sent_at[i], bytes_out, len(line) + 1,
+                                         line == b"Fail")
+        except OSError as e:
+            self.error = e
+
+
+def _command(line):
+    return line[:line.find(b"(")]
+
+
+def replay(path, address="localhost", port=4711, pace=None, metrics=None) -> dict:
+    """Воспроизвести журнал path на сервере address:port.
+
+    pace: None - как можно быстрее, 1.0 - с записанными интервалами,
+    2.0 - вдвое быстрее и т.д. Ждет столько строк ответа, сколько было
+    записано => отчет (словарь). metrics: metrics.Metrics, в котором
+    учитываются задержки запросов (по умолчанию - новый)"""
+    metrics = Metrics() if metrics is None else metrics
+    streams = load_streams(path)
+    replays = [_StreamReplay(address, port, s["writes"], s["answers"], s["responses"], pace, metrics)
+               for s in streams.values()]
+    recorded = [t for s in streams.values() for t, _ in s["writes"]]
+    t0 = min(recorded, default=0.0)
+    threads = []
+    start = time.perf_counter()
+    for r in replays:
+        threads.append(threading.Thread(target=r.run, args=(start, t0), daemon=True))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    commands = sum(data.count(b"\n") for r in replays for _, data in r.writes)
+    errors = [str(r.error) for r in replays if r.error is not None]
+    latency = {name: {key: stats[key] for key in ("requests", "failures", "latency_mean", "latency_p50",
+                                                  "latency_p99")}
+               for name, stats in metrics.snapshot()["commands"].items() if stats["requests"]}
+    return {
+        "streams": len(replays),
+        "commands": commands,
+        "responses": sum(r.received for r in replays),
+        "expected_responses": sum(r.responses for r in replays),
+        "bytes_out": sum(len(data) for r in replays for _, data in r.writes),
+        "bytes_in": sum(r.bytes_in for r in replays),
+        "seconds": seconds,
+        "recorded_seconds": max(recorded, default=t0) - t0,
+        "commands_per_sec": commands / seconds if seconds else float("inf"),
+        "latency": latency,
+        "errors": errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay or inspect a protocol traffic log")
+    sub = parser.add_subparsers(dest="action", required=True)
+    info = sub.add_parser("info", help="summary of a log")
+    info.add_argument("log")
+    play = sub.add_parser("replay", help="play a log back against a server")
+    play.add_argument("log")
+    play.add_argument("--host", default=os.environ.get("JRP_API_HOST", "localhost"))
+    play.add_argument("--port", type=int, default=int(os.environ.get("JRP_API_PORT", 4711)))
+    play.add_argument("--pace", type=float, default=None,
+                      help="replay with the recorded timing, sped up by this factor (default: as fast as possible)")
+    args = parser.parse_args(argv)
+    if args.action == "info":
+        report = log_info(args.log)
+    else:
+        report = replay(args.log, args.host, args.port, args.pace)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
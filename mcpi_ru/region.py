@@ -0,0 +1,256 @@
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+
+from .minecraft import int_floor
+from .pipeline import Pipeline
+from .vec3 import Vec3
+from .volume import Palette, normalize_cuboid, split_cuboid, merge_cuboids, _block_parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Region files: a cuboid of blocks saved chunk by chunk.
+
+    Layout (little-endian):
+      header   magic, origin (3 x int32), size (3 x int32), chunk size
+               (3 x int32), compression (uint8), palette length (uint32),
+               offset of the footer (uint64)
+      chunks   one record per sub-cuboid, in split_cuboid order: the uint16
+               palette indices of the blocks in y, x, z order, raw or
+               zlib-compressed
+      footer   (offset uint64, length uint32) of every chunk record, then the
+               palette: (length uint16, UTF-8 name) per block name
+
+    Export and import hold one window of chunks in memory at a time.
+    Uncompressed files can be memory-mapped and read block by block."""
+
+MAGIC = b"MCPIREG\x01"
+HEADER = struct.Struct("<8s3i3i3iB3xIQ")
+INDEX_ENTRY = struct.Struct("<QI")
+NAME_LENGTH = struct.Struct("<H")
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+DEFAULT_CHUNK = (32, 32, 32)
+
+
+def _to_le(data):
+    if sys.byteorder == "big":
+        data = array("H", data)
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_le(raw):
+    data = array("H", raw)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data
+
+
+def export_region(mc, p0, p1, path, compress=True, chunk=DEFAULT_CHUNK, window=64) -> int:
+    """Saves the cuboid p0..p1 to the region file path => number of blocks"""
+    lo, hi = normalize_cuboid(p0, p1)
+    size = [b - a + 1 for a, b in zip(lo, hi)]
+    compression = COMPRESSION_ZLIB if compress else COMPRESSION_NONE
+    boxes = list(split_cuboid(lo, hi, chunk))
+    palette = Palette()
+    index = []
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0, 0, 0, 0, 0, 0, compression, 0, 0))
+        for start in range(0, len(boxes), window):
+            pipeline = Pipeline(mc.conn, window)
+            results = []
+            for a, b in boxes[start:start + window]:
+                count = (b[0] - a[0] + 1) * (b[1] - a[1] + 1) * (b[2] - a[2] + 1)
+                results.append(pipeline.query(_block_parser(palette, count), b"world.getBlocks", a, b))
+            pipeline.execute()
+            for result in results:
+                raw = _to_le(result.result())
+                if compression == COMPRESSION_ZLIB:
+                    raw = zlib.compress(raw)
+                index.append((f.tell(), len(raw)))
+                f.write(raw)
+        footer = f.tell()
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        for name in palette.names():
+            name = name.encode("UTF-8")
+            f.write(NAME_LENGTH.pack(len(name)))
+            f.write(name)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, *lo, *size, *chunk, compression, len(palette), footer))
+    return size[0] * size[1] * size[2]
+
+
+class Region:
+    """Файл региона, открытый для чтения.
+
+    origin: Vec3 исходного угла, size: (nx, ny, nz), palette: [имя блока].
+    Несжатые файлы отображаются в память (mmap)."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a region file" % path)
+            fields = HEADER.unpack(header)
+            self.origin = Vec3(*fields[1:4])
+            self.size = fields[4:7]
+            self.chunk = fields[7:10]
+            self.compression = fields[10]
+            palette_length, footer = fields[11], fields[12]
+
+            lo = list(fields[1:4])
+            hi = [a + n - 1 for a, n in zip(lo, self.size)]
+            self.boxes = [(tuple(x - o for x, o in zip(a, lo)), tuple(x - o for x, o in zip(b, lo)))
+                          for a, b in split_cuboid(lo, hi, self.chunk)]
+            self.file.seek(footer)
+            raw = self.file.read(INDEX_ENTRY.size * len(self.boxes))
+            self.index = [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size) for i in range(len(self.boxes))]
+            self.palette = []
+            for _ in range(palette_length):
+                length, = NAME_LENGTH.unpack(self.file.read(NAME_LENGTH.size))
+                self.palette.append(self.file.read(length).decode("UTF-8"))
+
+            self.map = None
+            if self.compression == COMPRESSION_NONE and footer > HEADER.size:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.file.close()
+            raise
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._cached = (None, None)
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # chunk arrays handed out still use the mapping; it goes away with them
+            self.map = None
+        self.file.close()
+
+    def chunk_data(self, i):
+        """Индексы palette блоков i-го чанка (в порядке y, x, z)"""
+        offset, length = self.index[i]
+        if self.map is not None:
+            if numpy is not None:
+                return numpy.frombuffer(self.map, dtype="<u2", count=length // 2, offset=offset)
+            return _from_le(self.map[offset:offset + length])
+        self.file.seek(offset)
+        raw = self.file.read(length)
+        if self.compression == COMPRESSION_ZLIB:
+            raw = zlib.decompress(raw)
+        return _from_le(raw)
+
+    def chunks(self):
+        """Перебрать чанки: (угол0, угол1, данные); углы относительно origin"""
+        for i, (a, b) in enumerate(self.boxes):
+            yield a, b, self.chunk_data(i)
+
+    def get(self, x, y, z) -> str:
+        """Имя блока (x, y, z), координаты относительно origin"""
+        if not all(0 <= v < n for v, n in zip((x, y, z), self.size)):
+            raise IndexError("(%s, %s, %s) is outside of the region" % (x, y, z))
+        nx, ny, nz = self.size
+        cx, cy, cz = self.chunk
+        chunks_x = (nx + cx - 1) // cx
+        chunks_z = (nz + cz - 1) // cz
+        i = ((y // cy) * chunks_x + x // cx) * chunks_z + z // cz
+        if self._cached[0] != i:
+            self._cached = (i, self.chunk_data(i))
+        (ax, ay, az), (bx, by, bz) = self.boxes[i]
+        sx, sz = bx - ax + 1, bz - az + 1
+        return self.palette[int(self._cached[1][((y - ay) * sx + (x - ax)) * sz + (z - az)])]
+
+
+def import_region(mc, path, origin, skip=()) -> int:
+    """Writes the region file path with its minimal corner at origin, chunk
+    by chunk, as merged setBlocks cuboids => number of commands sent.
+    Blocks named in skip are left as they are"""
+    ox, oy, oz = int_floor(origin)
+    commands = 0
+    with Region(path) as region:
+        names = [None if name in skip else name for name in region.palette]
+        for (ax, ay, az), (bx, by, bz), data in region.chunks():
+            values = [names[i] for i in (data.tolist() if numpy is not None and
+                                         isinstance(data, numpy.ndarray) else data)]
+            for (x0, y0, z0), (x1, y1, z1), block in merge_cuboids(values, (bx - ax + 1, by - ay + 1, bz - az + 1)):
+                mc.set_blocks(ox + ax + x0, oy + ay + y0, oz + az + z0,
+                              ox + ax + x1, oy + ay + y1, oz + az + z1, block)
+                commands += 1
+    return commands
+
+
+def test_region():
+    import os
+    import tempfile
+
+    from .emulator import EmulatorServer, World
+
+    world = World(ground=2)
+    with EmulatorServer(world=world) as server, tempfile.TemporaryDirectory() as tmp:
+        mc = server.minecraft()
+        mc.set_blocks(0, 2, 0, 6, 4, 6, "planks")
+        mc.set_blocks(1, 3, 1, 5, 3, 5, "air")
+        mc.set_block(2, 5, 3, "glass")
+        mc.set_block(-1, 0, 7, "diamond_ore")
+        mc.get_player_entity_ids()  # answered after the writes are done
+        lo, hi = (-1, 0, -2), (8, 6, 9)
+        blocks = {(x, y, z): world.get_block(x, y, z).decode()
+                  for x in range(lo[0], hi[0] + 1) for y in range(lo[1], hi[1] + 1) for z in range(lo[2], hi[2] + 1)}
+
+        for compress in (True, False):
+            path = os.path.join(tmp, "r%d.bin" % compress)
+            # Chunks that don't divide the size: partial chunks at the far edges
+            assert export_region(mc, hi, lo, path, compress, chunk=(4, 3, 5), window=4) == len(blocks)
+            with Region(path) as region:
+                assert region.origin == Vec3(*lo) and region.size == (10, 7, 12) and region.chunk == (4, 3, 5)
+                assert region.compression == (COMPRESSION_ZLIB if compress else COMPRESSION_NONE)
+                assert (region.map is None) == compress
+                assert sorted(region.palette) == sorted(set(blocks.values()))
+                assert len(region.boxes) == 3 * 3 * 3
+                for (x, y, z), name in blocks.items():
+                    assert region.get(x - lo[0], y - lo[1], z - lo[2]) == name
+                try:
+                    region.get(10, 0, 0)
+                    assert False
+                except IndexError:
+                    pass
+
+            # Import somewhere else, air left out
+            mc.set_block(3 - lo[0] + 100, 3 - lo[1], 3 - lo[2] + 100, "wool")
+            assert blocks[(3, 3, 3)] == "air"
+            assert import_region(mc, path, (100, 0, 100), skip=("air",)) > 0
+            mc.get_player_entity_ids()  # answered after the writes are done
+            for (x, y, z), name in blocks.items():
+                if name != "air":
+                    assert world.get_block(x - lo[0] + 100, y - lo[1], z - lo[2] + 100).decode() == name
+            assert world.get_block(3 - lo[0] + 100, 3 - lo[1], 3 - lo[2] + 100) == b"wool"
+            mc.set_blocks(100, 0, 100, 120, 10, 120, "air")
+
+        with open(os.path.join(tmp, "bad.bin"), "wb") as f:
+            f.write(b"not a region")
+        try:
+            Region(os.path.join(tmp, "bad.bin"))
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_region()
@@ -0,0 +1,394 @@
+import heapq
+import math
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+from .cache import CHUNK_SHIFT
+from .connection import Connection
+
+""" Rate-limited, prioritized sending of fire-and-forget commands.
+
+    A Scheduler stands in front of a Connection (or ConnectionPool) and has
+    the same methods, so it can be given to Minecraft:
+
+    scheduler = Scheduler(Connection("localhost", 4711), rate=2000)
+    mc = Minecraft(scheduler)
+
+    Commands without a response are queued by priority (chat and
+    teleports before bulk world edits) and written by a background thread
+    within a budget of commands and bytes per second. The budget adapts to
+    the server: round-trip times of requests (and of a probe sent while
+    writing) that grow above the quietest round-trip seen mean the server
+    is falling behind, so the rate is cut; while round-trips stay low it
+    grows back towards the configured rate. A full queue blocks the sender
+    (backpressure). Requests that wait for a response are sent at once and
+    do not wait for queued commands, except block and height reads: they
+    wait until the queued block writes of the same 16x16 columns have
+    reached the server, so they (and a block cache) never see the world
+    from before a write that was already made. Call join() when any other read has to see
+    queued commands."""
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+# Commands that are not NORMAL by default
+DEFAULT_PRIORITIES = {
+    b"chat.post": INTERACTIVE,
+    b"player.setPos": INTERACTIVE,
+    b"player.setTile": INTERACTIVE,
+    b"player.setDirection": INTERACTIVE,
+    b"player.setRotation": INTERACTIVE,
+    b"player.setPitch": INTERACTIVE,
+    b"entity.setPos": INTERACTIVE,
+    b"entity.setTile": INTERACTIVE,
+    b"camera.setPos": INTERACTIVE,
+    b"camera.mode.setNormal": INTERACTIVE,
+    b"camera.mode.setFixed": INTERACTIVE,
+    b"camera.mode.setFollow": INTERACTIVE,
+    b"world.setBlock": BULK,
+    b"world.setBlocks": BULK,
+    b"world.setSign": BULK,
+}
+
+PROBE = b"world.getPlayerIds"
+
+# command -> number of coordinates that locate it
+WRITES = {b"world.setBlock": 3, b"world.setBlocks": 6, b"world.setSign": 3}
+READS = {b"world.getBlock": 3, b"world.getBlockWithData": 3, b"world.getHeight": 2, b"world.getBlocks": 6}
+# Areas over more columns than this are tracked as "everywhere"
+MAX_COLUMNS = 256
+EVERYWHERE = None
+
+
+def _columns(f, line, commands):
+    """16x16 columns (cx, cz) touched by the command line => tuple, (EVERYWHERE,) if too many"""
+    n = commands.get(f)
+    if n is None:
+        return ()
+    args = line[line.find(b"(") + 1:line.rfind(b")")].split(b",")[:n]
+    try:
+        values = [int(math.floor(float(a))) for a in args]
+    except ValueError:
+        return (EVERYWHERE,)
+    if len(values) < n:
+        return (EVERYWHERE,)
+    if n == 2:
+        x0, z0 = x1, z1 = values
+    elif n == 3:
+        x0, z0 = x1, z1 = values[0], values[2]
+    else:
+        x0, z0, x1, z1 = values[0], values[2], values[3], values[5]
+    xs = range(min(x0, x1) >> CHUNK_SHIFT, (max(x0, x1) >> CHUNK_SHIFT) + 1)
+    zs = range(min(z0, z1) >> CHUNK_SHIFT, (max(z0, z1) >> CHUNK_SHIFT) + 1)
+    if len(xs) * len(zs) > MAX_COLUMNS:
+        return (EVERYWHERE,)
+    return tuple((cx, cz) for cx in xs for cz in zs)
+
+
+def _check_priority(priority):
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise TypeError("Priority must be an int (INTERACTIVE, NORMAL, BULK or any other), not %r" % (priority,))
+
+
+class Scheduler:
+    """Очередь команд с приоритетами и ограничением скорости.
+
+    rate: команд в секунду (верхняя граница), byte_rate: байт в секунду
+    (None - без ограничения), max_queue: сколько команд может ждать, пока
+    send() не начнет блокироваться. adaptive: подстраивать скорость под
+    задержку ответов сервера, не опускаясь ниже min_rate."""
+
+    def __init__(self, conn, rate=5000.0, byte_rate=None, max_queue=100000, adaptive=True,
+                 min_rate=50.0, lag_factor=2.0, probe_interval=0.25, priorities=None):
+        self.conn = conn
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.byte_rate = byte_rate
+        self.max_queue = max_queue
+        self.adaptive = adaptive
+        self.min_rate = min(min_rate, self.max_rate)
+        self.lag_factor = lag_factor
+        self.probe_interval = probe_interval
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        if priorities:
+            for priority in priorities.values():
+                _check_priority(priority)
+            self.priorities.update(priorities)
+
+        self._queue = []  # (priority, sequence, f, line, columns)
+        self._writes = Counter()  # column -> queued or in-flight block writes
+        self._depth = Counter()  # priority -> queued commands
+        self._sequence = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._closed = False
+
+        self.sent = 0
+        self.bytes_sent = 0
+        self.blocked_time = 0.0
+        self.rtt = None        # moving average of round-trips, seconds
+        self.base_rtt = None   # quietest round-trip seen
+        self.errors = 0
+        self.read_waits = 0
+        self._waiting_reads = 0
+        self._last_probe = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="Scheduler", daemon=True)
+        self._thread.start()
+
+    # -- the Connection interface --
+
+    @contextmanager
+    def connection(self):
+        with self.conn.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def priority(self, priority):
+        """Все команды этого потока внутри with - с приоритетом priority"""
+        _check_priority(priority)
+        previous = getattr(self._local, "priority", None)
+        self._local.priority = priority
+        try:
+            yield self
+        finally:
+            self._local.priority = previous
+
+    def _priority(self, f):
+        priority = getattr(self._local, "priority", None)
+        return priority if priority is not None else self.priorities.get(f, NORMAL)
+
+    def send(self, f, *data):
+        self._enqueue([(f, Connection.command(f, *data))])
+
+    def send_many(self, commands):
+        self._enqueue([(f, Connection.command(f, *data)) for f, data in commands])
+
+    def _enqueue(self, lines):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed")
+            if len(self._queue) + len(lines) > self.max_queue and self._queue:
+                start = time.perf_counter()
+                while len(self._queue) + len(lines) > self.max_queue and self._queue and not self._closed:
+                    self._cond.wait()
+                self.blocked_time += time.perf_counter() - start
+            for f, line in lines:
+                priority = self._priority(f)
+                columns = _columns(f, line, WRITES)
+                self._writes.update(columns)
+                self._sequence += 1
+                heapq.heappush(self._queue, (priority, self._sequence, f, line, columns))
+                self._depth[priority] += 1
+            self._cond.notify_all()
+
+    def _writing(self, columns):
+        writes = self._writes
+        if EVERYWHERE in columns:
+            return bool(writes)
+        return EVERYWHERE in writes or any(c in writes for c in columns)
+
+    def send_receive_bytes(self, *data):
+        if data and data[0] in READS and self._writes:
+            columns = _columns(data[0], Connection.command(*data), READS)
+            with self._cond:
+                if self._writing(columns):
+                    self.read_waits += 1
+                    self._waiting_reads += 1
+                    try:
+                        self._cond.wait_for(lambda: not self._writing(columns))
+                    finally:
+                        self._waiting_reads -= 1
+        start = time.perf_counter()
+        s = self.conn.send_receive_bytes(*data)
+        self._measured(time.perf_counter() - start)
+        return s
+
+    def send_receive(self, *data):
+        return self.send_receive_bytes(*data).decode("UTF-8")
+
+    def flush(self):
+        """Дождаться отправки всей очереди"""
+        self.join()
+        self.conn.flush()
+
+    def join(self, timeout=None) -> bool:
+        """Дождаться, пока очередь опустеет => False, если не дождались за timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._in_flight, timeout)
+
+    def close(self):
+        """Отправить очередь и остановить поток (соединение не закрывается)"""
+        self.join()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # -- pacing --
+
+    def _measured(self, rtt):
+        with self._cond:
+            self.rtt = rtt if self.rtt is None else 0.7 * self.rtt + 0.3 * rtt
+            if self.base_rtt is None or rtt < self.base_rtt:
+                self.base_rtt = rtt
+            if not self.adaptive:
+                return
+            if self.rtt > self.base_rtt * self.lag_factor + 0.001:
+                self.rate = max(self.min_rate, self.rate * 0.7)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def _probe(self):
+        start = time.perf_counter()
+        self.conn.send_receive_bytes(PROBE)
+        self._measured(time.perf_counter() - start)
+
+    def _run(self):
+        tokens = 0.0
+        byte_tokens = 0.0
+        last = time.perf_counter()
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                now = time.perf_counter()
+                rate = self.rate
+                # Buckets hold at most 50 ms of budget, so bursts stay short
+                tokens = min(tokens + (now - last) * rate, max(1.0, rate * 0.05))
+                if self.byte_rate:
+                    byte_tokens = min(byte_tokens + (now - last) * self.byte_rate, max(1.0, self.byte_rate * 0.05))
+                last = now
+                if tokens < 1.0 or (self.byte_rate and byte_tokens <= 0):
+                    wait = (1.0 - tokens) / rate if tokens < 1.0 else -byte_tokens / self.byte_rate
+                    self._cond.wait(max(wait, 0.0005))
+                    continue
+                batch = []
+                while self._queue and len(batch) < int(tokens):
+                    if self.byte_rate and byte_tokens <= 0:
+                        break
+                    priority, _, f, line, columns = heapq.heappop(self._queue)
+                    self._depth[priority] -= 1
+                    batch.append((f, line, columns))
+                    byte_tokens -= len(line)
+                tokens -= len(batch)
+                self._in_flight = len(batch)
+                # A waiting read may go over another connection: make sure the
+                # server has run the writes before letting it go
+                sync = self._waiting_reads and any(columns for _, _, columns in batch)
+                self._cond.notify_all()
+            try:
+                self._write(batch, sync)
+                if self.adaptive and now - self._last_probe >= self.probe_interval:
+                    self._last_probe = now
+                    self._probe()
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    for _, _, columns in batch:
+                        self._writes.subtract(columns)
+                        for column in columns:
+                            if not self._writes[column]:
+                                del self._writes[column]
+                    self._cond.notify_all()
+
+    def _write(self, batch, sync=False):
+        data = b"".join([line for _, line, _ in batch])
+        with self.conn.connection() as conn:
+            conn._send(data)
+            metrics = getattr(conn, "metrics", None)
+            if metrics is not None:
+                for f, line, _ in batch:
+                    metrics.sent(f, len(line))
+            if sync:
+                conn.send_receive_bytes(PROBE)
+        self.sent += len(batch)
+        self.bytes_sent += len(data)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "queued_by_priority": {"interactive": self._depth[INTERACTIVE], "normal": self._depth[NORMAL],
+                                       "bulk": self._depth[BULK],
+                                       **{p: n for p, n in self._depth.items() if n and p not in (INTERACTIVE, NORMAL, BULK)}},
+                "rate": self.rate,
+                "max_rate": self.max_rate,
+                "sent": self.sent,
+                "bytes_sent": self.bytes_sent,
+                "rtt": self.rtt,
+                "base_rtt": self.base_rtt,
+                "blocked_time": self.blocked_time,
+                "errors": self.errors,
+                "read_waits": self.read_waits,
+            }
+
+
+def test_scheduler():
+    from .emulator import EmulatorServer, World
+    from .minecraft import Minecraft
+
+    # Columns of writes and reads
+    assert _columns(b"world.setBlock", b"world.setBlock(1,2,-1,stone)\n", WRITES) == ((0, -1),)
+    assert _columns(b"world.setBlocks", b"world.setBlocks(0,0,0,16,9,0,stone)\n", WRITES) == ((0, 0), (1, 0))
+    assert _columns(b"world.setBlocks", b"world.setBlocks(-9999,0,0,9999,0,0,air)\n", WRITES) == (EVERYWHERE,)
+    assert _columns(b"world.getHeight", b"world.getHeight(-17,33)\n", READS) == ((-2, 2),)
+    assert _columns(b"chat.post", b"chat.post(hi)\n", WRITES) == ()
+
+    world = World(ground=0)
+    with EmulatorServer(world=world) as server:
+        # Token bucket: 200 commands at 1000/s take about 0.2 s
+        with Scheduler(Connection(*server.address), rate=1000, adaptive=False) as scheduler:
+            mc = Minecraft(scheduler)
+            start = time.perf_counter()
+            for i in range(200):
+                mc.post_to_chat("m%d" % i)
+            scheduler.join()
+            assert 0.15 <= time.perf_counter() - start < 1.0
+            assert scheduler.stats()["sent"] == 200
+
+        # Priorities: chat queued after bulk writes is sent before them
+        scheduler = Scheduler(Connection(*server.address), rate=100, adaptive=False)
+        mc = Minecraft(scheduler)
+        with scheduler.priority(BULK):
+            for i in range(20):
+                mc.post_to_chat("bulk%d" % i)
+        mc.post_to_chat("now")
+        scheduler.close()
+        assert list(world.chat).index("now") < list(world.chat).index("bulk19")
+
+        # Reads see queued writes, also through the block cache
+        scheduler = Scheduler(Connection(*server.address), rate=200, adaptive=False)
+        mc = Minecraft(scheduler)
+        cache = mc.enable_cache()
+        assert mc.get_block(5, 1, 5) == "air"
+        for x in range(30):
+            mc.set_block(x, 1, 5, "stone")
+        assert mc.get_block(5, 1, 5) == "stone"
+        assert mc.get_block(29, 1, 5) == "stone"
+        assert mc.get_height(29, 5) == 1
+        assert cache.get_block(29, 1, 5) == "stone"
+        mc.set_blocks(0, 1, 5, 29, 1, 5, "air")
+        assert mc.get_block(29, 1, 5) == "air"
+        assert scheduler.stats()["read_waits"] >= 2
+        scheduler.close()
+
+
+if __name__ == "__main__":
+    test_scheduler()
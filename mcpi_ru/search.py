@@ -0,0 +1,335 @@
+import struct
+import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from .connection import ConnectionPool
+from .pipeline import Pipeline
+from .vec3 import Vec3Array
+from .volume import normalize_cuboid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Searching a region for blocks.
+
+    The region is cut into chunks aligned to a fixed grid. Chunks are read
+    with world.getBlocks by a pool of threads, each pipelining a batch of
+    chunks over its own connection of a ConnectionPool, so the scan runs
+    over all connections of the pool at once:
+
+    mc = Minecraft.create(pool_size=8)
+    ores = mc.find_blocks((-100, 0, -100), (100, 64, 100), ["diamond_ore"])
+    print(len(ores["diamond_ore"]))
+
+    A BlockIndex remembers, per chunk, where every block type is (as uint16
+    offsets inside the chunk). Chunks found in the index are not read
+    again; the index can be saved to a file and loaded later. It does not
+    see changes made after a chunk was read: call invalidate() for areas
+    that were written since."""
+
+DEFAULT_CHUNK = (16, 16, 16)
+
+MAGIC = b"MCPIIDX\x01"
+HEADER = struct.Struct("<8s3iII")
+CHUNK_HEADER = struct.Struct("<3iH")
+ENTRY_HEADER = struct.Struct("<HI")
+NAME_LENGTH = struct.Struct("<H")
+
+
+def _le(data):
+    if sys.byteorder == "big":
+        data = array("H", data)
+        data.byteswap()
+    return data
+
+
+class BlockIndex:
+    """Индекс блоков по чанкам: (cx, cy, cz) -> {имя блока: array('H') смещений}.
+
+    chunk: размер чанка (dx, dy, dz), dx*dy*dz <= 65536. Блоки exclude
+    (по умолчанию air) не запоминаются."""
+
+    def __init__(self, chunk=DEFAULT_CHUNK, exclude=("air",)):
+        if chunk[0] * chunk[1] * chunk[2] > 0x10000:
+            raise ValueError("A chunk of the index holds at most 65536 blocks")
+        self.chunk = tuple(chunk)
+        self.exclude = frozenset(exclude)
+        self.chunks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, key):
+        return key in self.chunks
+
+    def bounds(self, key):
+        """Углы чанка key => ((x0, y0, z0), (x1, y1, z1))"""
+        lo = [k * n for k, n in zip(key, self.chunk)]
+        return tuple(lo), tuple(a + n - 1 for a, n in zip(lo, self.chunk))
+
+    def keys(self, lo, hi) -> list:
+        """Чанки, пересекающие кубоид lo..hi"""
+        cx, cy, cz = self.chunk
+        return [(x, y, z)
+                for y in range(lo[1] // cy, hi[1] // cy + 1)
+                for x in range(lo[0] // cx, hi[0] // cx + 1)
+                for z in range(lo[2] // cz, hi[2] // cz + 1)]
+
+    def put(self, key, entries):
+        with self._lock:
+            self.chunks[key] = entries
+
+    def invalidate(self, p0, p1):
+        """Забыть чанки, пересекающие кубоид p0..p1 (например, после записи в него)"""
+        lo, hi = normalize_cuboid(p0, p1)
+        with self._lock:
+            for key in self.keys(lo, hi):
+                self.chunks.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.chunks.clear()
+
+    def save(self, path):
+        """Сохранить индекс в файл path"""
+        with self._lock:
+            names = sorted({name for entries in self.chunks.values() for name in entries})
+            numbers = {name: i for i, name in enumerate(names)}
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, *self.chunk, len(names), len(self.chunks)))
+                for name in names:
+                    raw = name.encode("UTF-8")
+                    f.write(NAME_LENGTH.pack(len(raw)))
+                    f.write(raw)
+                exclude = sorted(self.exclude)
+                f.write(NAME_LENGTH.pack(len(exclude)))
+                for name in exclude:
+                    raw = name.encode("UTF-8")
+                    f.write(NAME_LENGTH.pack(len(raw)))
+                    f.write(raw)
+                for key, entries in self.chunks.items():
+                    f.write(CHUNK_HEADER.pack(*key, len(entries)))
+                    for name, offsets in entries.items():
+                        f.write(ENTRY_HEADER.pack(numbers[name], len(offsets)))
+                        f.write(_le(offsets).tobytes())
+
+    @staticmethod
+    def load(path) -> "BlockIndex":
+        """Загрузить индекс, сохраненный save()"""
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a block index" % path)
+            _, cx, cy, cz, name_count, chunk_count = HEADER.unpack(header)
+
+            def read_name():
+                length, = NAME_LENGTH.unpack(f.read(NAME_LENGTH.size))
+                return f.read(length).decode("UTF-8")
+
+            names = [read_name() for _ in range(name_count)]
+            exclude_count, = NAME_LENGTH.unpack(f.read(NAME_LENGTH.size))
+            index = BlockIndex((cx, cy, cz), [read_name() for _ in range(exclude_count)])
+            for _ in range(chunk_count):
+                x, y, z, entry_count = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+                entries = {}
+                for _ in range(entry_count):
+                    number, count = ENTRY_HEADER.unpack(f.read(ENTRY_HEADER.size))
+                    offsets = array("H")
+                    offsets.frombytes(f.read(2 * count))
+                    entries[names[number]] = _le(offsets)
+                index.chunks[(x, y, z)] = entries
+        return index
+
+
+def _offsets(raw, wanted, exclude):
+    """getBlocks answer => {name: array('H') of offsets}; wanted=None keeps all
+    names except exclude"""
+    values = raw.split(b",")
+    if numpy is not None:
+        names, inverse = numpy.unique(numpy.array(values), return_inverse=True)
+        order = numpy.argsort(inverse, kind="stable")
+        bounds = numpy.searchsorted(inverse[order], numpy.arange(len(names) + 1))
+        entries = {}
+        for i, name in enumerate(names.tolist()):
+            name = name.decode("UTF-8")
+            if (wanted is not None and name not in wanted) or (wanted is None and name in exclude):
+                continue
+            entries[name] = array("H", order[bounds[i]:bounds[i + 1]].astype(numpy.uint16).tobytes())
+        return entries
+    entries = {}
+    for i, value in enumerate(values):
+        name = value.decode("UTF-8")
+        if (wanted is not None and name not in wanted) or (wanted is None and name in exclude):
+            continue
+        offsets = entries.get(name)
+        if offsets is None:
+            offsets = entries[name] = array("H")
+        offsets.append(i)
+    return entries
+
+
+def _raw(s):
+    return s
+
+
+def _scan(conn, boxes, wanted, exclude, window):
+    """Reads the chunks boxes [(key, lo, hi)] over one connection => [(key, entries)]"""
+    with conn.connection() as c:
+        pipeline = Pipeline(c, window)
+        results = [(key, pipeline.query(_raw, b"world.getBlocks", lo, hi)) for key, lo, hi in boxes]
+        pipeline.execute()
+    return [(key, _offsets(result.result(), wanted, exclude)) for key, result in results]
+
+
+def find_blocks(mc, p0, p1, blocks, index=None, workers=None, batch=16, window=64) -> dict:
+    """Найти блоки blocks (имена) в кубоиде p0..p1 => {имя: Vec3Array координат}
+
+    index: BlockIndex - прочитанные чанки добавляются в него, уже
+    известные не читаются. workers: число потоков (по умолчанию - размер
+    ConnectionPool, иначе 1). batch: чанков в одном конвейере."""
+    if isinstance(blocks, str):
+        blocks = [blocks]
+    wanted = frozenset(blocks)
+    lo, hi = normalize_cuboid(p0, p1)
+    chunk = index.chunk if index is not None else DEFAULT_CHUNK
+    grid = index if index is not None else BlockIndex(chunk)
+    if index is not None and wanted & index.exclude:
+        raise ValueError("%s are not kept by the index" % ", ".join(sorted(wanted & index.exclude)))
+
+    found = {}
+    todo = []
+    for key in grid.keys(lo, hi):
+        entries = index.chunks.get(key) if index is not None else None
+        if entries is not None:
+            found[key] = entries
+            continue
+        a, b = grid.bounds(key)
+        if index is None:
+            # Only the part inside the region, it is not kept anyway
+            a = tuple(max(u, v) for u, v in zip(a, lo))
+            b = tuple(min(u, v) for u, v in zip(b, hi))
+        todo.append((key, a, b))
+
+    if todo:
+        conn = mc.conn
+        if workers is None:
+            workers = conn.size if isinstance(conn, ConnectionPool) else 1
+        batches = [todo[i:i + batch] for i in range(0, len(todo), batch)]
+        scan_wanted = None if index is not None else wanted
+        exclude = index.exclude if index is not None else frozenset()
+        if workers <= 1 or len(batches) == 1:
+            scanned = [_scan(conn, b, scan_wanted, exclude, window) for b in batches]
+        else:
+            with ThreadPoolExecutor(min(workers, len(batches)), thread_name_prefix="find_blocks") as pool:
+                scanned = list(pool.map(lambda b: _scan(conn, b, scan_wanted, exclude, window), batches))
+        shapes = {key: (a, b) for key, a, b in todo}
+        for part in scanned:
+            for key, entries in part:
+                if index is not None:
+                    index.put(key, entries)
+                found[key] = entries
+    else:
+        shapes = {}
+
+    columns = {name: ([], [], []) for name in blocks}
+    for key, entries in found.items():
+        a, b = shapes.get(key) or grid.bounds(key)
+        sx, sz = b[0] - a[0] + 1, b[2] - a[2] + 1
+        for name in wanted:
+            offsets = entries.get(name)
+            if not offsets:
+                continue
+            xs, ys, zs = columns[name]
+            if numpy is not None:
+                o = numpy.frombuffer(offsets, dtype=numpy.uint16).astype(numpy.int64)
+                y, x, z = o // (sx * sz) + a[1], o // sz % sx + a[0], o % sz + a[2]
+                inside = ((x >= lo[0]) & (x <= hi[0]) & (y >= lo[1]) & (y <= hi[1]) &
+                          (z >= lo[2]) & (z <= hi[2]))
+                xs.append(x[inside])
+                ys.append(y[inside])
+                zs.append(z[inside])
+                continue
+            for o in offsets:
+                y, x, z = o // (sx * sz) + a[1], o // sz % sx + a[0], o % sz + a[2]
+                if lo[0] <= x <= hi[0] and lo[1] <= y <= hi[1] and lo[2] <= z <= hi[2]:
+                    xs.append(x)
+                    ys.append(y)
+                    zs.append(z)
+    result = {}
+    for name, (xs, ys, zs) in columns.items():
+        if numpy is not None:
+            xs, ys, zs = [numpy.concatenate(c) if c else numpy.empty(0, dtype=numpy.int64) for c in (xs, ys, zs)]
+        result[name] = Vec3Array(xs, ys, zs)
+    return result
+
+
+def test_search():
+    import os
+    import random
+    import tempfile
+
+    from .emulator import EmulatorServer, World
+
+    world = World(ground=0)
+    rnd = random.Random(1)
+    ores = set()
+    for _ in range(200):
+        p = (rnd.randint(-40, 40), rnd.randint(-5, 30), rnd.randint(-40, 40))
+        world.set_block(*p, b"diamond_ore")
+        ores.add(p)
+    p0, p1 = (-37, -3, -30), (35, 28, 39)
+    wanted = {p for p in ores if all(a <= c <= b for a, c, b in zip(p0, p, p1))}
+
+    def points(found):
+        return {(int(v.x), int(v.y), int(v.z)) for v in found}
+
+    with EmulatorServer(world=world) as server, tempfile.TemporaryDirectory() as tmp:
+        # One connection and a pool of them find the same blocks
+        for pool_size in (None, 3):
+            mc = server.minecraft(pool_size=pool_size)
+            assert points(mc.find_blocks(p1, p0, "diamond_ore")["diamond_ore"]) == wanted
+
+        index = BlockIndex()
+        found = mc.find_blocks(p0, p1, ["diamond_ore", "stone"], index=index)
+        assert points(found["diamond_ore"]) == wanted
+        assert len(found["stone"]) == 73 * 3 * 70 - len([p for p in wanted if p[1] < 0])
+        assert len(index) == 6 * 3 * 5
+
+        # Save and load: the loaded index answers without the server
+        path = os.path.join(tmp, "index.bin")
+        index.save(path)
+        loaded = BlockIndex.load(path)
+        assert loaded.chunk == index.chunk and loaded.exclude == index.exclude
+        assert sorted(loaded.chunks) == sorted(index.chunks)
+        for key, entries in index.chunks.items():
+            assert {name: list(o) for name, o in loaded.chunks[key].items()} == \
+                {name: list(o) for name, o in entries.items()}
+        assert points(find_blocks(None, p0, p1, "diamond_ore", index=loaded)["diamond_ore"]) == wanted
+        try:
+            find_blocks(None, p0, p1, "air", index=loaded)
+            assert False
+        except ValueError:
+            pass
+
+        # Invalidated chunks are read again and see the new blocks
+        world.set_block(0, 0, 0, b"diamond_ore")
+        loaded.invalidate((0, 0, 0), (0, 0, 0))
+        assert len(loaded) == len(index) - 1
+        assert points(mc.find_blocks(p0, p1, "diamond_ore", index=loaded)["diamond_ore"]) == wanted | {(0, 0, 0)}
+
+        with open(path, "wb") as f:
+            f.write(b"garbage")
+        try:
+            BlockIndex.load(path)
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_search()
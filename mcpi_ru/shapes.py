@@ -0,0 +1,381 @@
+import math
+
+from .minecraft import int_floor
+from .vec3 import Vec3
+from .volume import merge_cuboids
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Rasterized shapes.
+
+    Every function returns a Shape: the blocks of the shape as a boolean
+    mask over its bounding cuboid (a numpy array of shape (ny, nx, nz) when
+    numpy is installed, a flat bytearray in y, x, z order otherwise).
+    Shape.cuboids() coalesces the blocks into few axis-aligned cuboids, so
+    that drawing costs one world.setBlocks per cuboid instead of one
+    world.setBlock per block:
+
+    mc.draw(shapes.sphere((0, 80, 0), 50, hollow=True), "glass")
+
+    Blocks are the voxels whose centers lie inside the shape."""
+
+
+class Shape:
+    """Блоки фигуры.
+
+    origin: Vec3 минимального угла, size: (nx, ny, nz),
+    mask: True для блоков фигуры, в порядке [y][x][z]."""
+
+    def __init__(self, origin, size, mask):
+        self.origin = Vec3(*origin)
+        self.size = tuple(size)
+        self.mask = mask
+
+    def __len__(self):
+        if numpy is not None and isinstance(self.mask, numpy.ndarray):
+            return int(numpy.count_nonzero(self.mask))
+        return self.mask.count(1)
+
+    def __repr__(self):
+        return "Shape(%s, %s, %d blocks)" % (self.origin, self.size, len(self))
+
+    def translate(self, *args) -> "Shape":
+        """Та же фигура, сдвинутая на (dx, dy, dz)"""
+        dx, dy, dz = int_floor(args)
+        o = self.origin
+        return Shape((o.x + dx, o.y + dy, o.z + dz), self.size, self.mask)
+
+    def points(self) -> list:
+        """Координаты всех блоков [(x, y, z)]"""
+        ox, oy, oz = self.origin.x, self.origin.y, self.origin.z
+        if numpy is not None and isinstance(self.mask, numpy.ndarray):
+            y, x, z = numpy.nonzero(self.mask)
+            return list(zip((x + ox).tolist(), (y + oy).tolist(), (z + oz).tolist()))
+        nx, ny, nz = self.size
+        return [(ox + i // nz % nx, oy + i // (nx * nz), oz + i % nz)
+                for i, v in enumerate(self.mask) if v]
+
+    def cuboids(self) -> list:
+        """Блоки фигуры, объединенные в кубоиды => [((x0, y0, z0), (x1, y1, z1))]"""
+        if numpy is not None and isinstance(self.mask, numpy.ndarray):
+            boxes = mask_cuboids(self.mask)
+        else:
+            boxes = [(a, b) for a, b, _ in merge_cuboids([True if v else None for v in self.mask], self.size)]
+        ox, oy, oz = self.origin.x, self.origin.y, self.origin.z
+        return [((ox + x0, oy + y0, oz + z0), (ox + x1, oy + y1, oz + z1)) for (x0, y0, z0), (x1, y1, z1) in boxes]
+
+
+def _segments(keys, position):
+    """Rows sorted by keys then position => start index of every run of equal
+    keys with consecutive positions"""
+    n = len(position)
+    brk = numpy.ones(n, dtype=bool)
+    if n > 1:
+        same = numpy.ones(n - 1, dtype=bool)
+        for k in keys:
+            same &= k[1:] == k[:-1]
+        brk[1:] = ~(same & (position[1:] == position[:-1] + 1))
+    return numpy.flatnonzero(brk)
+
+
+def mask_cuboids(mask) -> list:
+    """Vectorized merge of a boolean numpy mask (ny, nx, nz) into cuboids:
+    runs along z, then equal runs of neighbouring rows along x, then equal
+    rectangles of neighbouring layers along y.
+    => [((x0, y0, z0), (x1, y1, z1))], corners inclusive, relative to the mask"""
+    ny, nx, nz = mask.shape
+    if not mask.any():
+        return []
+    padded = numpy.zeros((ny, nx, nz + 2), dtype=numpy.int8)
+    padded[:, :, 1:-1] = mask
+    edges = numpy.diff(padded, axis=2)
+    y, x, z0 = numpy.nonzero(edges == 1)
+    z1 = numpy.nonzero(edges == -1)[2] - 1  # same (y, x) row order, one end per start
+
+    # Rows -> rectangles: runs with the same y, z0, z1 in consecutive x
+    order = numpy.lexsort((x, z1, z0, y))
+    y, x, z0, z1 = y[order], x[order], z0[order], z1[order]
+    starts = _segments((y, z0, z1), x)
+    ends = numpy.append(starts[1:], len(x)) - 1
+    y, x0, x1, z0, z1 = y[starts], x[starts], x[ends], z0[starts], z1[starts]
+
+    # Rectangles -> cuboids: the same x0, x1, z0, z1 in consecutive y
+    order = numpy.lexsort((y, z1, z0, x1, x0))
+    y, x0, x1, z0, z1 = y[order], x0[order], x1[order], z0[order], z1[order]
+    starts = _segments((x0, x1, z0, z1), y)
+    ends = numpy.append(starts[1:], len(y)) - 1
+    return list(zip(zip(x0[starts].tolist(), y[starts].tolist(), z0[starts].tolist()),
+                    zip(x1[starts].tolist(), y[ends].tolist(), z1[starts].tolist())))
+
+
+def _shell(mask, size, thickness, axes):
+    """Blocks of mask closer than thickness (6-neighbour steps along axes,
+    0 = y, 1 = x, 2 = z) to a block outside of it"""
+    if numpy is not None:
+        inner = mask.copy()
+        for _ in range(thickness):
+            eroded = inner.copy()
+            for axis in axes:
+                front = [slice(None)] * 3
+                back = [slice(None)] * 3
+                front[axis], back[axis] = slice(1, None), slice(None, -1)
+                eroded[tuple(front)] &= inner[tuple(back)]
+                eroded[tuple(back)] &= inner[tuple(front)]
+                edge = [slice(None)] * 3
+                edge[axis] = 0
+                eroded[tuple(edge)] = False
+                edge[axis] = -1
+                eroded[tuple(edge)] = False
+            inner = eroded
+        return mask & ~inner
+    nx, ny, nz = size
+    steps = {0: nx * nz, 1: nz, 2: 1}
+    dims = {0: ny, 1: nx, 2: nz}
+    inner = bytearray(mask)
+    for _ in range(thickness):
+        eroded = bytearray(inner)
+        for i, v in enumerate(inner):
+            if not v:
+                continue
+            coords = (i // (nx * nz), i // nz % nx, i % nz)
+            for axis in axes:
+                c, step = coords[axis], steps[axis]
+                if c == 0 or c == dims[axis] - 1 or not inner[i - step] or not inner[i + step]:
+                    eroded[i] = 0
+                    break
+        inner = eroded
+    return bytearray(a and not b for a, b in zip(mask, inner))
+
+
+def _grid(lo, size):
+    """Block coordinates of the cuboid: numpy broadcastable (y, x, z), or flat lists"""
+    nx, ny, nz = size
+    if numpy is not None:
+        y, x, z = numpy.ogrid[0:ny, 0:nx, 0:nz]
+        return x + lo[0], y + lo[1], z + lo[2]
+    return ([lo[0] + x for y in range(ny) for x in range(nx) for z in range(nz)],
+            [lo[1] + y for y in range(ny) for x in range(nx) for z in range(nz)],
+            [lo[2] + z for y in range(ny) for x in range(nx) for z in range(nz)])
+
+
+def box(p0, p1, hollow=False, thickness=1) -> Shape:
+    """Параллелепипед с углами p0, p1 (hollow - только стенки)"""
+    a, b = int_floor(p0), int_floor(p1)
+    lo = [min(u, v) for u, v in zip(a, b)]
+    size = [abs(u - v) + 1 for u, v in zip(a, b)]
+    nx, ny, nz = size
+    if numpy is not None:
+        mask = numpy.ones((ny, nx, nz), dtype=bool)
+    else:
+        mask = bytearray(b"\x01" * (nx * ny * nz))
+    if hollow:
+        mask = _shell(mask, size, thickness, (0, 1, 2))
+    return Shape(lo, size, mask)
+
+
+def sphere(center, radius, hollow=False, thickness=1) -> Shape:
+    """Шар с центром center и радиусом radius (hollow - только оболочка)"""
+    c = [float(v) for v in center]
+    # Centered on the block that contains center
+    cx, cy, cz = [math.floor(v) + 0.5 for v in c]
+    r = int(math.ceil(radius))
+    lo = [int(math.floor(v)) - r for v in c]
+    size = [2 * r + 1] * 3
+    x, y, z = _grid(lo, size)
+    r2 = radius * radius
+    if numpy is not None:
+        mask = (x + 0.5 - cx) ** 2 + (y + 0.5 - cy) ** 2 + (z + 0.5 - cz) ** 2 <= r2
+    else:
+        mask = bytearray((a + 0.5 - cx) ** 2 + (b + 0.5 - cy) ** 2 + (d + 0.5 - cz) ** 2 <= r2
+                         for a, b, d in zip(x, y, z))
+    if hollow:
+        mask = _shell(mask, size, thickness, (0, 1, 2))
+    return Shape(lo, size, mask)
+
+
+AXES = {"x": 1, "y": 0, "z": 2}
+
+
+def cylinder(base, radius, height, axis="y", hollow=False, thickness=1) -> Shape:
+    """Цилиндр: центр основания base, радиус radius, высота height вдоль оси
+    axis ("x", "y" или "z"). hollow - труба без оснований"""
+    if axis not in AXES:
+        raise ValueError("axis must be 'x', 'y' or 'z', not %r" % (axis,))
+    c = [float(v) for v in base]
+    r = int(math.ceil(radius))
+    lo = [int(math.floor(v)) - r for v in c]
+    size = [2 * r + 1] * 3
+    along = "xyz".index(axis)
+    length = int(height)
+    if length < 0:
+        lo[along] = int(math.floor(c[along])) + length + 1
+    else:
+        lo[along] = int(math.floor(c[along]))
+    size[along] = max(abs(length), 1)
+    x, y, z = _grid(lo, size)
+    centers = [math.floor(v) + 0.5 for v in c]
+    r2 = radius * radius
+    if numpy is not None:
+        coords = [x, y, z]
+        mask = numpy.zeros((size[1], size[0], size[2]), dtype=bool)
+        mask |= sum((coords[i] + 0.5 - centers[i]) ** 2 for i in range(3) if i != along) <= r2
+    else:
+        mask = bytearray(sum((p[i] + 0.5 - centers[i]) ** 2 for i in range(3) if i != along) <= r2
+                         for p in zip(x, y, z))
+    if hollow:
+        mask = _shell(mask, size, thickness, [AXES[a] for a in "xyz" if a != axis])
+    return Shape(lo, size, mask)
+
+
+def _line_points(p0, p1):
+    """Blocks of the 3-D Bresenham line p0..p1 as (xs, ys, zs): every coordinate
+    is rounded from the exact line at each step of the longest axis"""
+    a, b = int_floor(p0), int_floor(p1)
+    d = [v - u for u, v in zip(a, b)]
+    n = max(abs(v) for v in d)
+    if n == 0:
+        return [[a[0]], [a[1]], [a[2]]]
+    if numpy is not None:
+        t = numpy.arange(n + 1)
+        return [u + numpy.floor_divide(2 * t * dv + n, 2 * n) for u, dv in zip(a, d)]
+    return [[u + (2 * t * dv + n) // (2 * n) for t in range(n + 1)] for u, dv in zip(a, d)]
+
+
+def _from_points(xs, ys, zs) -> Shape:
+    if numpy is not None:
+        xs, ys, zs = numpy.asarray(xs), numpy.asarray(ys), numpy.asarray(zs)
+        lo = [int(xs.min()), int(ys.min()), int(zs.min())]
+        size = [int(xs.max()) - lo[0] + 1, int(ys.max()) - lo[1] + 1, int(zs.max()) - lo[2] + 1]
+        mask = numpy.zeros((size[1], size[0], size[2]), dtype=bool)
+        mask[ys - lo[1], xs - lo[0], zs - lo[2]] = True
+        return Shape(lo, size, mask)
+    lo = [min(xs), min(ys), min(zs)]
+    size = [max(xs) - lo[0] + 1, max(ys) - lo[1] + 1, max(zs) - lo[2] + 1]
+    nx, nz = size[0], size[2]
+    mask = bytearray(size[0] * size[1] * size[2])
+    for x, y, z in zip(xs, ys, zs):
+        mask[((y - lo[1]) * nx + x - lo[0]) * nz + z - lo[2]] = 1
+    return Shape(lo, size, mask)
+
+
+def line(p0, p1) -> Shape:
+    """Отрезок от p0 до p1 (3-D Брезенхем)"""
+    return _from_points(*_line_points(p0, p1))
+
+
+def polyline(points, closed=False) -> Shape:
+    """Ломаная через points (closed - замкнутая)"""
+    points = list(points)
+    if closed and len(points) > 2:
+        points.append(points[0])
+    if len(points) == 1:
+        return line(points[0], points[0])
+    parts = [_line_points(a, b) for a, b in zip(points, points[1:])]
+    if numpy is not None:
+        return _from_points(*[numpy.concatenate([p[i] for p in parts]) for i in range(3)])
+    return _from_points(*[sum((p[i] for p in parts), []) for i in range(3)])
+
+
+def polygon(points, y, height=1, hollow=False) -> Shape:
+    """Многоугольник с вершинами points [(x, z)] в плоскости y, вытянутый
+    вверх на height блоков. hollow - только стенки по контуру"""
+    points = [(float(px), float(pz)) for px, pz in points]
+    if len(points) < 3:
+        raise ValueError("A polygon needs at least 3 points")
+    y0 = int(math.floor(y))
+    ny = max(int(height), 1)
+    edge = polyline([(px, y0, pz) for px, pz in points], closed=True)
+    if hollow:
+        lo, (nx, _, nz) = edge.origin, edge.size
+        if numpy is not None:
+            mask = numpy.repeat(edge.mask, ny, axis=0)
+        else:
+            mask = edge.mask * ny
+        return Shape((lo.x, y0, lo.z), (nx, ny, nz), mask)
+
+    lo = [int(math.floor(min(p[0] for p in points))), y0, int(math.floor(min(p[1] for p in points)))]
+    nx = int(math.floor(max(p[0] for p in points))) - lo[0] + 1
+    nz = int(math.floor(max(p[1] for p in points))) - lo[2] + 1
+    edges = list(zip(points, points[1:] + points[:1]))
+    if numpy is not None:
+        # Even-odd rule for the block centers, all edges against all blocks at once
+        px = (numpy.arange(nx) + lo[0] + 0.5)[:, None]
+        pz = (numpy.arange(nz) + lo[2] + 0.5)[None, :]
+        inside = numpy.zeros((nx, nz), dtype=bool)
+        for (ax, az), (bx, bz) in edges:
+            if az == bz:
+                continue
+            crosses = (az > pz) != (bz > pz)
+            x_at = ax + (pz - az) * (bx - ax) / (bz - az)
+            inside ^= crosses & (px < x_at)
+        # The outline itself belongs to the polygon
+        ox, oz = edge.origin.x - lo[0], edge.origin.z - lo[2]
+        ex, _, ez = edge.size
+        inside[ox:ox + ex, oz:oz + ez] |= edge.mask[0]
+        mask = numpy.repeat(inside[None, :, :], ny, axis=0)
+        return Shape(lo, (nx, ny, nz), mask)
+
+    layer = bytearray(nx * nz)
+    for i in range(nx):
+        cx = lo[0] + i + 0.5
+        for k in range(nz):
+            cz = lo[2] + k + 0.5
+            inside = False
+            for (ax, az), (bx, bz) in edges:
+                if (az > cz) != (bz > cz) and cx < ax + (cz - az) * (bx - ax) / (bz - az):
+                    inside = not inside
+            layer[i * nz + k] = inside
+    ex, _, ez = edge.size
+    for i in range(ex):
+        for k in range(ez):
+            if edge.mask[i * ez + k]:
+                layer[(edge.origin.x - lo[0] + i) * nz + edge.origin.z - lo[2] + k] = 1
+    return Shape(lo, (nx, ny, nz), layer * ny)
+
+
+def test_shapes():
+    from .emulator import EmulatorServer, World
+
+    def covered(boxes):
+        blocks = []
+        for (x0, y0, z0), (x1, y1, z1) in boxes:
+            blocks += [(x, y, z) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) for z in range(z0, z1 + 1)]
+        return blocks
+
+    # Cuboids cover every block of the shape exactly once
+    for shape in (box((0, 0, 0), (4, 3, 2)), box((0, 0, 0), (5, 5, 5), hollow=True), sphere((0, 0, 0), 4.5),
+                  sphere((1, 2, 3), 6, hollow=True), cylinder((0, 0, 0), 3, -5, axis="x"),
+                  polygon([(0, 0), (8, 0), (4, 6)], 10, 2), line((0, 0, 0), (7, -3, 12))):
+        boxes = shape.cuboids()
+        blocks = covered(boxes)
+        assert len(blocks) == len(set(blocks)) == len(shape)
+        assert sorted(blocks) == sorted(shape.points())
+        if numpy is not None:
+            # The same as the merge of the plain mask
+            flat = bytearray(shape.mask.ravel().tolist())
+            assert sorted(covered(Shape(shape.origin, shape.size, flat).cuboids())) == sorted(blocks)
+
+    # Greedy merging: a box is one cuboid, its shell six slabs at most
+    assert box((0, 0, 0), (9, 9, 9)).cuboids() == [((0, 0, 0), (9, 9, 9))]
+    shell = box((0, 0, 0), (9, 9, 9), hollow=True)
+    assert len(shell) == 1000 - 512 and len(shell.cuboids()) <= 6
+    assert len(box((0, 0, 0), (9, 9, 9), hollow=True, thickness=2)) == 1000 - 216
+    assert len(line((0, 0, 0), (10, 0, 0)).cuboids()) == 1
+
+    # Drawing places exactly the blocks of the shape
+    world = World(ground=0)
+    with EmulatorServer(world=world) as server:
+        mc = server.minecraft()
+        ball = sphere((0, 20, 0), 5, hollow=True)
+        assert mc.draw(ball, "glass") == len(ball.cuboids())
+        mc.get_player_entity_ids()  # answered after the writes are done
+        drawn = [(x, y, z) for x in range(-6, 7) for y in range(14, 27) for z in range(-6, 7)
+                 if world.get_block(x, y, z) == b"glass"]
+        assert sorted(drawn) == sorted(ball.points())
+
+
+if __name__ == "__main__":
+    test_shapes()
@@ -0,0 +1,324 @@
+import heapq
+import math
+import threading
+import time
+import traceback
+
+from .snapshot import snapshot
+from .vec3 import Vec3
+
+""" Local nearest and range queries over entities.
+
+    EntityIndex keeps the ids, types and positions of the entities around a
+    point in a uniform grid of cubic cells. refresh() asks
+    world.getNearbyEntities for the list (every list_every frames) and the
+    positions of all of them in one pipeline (every frame); only entities
+    that moved to another cell are moved in the grid. Queries are answered
+    from the grid without going to the server:
+
+    index = mc.entity_index(lambda: mc.player.get_pos(), distance=64).start()
+    for entity_id, distance in index.nearest(mc.player.get_pos(), k=3):
+        ...
+
+    An EntityTracker snapshot (or any EntitySnapshot with "pos") can be fed
+    with update() instead."""
+
+
+class EntityIndex:
+    """Сетка сущностей: id, тип и позиция, запросы nearest/within/in_box.
+
+    center: точка (x, y, z) для getNearbyEntities или функция, которая ее
+    возвращает; distance: радиус поиска (None - по умолчанию сервера).
+    cell: размер ячейки сетки. rate: кадров в секунду фонового обновления,
+    list_every: раз в сколько кадров обновлять список сущностей."""
+
+    def __init__(self, mc, center=None, distance=None, cell=8.0, rate=10.0, list_every=5):
+        self.mc = mc
+        self.center = center
+        self.distance = distance
+        self.cell = float(cell)
+        self.rate = rate
+        self.list_every = max(1, int(list_every))
+        self.entities = []
+        self.frames = 0
+        self.errors = 0
+        self.frame_time = 0.0
+        self.updated = None
+        self._items = {}   # id -> [x, y, z, type, cell]
+        self._grid = {}    # cell -> {id}
+        self._bounds = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, entity_id):
+        return str(entity_id) in self._items
+
+    def __repr__(self):
+        return "EntityIndex(%d entities, cell=%s)" % (len(self), self.cell)
+
+    # -- filling --
+
+    def _key(self, x, y, z):
+        cell = self.cell
+        return int(math.floor(x / cell)), int(math.floor(y / cell)), int(math.floor(z / cell))
+
+    def _remove(self, entity_id):
+        item = self._items.pop(entity_id, None)
+        if item is not None:
+            ids = self._grid[item[4]]
+            ids.discard(entity_id)
+            if not ids:
+                del self._grid[item[4]]
+
+    def update(self, snap, complete=True):
+        """Принять EntitySnapshot с полем pos.
+
+        complete=True: в снимке все сущности, остальные удаляются из индекса;
+        иначе обновляются только сущности снимка."""
+        if snap.pos is None:
+            raise ValueError("The snapshot has no positions")
+        xs, ys, zs = snap.pos.tolist_x(), snap.pos.tolist_y(), snap.pos.tolist_z()
+        missing = {str(e) for e in snap.missing}
+        with self._lock:
+            seen = set()
+            for entity_id, type_name, x, y, z in zip(snap.ids, snap.types, xs, ys, zs):
+                entity_id = str(entity_id)
+                if entity_id in missing:
+                    self._remove(entity_id)
+                    continue
+                seen.add(entity_id)
+                key = self._key(x, y, z)
+                item = self._items.get(entity_id)
+                if item is not None and item[4] == key:
+                    item[0], item[1], item[2] = x, y, z
+                    if type_name is not None:
+                        item[3] = type_name
+                    continue
+                if item is not None:
+                    self._remove(entity_id)
+                    type_name = type_name if type_name is not None else item[3]
+                self._items[entity_id] = [x, y, z, type_name, key]
+                self._grid.setdefault(key, set()).add(entity_id)
+            if complete:
+                for entity_id in [e for e in self._items if e not in seen]:
+                    self._remove(entity_id)
+            if self._grid:
+                keys = list(self._grid)
+                self._bounds = tuple(min(k[i] for k in keys) for i in range(3)), \
+                    tuple(max(k[i] for k in keys) for i in range(3))
+            else:
+                self._bounds = None
+            self.updated = snap.time
+
+    def refresh(self):
+        """Один кадр: список сущностей (каждые list_every кадров) и их позиции"""
+        start = time.perf_counter()
+        if self.center is not None and (self.frames % self.list_every == 0 or not self.entities):
+            center = self.center() if callable(self.center) else self.center
+            args = tuple(center) if self.distance is None else tuple(center) + (self.distance,)
+            self.entities = self.mc.get_nearby_entities(*args)
+        self.update(snapshot(self.mc.conn, self.entities, ("pos",)))
+        self.frames += 1
+        self.frame_time = time.perf_counter() - start
+
+    # -- queries --
+
+    def position(self, entity_id) -> Vec3:
+        with self._lock:
+            x, y, z = self._items[str(entity_id)][:3]
+        return Vec3(x, y, z)
+
+    def type_of(self, entity_id):
+        with self._lock:
+            return self._items[str(entity_id)][3]
+
+    def _cells(self, lo, hi):
+        """Ids in the cells between lo and hi (cell keys), clipped to the grid"""
+        if self._bounds is None:
+            return
+        blo, bhi = self._bounds
+        ranges = [range(max(a, b), min(c, d) + 1) for a, b, c, d in zip(lo, blo, hi, bhi)]
+        grid = self._grid
+        if len(ranges[0]) * len(ranges[1]) * len(ranges[2]) > len(grid):
+            # Fewer occupied cells than cells in the box
+            for key, ids in grid.items():
+                if all(a <= k <= b for a, k, b in zip(lo, key, hi)):
+                    yield from ids
+            return
+        for cx in ranges[0]:
+            for cy in ranges[1]:
+                for cz in ranges[2]:
+                    ids = grid.get((cx, cy, cz))
+                    if ids:
+                        yield from ids
+
+    def in_box(self, p0, p1, type_name=None) -> list:
+        """Сущности внутри параллелепипеда p0..p1 => [id]"""
+        lo = [min(a, b) for a, b in zip(p0, p1)]
+        hi = [max(a, b) for a, b in zip(p0, p1)]
+        found = []
+        with self._lock:
+            items = self._items
+            for entity_id in self._cells(self._key(*lo), self._key(*hi)):
+                x, y, z, t, _ = items[entity_id]
+                if lo[0] <= x <= hi[0] and lo[1] <= y <= hi[1] and lo[2] <= z <= hi[2] and \
+                        (type_name is None or t == type_name):
+                    found.append(entity_id)
+        return found
+
+    def within(self, pos, r, type_name=None) -> list:
+        """Сущности на расстоянии не больше r от pos => [(id, расстояние)] по возрастанию"""
+        px, py, pz = pos
+        r2 = r * r
+        found = []
+        with self._lock:
+            items = self._items
+            for entity_id in self._cells(self._key(px - r, py - r, pz - r), self._key(px + r, py + r, pz + r)):
+                x, y, z, t, _ = items[entity_id]
+                d2 = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                if d2 <= r2 and (type_name is None or t == type_name):
+                    found.append((math.sqrt(d2), entity_id))
+        found.sort()
+        return [(entity_id, d) for d, entity_id in found]
+
+    def nearest(self, pos, k=1, type_name=None, max_distance=None) -> list:
+        """k ближайших к pos сущностей => [(id, расстояние)] по возрастанию"""
+        px, py, pz = pos
+        with self._lock:
+            if self._bounds is None or k <= 0:
+                return []
+            items = self._items
+            center = self._key(px, py, pz)
+            blo, bhi = self._bounds
+            # Rings of cells around the cell of pos; the grid ends at `last`
+            last = max(max(abs(c - b) for c, b in zip(center, blo)),
+                       max(abs(c - b) for c, b in zip(center, bhi)))
+            best = []  # heap of (-d2, id), the k closest so far
+            for ring in range(last + 1):
+                if len(best) == k and -best[0][0] <= ((ring - 1) * self.cell) ** 2:
+                    break  # nothing in this ring or further can be closer
+                if max_distance is not None and (ring - 1) * self.cell > max_distance:
+                    break
+                lo = [c - ring for c in center]
+                hi = [c + ring for c in center]
+                for entity_id in self._cells(lo, hi):
+                    x, y, z, t, key = items[entity_id]
+                    if max(abs(a - b) for a, b in zip(key, center)) != ring:
+                        continue  # seen in an inner ring
+                    if type_name is not None and t != type_name:
+                        continue
+                    d2 = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                    if max_distance is not None and d2 > max_distance * max_distance:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-d2, entity_id))
+                    elif d2 < -best[0][0]:
+                        heapq.heapreplace(best, (-d2, entity_id))
+        return [(entity_id, math.sqrt(-d2)) for d2, entity_id in sorted(best, reverse=True)]
+
+    # -- background refresh --
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_frame = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                if self._stop.is_set():
+                    break
+                self.errors += 1
+                traceback.print_exc()
+            next_frame = max(next_frame + period, time.perf_counter())
+            self._stop.wait(next_frame - time.perf_counter())
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="EntityIndex", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "errors": self.errors,
+            "frame_time": self.frame_time,
+            "entities": len(self._items),
+            "cells": len(self._grid),
+        }
+
+
+def test_spatial():
+    import random
+
+    from .emulator import EmulatorServer, World
+
+    world = World(ground=0)
+    rnd = random.Random(2)
+    for _ in range(300):
+        world.spawn_entity(rnd.choice(["zombie", "pig"]), rnd.uniform(-60, 60), rnd.uniform(0, 20),
+                           rnd.uniform(-60, 60))
+    # On cell borders and in one far cell, so the rings have to reach past empty cells
+    for x in (-16.0, 0.0, 8.0, 24.0):
+        world.spawn_entity("pig", x, 8.0, 0.0)
+    world.spawn_entity("cow", 300.0, 5.0, 300.0)
+
+    with EmulatorServer(world=world) as server:
+        mc = server.minecraft()
+        index = mc.entity_index((0, 0, 0), distance=1000, cell=8)
+        index.refresh()
+        assert len(index) == 305
+        positions = {str(e.id): index.position(e.id) for e in mc.get_nearby_entities(0, 0, 0, 1000)}
+
+        def closest(p, k, type_name=None, max_distance=None):
+            found = sorted((math.dist(p, tuple(v)), e) for e, v in positions.items()
+                           if type_name is None or index.type_of(e) == type_name)
+            return [e for d, e in found if max_distance is None or d <= max_distance][:k]
+
+        # The ring search stops only when nothing further out can be closer
+        for _ in range(200):
+            p = (rnd.uniform(-90, 90), rnd.uniform(-10, 30), rnd.uniform(-90, 90))
+            k = rnd.randint(1, 6)
+            assert [e for e, _ in index.nearest(p, k)] == closest(p, k)
+            assert [e for e, _ in index.nearest(p, k, "pig")] == closest(p, k, "pig")
+            assert [e for e, _ in index.nearest(p, k, max_distance=12)] == closest(p, k, max_distance=12)
+            r = rnd.uniform(1, 30)
+            assert [e for e, _ in index.within(p, r)] == closest(p, len(positions), max_distance=r)
+            q = (p[0] + 20, p[1] + 10, p[2] + 15)
+            assert sorted(index.in_box(q, p)) == sorted(
+                e for e, v in positions.items() if all(a <= c <= b for a, c, b in zip(p, tuple(v), q)))
+        for p in ((8.0, 8.0, 0.0), (-16.0, 8.0, 0.0), (1000.0, 0.0, 1000.0), (-500.0, 0.0, -500.0)):
+            assert [e for e, _ in index.nearest(p, 3)] == closest(p, 3)
+        cow, = [e for e in positions if index.type_of(e) == "cow"]
+        assert index.nearest((0, 0, 0), 1, "cow")[0][0] == cow
+        assert index.nearest((0, 0, 0), 1, "cow", max_distance=100) == []
+        assert len(index.nearest((0, 0, 0), 1000)) == 305 and index.nearest((0, 0, 0), 0) == []
+
+        # Moved and removed entities
+        moved, gone = list(positions)[:2]
+        mc.entity.set_pos(moved, 200, 5, 200)
+        mc.remove_entity(gone)
+        index.refresh()
+        assert len(index) == 304 and gone not in index
+        assert index.nearest((200, 5, 200), 1)[0] == (moved, 0.0)
+
+
+if __name__ == "__main__":
+    test_spatial()
@@ -0,0 +1,274 @@
+import asyncio
+import queue
+import threading
+import traceback
+
+from .event import BlockEvent, ChatEvent, ProjectileEvent
+from .pipeline import Pipeline
+
+""" Background event polling.
+
+    The three event queues of the server are polled together in one
+    pipelined batch. The interval between polls drops to min_interval as
+    soon as events arrive and grows by backoff up to max_interval while
+    nothing happens. Events go to the handlers registered for their class
+    and, if requested, to a queue that can be iterated:
+
+    stream = EventStream(mc)
+    @stream.on_chat_post
+    def echo(event):
+        mc.post_to_chat(event.message)
+    stream.start()"""
+
+_STOP = object()
+
+
+class _EventDispatch:
+    """Handlers, queue and adaptive interval shared by the thread and asyncio streams"""
+
+    def __init__(self, mc, min_interval, max_interval, backoff, queue_size):
+        self.mc = mc
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.handlers = {BlockEvent: [], ChatEvent: [], ProjectileEvent: []}
+        self.queue = queue.Queue(queue_size) if queue_size is not None else None
+        self.polls = 0
+        self.events = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def on(self, event_class, handler):
+        """Вызывать handler(event) для событий класса event_class"""
+        self.handlers[event_class].append(handler)
+        return handler
+
+    def on_block_hit(self, handler):
+        return self.on(BlockEvent, handler)
+
+    def on_chat_post(self, handler):
+        return self.on(ChatEvent, handler)
+
+    def on_projectile_hit(self, handler):
+        return self.on(ProjectileEvent, handler)
+
+    def _dispatch(self, block_hits, chat_posts, projectile_hits):
+        self.polls += 1
+        cache = getattr(self.mc, "cache", None)
+        if cache is not None:
+            for e in block_hits:
+                cache.invalidate(e.x, e.y, e.z)
+        count = 0
+        for events in (block_hits, chat_posts, projectile_hits):
+            for e in events:
+                count += 1
+                for handler in self.handlers[type(e)]:
+                    try:
+                        handler(e)
+                    except Exception:
+                        self.errors += 1
+                        traceback.print_exc()
+                if self.queue is not None:
+                    try:
+                        self.queue.put_nowait(e)
+                    except queue.Full:
+                        self.dropped += 1
+        self.events += count
+        if count:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def _poll_failed(self):
+        self.errors += 1
+        self.interval = self.max_interval
+        traceback.print_exc()
+
+    def __iter__(self):
+        """События из очереди (queue_size), пока поток не остановлен"""
+        if self.queue is None:
+            raise RuntimeError("The stream was created without a queue (queue_size)")
+        while True:
+            e = self.queue.get()
+            if e is _STOP:
+                return
+            yield e
+
+    def _close_queue(self):
+        if self.queue is not None:
+            while True:
+                try:
+                    self.queue.put_nowait(_STOP)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def stats(self) -> dict:
+        return {
+            "polls": self.polls,
+            "events": self.events,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "interval": self.interval,
+        }
+
+
+class EventStream(_EventDispatch):
+    """Опрос событий в фоновом потоке.
+
+    mc: Minecraft. queue_size: если указан, события также складываются в
+    очередь, которую можно перебирать (for event in stream)."""
+
+    def __init__(self, mc, min_interval=0.02, max_interval=1.0, backoff=1.5, queue_size=None):
+        _EventDispatch.__init__(self, mc, min_interval, max_interval, backoff, queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Один опрос всех очередей событий сервера одним пакетом"""
+        pipeline = Pipeline(self.mc.conn)
+        block_hits = pipeline.events.poll_block_hits()
+        chat_posts = pipeline.events.poll_chat_posts()
+        projectile_hits = pipeline.events.poll_projectile_hits()
+        pipeline.execute()
+        self._dispatch(block_hits.result(), chat_posts.result(), projectile_hits.result())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                if self._stop.is_set():
+                    break
+                self._poll_failed()
+            self._stop.wait(self.interval)
+        self._close_queue()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="EventStream", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class AsyncEventStream(_EventDispatch):
+    """Опрос событий задачей asyncio. mc: AsyncMinecraft.
+    События передаются только обработчикам (on_...)"""
+
+    def __init__(self, mc, min_interval=0.02, max_interval=1.0, backoff=1.5):
+        _EventDispatch.__init__(self, mc, min_interval, max_interval, backoff, None)
+        self._task = None
+
+    async def poll(self):
+        events = self.mc.events
+        self._dispatch(*await asyncio.gather(events.poll_block_hits(), events.poll_chat_posts(),
+                                             events.poll_projectile_hits()))
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await self.poll()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self._poll_failed()
+                await asyncio.sleep(self.interval)
+        finally:
+            self._close_queue()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+def test_stream():
+    import time
+
+    from .aio import AsyncConnection, AsyncMinecraft
+    from .emulator import EmulatorServer, World
+
+    world = World(ground=0)
+    with EmulatorServer(world=world) as server:
+        mc = server.minecraft()
+        cache = mc.enable_cache()
+
+        # One poll: handlers by event class, the queue, the cache and the interval
+        stream = EventStream(mc, min_interval=0.01, max_interval=0.08, backoff=2.0, queue_size=3)
+        seen = []
+        stream.on_block_hit(lambda e: seen.append(("hit", e.x, e.y, e.z)))
+        stream.on_chat_post(lambda e: seen.append(("chat", e.message)))
+        stream.on_projectile_hit(lambda e: seen.append(("arrow", e.victimName)))
+        stream.on_chat_post(lambda e: 1 / 0)
+        assert mc.get_block(1, -1, 1) == "stone" and cache.get_block(1, -1, 1) == "stone"
+        world.hit_block(1, -1, 1)
+        world.post_chat(1, "hi")
+        world.post_chat(1, "again")
+        world.hit_projectile(0, 0, 0, "Steve", "Alex")
+        stream.poll()
+        assert seen == [("hit", 1, -1, 1), ("chat", "hi"), ("chat", "again"), ("arrow", "Alex")]
+        assert cache.get_block(1, -1, 1) is None
+        assert (stream.events, stream.errors, stream.dropped) == (4, 2, 1)
+        assert [type(stream.queue.get_nowait()) for _ in range(3)] == [BlockEvent, ChatEvent, ChatEvent]
+        assert stream.interval == 0.01
+        for expected in (0.02, 0.04, 0.08, 0.08):
+            stream.poll()
+            assert stream.interval == expected
+
+        # The thread: events reach the iterator until the stream stops
+        with stream:
+            world.post_chat(2, "late")
+            deadline = time.time() + 5
+            while stream.events < 5 and time.time() < deadline:
+                time.sleep(0.01)
+        assert [e.message for e in stream] == ["late"]
+        assert stream.polls > 5
+
+        # The asyncio stream
+        async def run():
+            amc = AsyncMinecraft(await AsyncConnection.open(*server.address))
+            astream = AsyncEventStream(amc, min_interval=0.01)
+            hits = []
+            astream.on_block_hit(hits.append)
+            astream.start()
+            world.hit_block(4, 5, 6)
+            for _ in range(500):
+                if hits:
+                    break
+                await asyncio.sleep(0.01)
+            await astream.stop()
+            await amc.conn.close()
+            return hits
+
+        assert [(e.x, e.y, e.z) for e in asyncio.run(run())] == [(4, 5, 6)]
+
+
+if __name__ == "__main__":
+    test_stream()
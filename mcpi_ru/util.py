@@ -3,6 +3,8 @@ try:
 except ImportError:
     import collections as collections
 
+from .vec3 import Vec3, FrozenVec3
+
 
 def flatten(l_arg):
     for e in l_arg:
@@ -14,7 +16,33 @@ def flatten(l_arg):
 
 
 def flatten_parameters_to_bytestring(l_arg):
-    return b",".join(map(_misc_to_bytes, flatten(l_arg)))
+    out = []
+    _parameters_to_bytes(l_arg, out)
+    return b",".join(out)
+
+
+def _parameters_to_bytes(l_arg, out):
+    """
+    Appends the UTF-8 text of every flattened parameter to out. Gives the same
+    bytes as mapping _misc_to_bytes over flatten(l_arg), with fast paths for the
+    exact types that commands are usually made of.
+    """
+    for e in l_arg:
+        t = type(e)
+        if t is int:
+            out.append(b"%d" % e)
+        elif t is str:
+            out.append(e.encode("UTF-8"))
+        elif t is float:
+            out.append(b"%r" % e)
+        elif t is Vec3 or t is FrozenVec3:
+            _parameters_to_bytes((e.x, e.y, e.z), out)
+        elif t is tuple or t is list:
+            _parameters_to_bytes(e, out)
+        elif isinstance(e, collections.Iterable) and not isinstance(e, str):
+            _parameters_to_bytes(e, out)
+        else:
+            out.append(_misc_to_bytes(e))
 
 
 def _misc_to_bytes(m):
@@ -24,3 +52,66 @@ def _misc_to_bytes(m):
     """
 
     return str(m).encode("UTF-8")
+
+
+_command_prefixes = {}
+
+
+def command_to_bytestring(f, data):
+    """One protocol line f(data...)\\n. The b"f(" prefix is built once per command name"""
+    prefix = _command_prefixes.get(f)
+    if prefix is None:
+        prefix = _command_prefixes[f] = f + b"("
+    out = []
+    _parameters_to_bytes(data, out)
+    return b"".join((prefix, b",".join(out), b")\n"))
+
+
+def commands_to_bytestring(commands):
+    """Serializes [(f, data)] into one buffer of protocol lines"""
+    buf = bytearray()
+    prefixes = _command_prefixes
+    for f, data in commands:
+        prefix = prefixes.get(f)
+        if prefix is None:
+            prefix = prefixes[f] = f + b"("
+        out = []
+        _parameters_to_bytes(data, out)
+        buf += prefix
+        buf += b",".join(out)
+        buf += b")\n"
+    return buf
+
+
+def test_util():
+    # Compare with the reference serialization: str() of every flattened item
+
+    def reference(l_arg):
+        return b",".join(map(_misc_to_bytes, flatten(l_arg)))
+
+    class Cube:
+        def __iter__(self):
+            return iter([Vec3(0, 0, 0), Vec3(1.5, 2, -3)])
+
+    cases = [
+        (),
+        (1, 2, 3),
+        (-7, 0.5, 1e20, float("inf"), 1.0 / 3),
+        ("stone", "камень", ""),
+        (True, False, None),
+        (b"ab",),
+        ([], [[1, 2], (3, [4])]),
+        (Vec3(1, 2, 3), Vec3(0.5, -1, 2).freeze()),
+        (Cube(), "wool", 5),
+        (range(3), {"k": 1}),
+    ]
+    for case in cases:
+        assert flatten_parameters_to_bytestring(case) == reference(case), case
+
+    assert command_to_bytestring(b"world.setBlock", (1, 2, 3, "stone")) == b"world.setBlock(1,2,3,stone)\n"
+    batch = [(b"world.setBlock", (Vec3(1, 2, 3), "stone")), (b"chat.post", ("hi",)), (b"events.clear", ())]
+    assert commands_to_bytestring(batch) == b"".join(command_to_bytestring(f, d) for f, d in batch)
+
+
+if __name__ == "__main__":
+    test_util()
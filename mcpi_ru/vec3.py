@@ -1,13 +1,37 @@
-class Vec3:
+import math
+import operator
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _Vec3Type(type):
+    # Vec3.y(n) is a constructor while v.y is a coordinate slot. A data
+    # descriptor on the metaclass answers the class attribute, so instances
+    # keep the plain slot.
+    @property
+    def y(cls):
+        return _vec3_y
+
+
+def _vec3_y(n=1):
+    return Vec3(0, n, 0)
+
+
+class Vec3(metaclass=_Vec3Type):
+    """3-D vector. Mutable, so not hashable: use freeze() for a dict key"""
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, x=0, y=0, z=0):
         self.x = x
         self.y = y
         self.z = z
 
     def __add__(self, rhs):
-        c = self.clone()
-        c += rhs
-        return c
+        return Vec3(self.x + rhs.x, self.y + rhs.y, self.z + rhs.z)
 
     def __iadd__(self, rhs):
         self.x += rhs.x
@@ -22,9 +46,9 @@ class Vec3:
         return self.x * self.x + self.y * self.y + self.z * self.z
 
     def __mul__(self, k):
-        c = self.clone()
-        c *= k
-        return c
+        return Vec3(self.x * k, self.y * k, self.z * k)
+
+    __rmul__ = __mul__
 
     def __imul__(self, k):
         self.x *= k
@@ -39,10 +63,13 @@ class Vec3:
         return Vec3(-self.x, -self.y, -self.z)
 
     def __sub__(self, rhs):
-        return self.__add__(-rhs)
+        return Vec3(self.x - rhs.x, self.y - rhs.y, self.z - rhs.z)
 
     def __isub__(self, rhs):
-        return self.__iadd__(-rhs)
+        self.x -= rhs.x
+        self.y -= rhs.y
+        self.z -= rhs.z
+        return self
 
     def __repr__(self):
         return "Vec3(%s,%s,%s)" % (self.x, self.y, self.z)
@@ -68,9 +95,15 @@ class Vec3:
         return 0
 
     def __eq__(self, rhs):
-        if self.x == rhs.x and self.y == rhs.y and self.z == rhs.z:
-            return True
-        return False
+        if not isinstance(rhs, Vec3):
+            return NotImplemented
+        return self.x == rhs.x and self.y == rhs.y and self.z == rhs.z
+
+    __hash__ = None
+
+    def freeze(self):
+        """Immutable, hashable copy of the vector => FrozenVec3"""
+        return FrozenVec3(self.x, self.y, self.z)
 
     def iround(self):
         self._map(lambda v: int(v + 0.5))
@@ -84,10 +117,6 @@ class Vec3:
     def rotate_right(self):
         self.x, self.z = -self.z, self.x
 
-    @staticmethod
-    def y(n=1):
-        return Vec3(0, n, 0)
-
     @staticmethod
     def up(n=1):
         return Vec3.y(n)
@@ -97,6 +126,169 @@ class Vec3:
         return Vec3.y(-n)
 
 
+class FrozenVec3(Vec3):
+    """Vec3 that can't change, so it can be a dict key or a set member.
+    In-place operators return new vectors"""
+    __slots__ = ()
+
+    def __init__(self, x=0, y=0, z=0):
+        object.__setattr__(self, "x", x)
+        object.__setattr__(self, "y", y)
+        object.__setattr__(self, "z", z)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("A frozen Vec3 can't be changed, use clone()")
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.z))
+
+    def freeze(self):
+        return self
+
+    def __iadd__(self, rhs):
+        return self + rhs
+
+    def __isub__(self, rhs):
+        return self - rhs
+
+    def __imul__(self, k):
+        return self * k
+
+    def _immutable(self, *args):
+        raise TypeError("FrozenVec3 is immutable, use clone()")
+
+    _map = iround = ifloor = rotate_left = rotate_right = _immutable
+
+
+class Vec3Array:
+    """Массив векторов, хранящийся по столбцам xs, ys, zs (numpy, если установлен,
+    иначе array). Операции выполняются сразу над всеми точками."""
+    __slots__ = ("xs", "ys", "zs")
+
+    def __init__(self, xs=(), ys=(), zs=()):
+        if not (len(xs) == len(ys) == len(zs)):
+            raise ValueError("Columns have different lengths")
+        self.xs = _column(xs)
+        self.ys = _column(ys)
+        self.zs = _column(zs)
+
+    @staticmethod
+    def from_points(points):
+        """Из последовательности Vec3 или кортежей (x, y, z)"""
+        points = [tuple(p) for p in points]
+        if not points:
+            return Vec3Array()
+        xs, ys, zs = zip(*points)
+        return Vec3Array(xs, ys, zs)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, i):
+        return Vec3(_scalar(self.xs[i]), _scalar(self.ys[i]), _scalar(self.zs[i]))
+
+    def __iter__(self):
+        return map(Vec3, self.tolist_x(), self.tolist_y(), self.tolist_z())
+
+    def tolist_x(self):
+        return self.xs.tolist()
+
+    def tolist_y(self):
+        return self.ys.tolist()
+
+    def tolist_z(self):
+        return self.zs.tolist()
+
+    def tolist(self) -> list:
+        """=> [(x, y, z)]"""
+        return list(zip(self.tolist_x(), self.tolist_y(), self.tolist_z()))
+
+    def _binary(self, rhs, op):
+        if isinstance(rhs, Vec3Array):
+            return Vec3Array(_apply(op, self.xs, rhs.xs), _apply(op, self.ys, rhs.ys),
+                             _apply(op, self.zs, rhs.zs))
+        return Vec3Array(_apply_scalar(op, self.xs, rhs.x), _apply_scalar(op, self.ys, rhs.y),
+                         _apply_scalar(op, self.zs, rhs.z))
+
+    def __add__(self, rhs):
+        """Сложить с Vec3 (сдвиг всех точек) или с Vec3Array той же длины"""
+        return self._binary(rhs, operator.add)
+
+    def __sub__(self, rhs):
+        return self._binary(rhs, operator.sub)
+
+    def __mul__(self, k):
+        return Vec3Array(_apply_scalar(operator.mul, self.xs, k), _apply_scalar(operator.mul, self.ys, k),
+                         _apply_scalar(operator.mul, self.zs, k))
+
+    __rmul__ = __mul__
+
+    def scale(self, k):
+        return self * k
+
+    def __neg__(self):
+        return self * -1
+
+    def rotate_left(self):
+        self.xs, self.zs = self.zs, _apply_scalar(operator.mul, self.xs, -1)
+
+    def rotate_right(self):
+        self.xs, self.zs = _apply_scalar(operator.mul, self.zs, -1), self.xs
+
+    def floor(self):
+        """Целые координаты блоков (math.floor, как int_floor) => Vec3Array"""
+        if numpy is not None:
+            return Vec3Array(numpy.floor(self.xs).astype(numpy.int64), numpy.floor(self.ys).astype(numpy.int64),
+                             numpy.floor(self.zs).astype(numpy.int64))
+        return Vec3Array(array("q", map(math.floor, self.xs)), array("q", map(math.floor, self.ys)),
+                         array("q", map(math.floor, self.zs)))
+
+    def length_sqr(self):
+        xs, ys, zs = self.xs, self.ys, self.zs
+        if numpy is not None:
+            return xs * xs + ys * ys + zs * zs
+        return array("d", [x * x + y * y + z * z for x, y, z in zip(xs, ys, zs)])
+
+    def length(self):
+        """Длины всех векторов"""
+        if numpy is not None:
+            return numpy.sqrt(self.length_sqr())
+        return array("d", map(math.sqrt, self.length_sqr()))
+
+    def __repr__(self):
+        return "Vec3Array(%d points)" % len(self)
+
+
+def _column(values):
+    if numpy is not None:
+        column = numpy.asarray(values)
+        if column.dtype.kind not in "iuf":
+            column = column.astype(numpy.float64)
+        return column
+    if isinstance(values, array):
+        return values
+    values = list(values)
+    if all(isinstance(v, int) for v in values):
+        return array("q", values)
+    return array("d", values)
+
+
+def _scalar(v):
+    return v.item() if hasattr(v, "item") else v
+
+
+def _apply(op, a, b):
+    if numpy is not None:
+        return op(a, b)
+    return _column(map(op, a, b))
+
+
+def _apply_scalar(op, a, k):
+    if numpy is not None:
+        return op(a, k)
+    return _column([op(v, k) for v in a])
+
+
 def test_vec3():
     # Note: It's not testing everything
 
@@ -131,6 +323,46 @@ def test_vec3():
     e = eval(repr(it))
     assert e == it
 
+    # 4.1 Only frozen vectors are hashable
+    v = Vec3(1, 2, 3)
+    try:
+        hash(v)
+        assert False
+    except TypeError:
+        pass
+    key = v.freeze()
+    d = {key: "a"}
+    assert d[Vec3(1, 2, 3).freeze()] == "a"
+    v.x = 10
+    v.ifloor()
+    assert key == Vec3(1, 2, 3) and key in d
+    try:
+        key.x = 10
+        assert False
+    except AttributeError:
+        pass
+    for change in (key.rotate_left, key.rotate_right, key.ifloor):
+        try:
+            change()
+            assert False
+        except TypeError as e:
+            assert "immutable" in str(e)
+    moved = key
+    moved += Vec3(1, 0, 0)
+    assert key == Vec3(1, 2, 3) and moved == Vec3(2, 2, 3) and type(key.clone()) is Vec3
+    assert Vec3.y(2) == Vec3(0, 2, 0) and Vec3.up().y == 1
+
+    # 5.1 Vec3Array
+    points = Vec3Array.from_points([a, b, c])
+    assert list(points + Vec3(1, 1, 1)) == [a + Vec3(1, 1, 1), b + Vec3(1, 1, 1), c + Vec3(1, 1, 1)]
+    assert list(points - points) == [Vec3(0, 0, 0)] * 3
+    assert list(points * 2) == [a * 2, b * 2, c * 2]
+    points.rotate_left()
+    a.rotate_left()
+    assert points[0] == a
+    assert list(Vec3Array.from_points([(1.5, -0.5, 2)]).floor()) == [Vec3(1, -1, 2)]
+    assert list(Vec3Array.from_points([(3, 4, 0)]).length()) == [5.0]
+
 
 if __name__ == "__main__":
     test_vec3()
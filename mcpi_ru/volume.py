@@ -0,0 +1,218 @@
+from array import array
+
+from .minecraft import int_floor
+from .pipeline import Pipeline
+from .vec3 import Vec3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Bulk reads of a cuboid of blocks.
+
+    world.getBlocks answers with the blocks of a cuboid in y, x, z order
+    (y outermost, z innermost). Block values are kept as indices into a
+    palette of block names, so a volume is one compact uint16 array: a
+    numpy array of shape (ny, nx, nz) when numpy is installed, a flat
+    array('H') in the same order otherwise."""
+
+DEFAULT_CHUNK = (16, 64, 16)
+
+
+class Palette(dict):
+    """Block name (bytes) -> index. Unknown names get the next free index"""
+
+    def __missing__(self, key):
+        if len(self) > 0xFFFF:
+            raise ValueError("More than 65536 different blocks in one volume")
+        index = self[key] = len(self)
+        return index
+
+    def names(self) -> list:
+        names = [None] * len(self)
+        for name, index in self.items():
+            names[index] = name.decode("UTF-8")
+        return names
+
+
+class Volume:
+    """Блоки кубоида.
+
+    origin: Vec3 минимального угла, size: (nx, ny, nz),
+    palette: [имя блока], data: индексы palette в порядке [y][x][z]."""
+
+    def __init__(self, origin, size, data, palette):
+        self.origin = origin
+        self.size = tuple(size)
+        self.data = data
+        self.palette = palette
+
+    @property
+    def shape(self):
+        """(ny, nx, nz): порядок осей в data"""
+        nx, ny, nz = self.size
+        return ny, nx, nz
+
+    def __len__(self):
+        nx, ny, nz = self.size
+        return nx * ny * nz
+
+    def index(self, x, y, z) -> int:
+        """Номер блока с мировыми координатами (x, y, z) в плоском data"""
+        nx, ny, nz = self.size
+        dx, dy, dz = x - self.origin.x, y - self.origin.y, z - self.origin.z
+        if not (0 <= dx < nx and 0 <= dy < ny and 0 <= dz < nz):
+            raise IndexError("(%s, %s, %s) is outside of the volume" % (x, y, z))
+        return (dy * nx + dx) * nz + dz
+
+    def get(self, x, y, z) -> str:
+        """Имя блока с мировыми координатами (x, y, z)"""
+        i = self.index(x, y, z)
+        if numpy is not None and isinstance(self.data, numpy.ndarray):
+            return self.palette[int(self.data.flat[i])]
+        return self.palette[self.data[i]]
+
+    def __repr__(self):
+        return "Volume(%s, %s, %d block types)" % (self.origin, self.size, len(self.palette))
+
+
+def normalize_cuboid(p0, p1):
+    """=> (min corner, max corner) as lists of ints"""
+    a = int_floor(p0)
+    b = int_floor(p1)
+    return [min(u, v) for u, v in zip(a, b)], [max(u, v) for u, v in zip(a, b)]
+
+
+def split_cuboid(lo, hi, chunk):
+    """Splits the cuboid lo..hi (inclusive) into sub-cuboids of at most chunk blocks per axis.
+    Yields (lo, hi) pairs in y, x, z order"""
+    cx, cy, cz = chunk
+    for y in range(lo[1], hi[1] + 1, cy):
+        for x in range(lo[0], hi[0] + 1, cx):
+            for z in range(lo[2], hi[2] + 1, cz):
+                yield ((x, y, z),
+                       (min(x + cx - 1, hi[0]), min(y + cy - 1, hi[1]), min(z + cz - 1, hi[2])))
+
+
+def _block_parser(palette, count):
+    def parse(s):
+        # One dict lookup per block, straight into uint16. numpy.unique over the
+        # split is slower: it sorts the names, and the split is needed anyway.
+        # array() fills faster from a list than from an iterator.
+        data = array("H", list(map(palette.__getitem__, s.split(b","))))
+        if len(data) != count:
+            raise ValueError("Expected %d blocks, got %d" % (count, len(data)))
+        return data
+    return parse
+
+
+def read_volume(conn, p0, p1, chunk=DEFAULT_CHUNK, window=64):
+    """Reads the cuboid p0..p1 => Volume. Sub-cuboids of chunk blocks are
+    requested through one Pipeline and copied into the result"""
+    lo, hi = normalize_cuboid(p0, p1)
+    nx, ny, nz = [b - a + 1 for a, b in zip(lo, hi)]
+    palette = Palette()
+    pipeline = Pipeline(conn, window)
+    parts = []
+    for a, b in split_cuboid(lo, hi, chunk):
+        count = (b[0] - a[0] + 1) * (b[1] - a[1] + 1) * (b[2] - a[2] + 1)
+        parts.append((a, b, pipeline.query(_block_parser(palette, count), b"world.getBlocks", a, b)))
+    pipeline.execute()
+
+    if len(parts) == 1:
+        data = parts[0][2].result()
+        if numpy is not None:
+            data = numpy.frombuffer(data, dtype=numpy.uint16).reshape(ny, nx, nz)
+        return Volume(Vec3(*lo), (nx, ny, nz), data, palette.names())
+
+    if numpy is not None:
+        data = numpy.empty((ny, nx, nz), dtype=numpy.uint16)
+        for a, b, result in parts:
+            sx, sy, sz = b[0] - a[0] + 1, b[1] - a[1] + 1, b[2] - a[2] + 1
+            ox, oy, oz = a[0] - lo[0], a[1] - lo[1], a[2] - lo[2]
+            sub = numpy.frombuffer(result.result(), dtype=numpy.uint16).reshape(sy, sx, sz)
+            data[oy:oy + sy, ox:ox + sx, oz:oz + sz] = sub
+    else:
+        data = array("H", bytes(2 * nx * ny * nz))
+        for a, b, result in parts:
+            sx, sy, sz = b[0] - a[0] + 1, b[1] - a[1] + 1, b[2] - a[2] + 1
+            ox, oy, oz = a[0] - lo[0], a[1] - lo[1], a[2] - lo[2]
+            sub = result.result()
+            i = 0
+            for y in range(oy, oy + sy):
+                for x in range(ox, ox + sx):
+                    start = (y * nx + x) * nz + oz
+                    data[start:start + sz] = sub[i:i + sz]
+                    i += sz
+    return Volume(Vec3(*lo), (nx, ny, nz), data, palette.names())
+
+
+def volume_values(voxels):
+    """Block values of voxels as (size, flat list in y, x, z order).
+    voxels is a Volume, a numpy array of shape (ny, nx, nz) or nested
+    sequences indexed [y][x][z]"""
+    if isinstance(voxels, Volume):
+        palette = voxels.palette
+        data = voxels.data.ravel().tolist() if numpy is not None and isinstance(voxels.data, numpy.ndarray) \
+            else voxels.data
+        return voxels.size, [palette[i] for i in data]
+    if numpy is not None and isinstance(voxels, numpy.ndarray):
+        if voxels.ndim != 3:
+            raise ValueError("Expected a 3-D array, got shape %s" % (voxels.shape,))
+        ny, nx, nz = voxels.shape
+        return (nx, ny, nz), voxels.ravel().tolist()
+    ny = len(voxels)
+    nx = len(voxels[0]) if ny else 0
+    nz = len(voxels[0][0]) if nx else 0
+    values = []
+    for plane in voxels:
+        if len(plane) != nx:
+            raise ValueError("Voxels are not a cuboid")
+        for row in plane:
+            if len(row) != nz:
+                raise ValueError("Voxels are not a cuboid")
+            values.extend(row)
+    return (nx, ny, nz), values
+
+
+def merge_cuboids(values, size):
+    """Greedily merges equal neighbouring values into axis-aligned cuboids.
+
+    values: flat list in y, x, z order (None = leave the block alone),
+    size: (nx, ny, nz). => [((x0, y0, z0), (x1, y1, z1), value)] with
+    inclusive corners relative to the origin of the volume"""
+    nx, ny, nz = size
+    done = bytearray(len(values))
+    cuboids = []
+
+    def run_free(start, z0, z1, value):
+        a, b = start + z0, start + z1
+        return 1 not in done[a:b] and values[a:b] == [value] * (b - a)
+
+    for y in range(ny):
+        for x in range(nx):
+            base = (y * nx + x) * nz
+            z = 0
+            while z < nz:
+                value = values[base + z]
+                if value is None or done[base + z]:
+                    z += 1
+                    continue
+                z1 = z + 1
+                while z1 < nz and not done[base + z1] and values[base + z1] == value:
+                    z1 += 1
+                x1 = x + 1
+                while x1 < nx and run_free((y * nx + x1) * nz, z, z1, value):
+                    x1 += 1
+                y1 = y + 1
+                while y1 < ny and all(run_free((y1 * nx + xx) * nz, z, z1, value) for xx in range(x, x1)):
+                    y1 += 1
+                mark = b"\x01" * (z1 - z)
+                for yy in range(y, y1):
+                    for xx in range(x, x1):
+                        start = (yy * nx + xx) * nz
+                        done[start + z:start + z1] = mark
+                cuboids.append(((x, y, z), (x1 - 1, y1 - 1, z1 - 1), value))
+                z = z1
+    return cuboids